@@ -0,0 +1,60 @@
+# Benchmark loading (JSON -> arrays) and saving (arrays -> JSON) as the number of measurements per field grows
+# Usage: python benchmarks/bench_json_conversion.py
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from galcat.core import Database
+
+N_FIELDS = 10
+N_MEASUREMENTS = [1, 10, 100, 1000, 5000]
+N_REPEAT = 3
+
+
+def make_doc(n_measurements):
+    doc = {'name': 'Bench Galaxy'}
+    for i in range(N_FIELDS):
+        doc['field_{}'.format(i)] = [{'value': float(j), 'error_upper': 0.1, 'error_lower': 0.1,
+                                      'best': int(j == 0), 'reference': 'Ref_{}'.format(j), 'unit': 'deg'}
+                                     for j in range(n_measurements)]
+    return doc
+
+
+def best_time(func, *args):
+    times = []
+    for _ in range(N_REPEAT):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    # An empty database is enough to exercise the conversion layer
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.join(tmp_dir, 'data')
+        os.mkdir(data_dir)
+        references_file = os.path.join(tmp_dir, 'references.json')
+        with open(references_file, 'w') as f:
+            f.write('[]')
+        db = Database(directory=data_dir, references_file=references_file)
+        run(db)
+
+
+def run(db):
+    print('{:>14} {:>12} {:>12}'.format('measurements', 'load (ms)', 'save (ms)'))
+    for n in N_MEASUREMENTS:
+        doc = make_doc(n)
+        fixed = db._recursive_json_fix(doc)
+        assert isinstance(fixed['field_0'], np.ndarray) and len(fixed['field_0']) == n
+
+        load_time = best_time(db._recursive_json_fix, doc)
+        save_time = best_time(db.save_from_db, fixed, False, '', False)
+        print('{:>14} {:>12.3f} {:>12.3f}'.format(n, 1e3 * load_time, 1e3 * save_time))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
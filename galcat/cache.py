@@ -0,0 +1,69 @@
+# Small caching utilities
+import json
+import hashlib
+from collections import OrderedDict
+
+__all__ = ['LRUCache', 'canonical_key']
+
+
+def _tagged(value):
+    # Values JSON cannot encode (eg, compiled regular expressions) keep their type so they never collide with a string
+    return {'__type__': type(value).__qualname__, 'repr': repr(value)}
+
+
+def canonical_key(*args):
+    """
+    Hash the arguments (dicts, lists, strings, numbers) in a canonical form, so that dicts with the same
+    contents give the same key regardless of insertion order. Other values are encoded by type and repr.
+
+    Returns
+    -------
+    key : str
+        Hex digest of the canonical JSON representation
+    """
+
+    text = json.dumps(args, sort_keys=True, default=_tagged)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=16):
+        """
+        Least-recently-used cache. The least recently used entry is evicted when more than maxsize
+        entries are stored. A maxsize of 0 disables caching.
+
+        Parameters
+        ----------
+        maxsize : int
+            Maximum number of entries (Default: 16)
+        """
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
@@ -0,0 +1,353 @@
+# Columnar projection of the in-memory database for vectorized queries
+import re
+import numbers
+from itertools import chain
+import numpy as np
+
+__all__ = ['ColumnarProjection', 'FieldColumns', 'UnsupportedQuery', 'document_keys']
+
+_UNCOMPARABLE = object()  # placeholder for nested values that never compare equal
+
+
+class UnsupportedQuery(Exception):
+    """Raised when a query cannot be compiled to the columnar representation"""
+    pass
+
+
+_NUMBER_TYPES = (int, float, np.integer, np.floating)
+_PLAIN_NUMBER_TYPES = {int, float, bool}
+_PLAIN_TYPES = {int, float, bool, str, type(None)}
+
+
+def _is_number(value):
+    # Concrete types are checked first as the numbers.Real check is comparatively slow
+    if isinstance(value, _NUMBER_TYPES):
+        return True
+    return isinstance(value, numbers.Real) and not isinstance(value, np.ndarray)
+
+
+def _is_comparable(value):
+    # Values the columns can be compared with; regular expressions and None (which also matches missing
+    # fields) are left to the manual engine
+    return not (value is None or isinstance(value, (list, dict, np.ndarray, re.Pattern)))
+
+
+def document_keys(docs):
+    """
+    Top-level keys of the documents.
+
+    Parameters
+    ----------
+    docs : np.array
+        Numpy array of documents
+
+    Returns
+    -------
+    all_keys : dict
+        All keys in order of first appearance (values are None)
+    scalar_keys : set
+        Keys that hold a plain (non-array) value in at least one document
+    """
+
+    all_keys = dict.fromkeys(chain.from_iterable(docs))
+    scalar_keys = {key for doc in docs for key, val in doc.items() if not isinstance(val, (list, np.ndarray))}
+    return all_keys, scalar_keys
+
+
+class FieldColumns(object):
+    def __init__(self, field, docs):
+        """
+        Flat columns for all measurements of a single field, one row per measurement.
+        Rows are grouped by parent document in document order.
+
+        Parameters
+        ----------
+        field : str
+            Name of the field, eg: 'surface_brightness'
+        docs : np.array
+            Numpy array of documents
+        """
+
+        self.field = field
+        parts = [doc.get(field) for doc in docs]
+        parts = [v if isinstance(v, (list, np.ndarray)) else () for v in parts]
+        measurements = list(chain.from_iterable(parts))
+        if set(map(type, measurements)) <= {dict}:
+            counts = np.fromiter(map(len, parts), dtype=int, count=len(parts))
+        else:
+            # Skip anything that is not a measurement dict
+            parts = [[v for v in values if isinstance(v, dict)] for values in parts]
+            measurements = list(chain.from_iterable(parts))
+            counts = np.fromiter(map(len, parts), dtype=int, count=len(parts))
+
+        self.measurements = measurements
+        self.counts = counts
+        # Offset of the first row of each document and the documents that have any rows
+        self.offsets = np.cumsum(counts) - counts
+        self.doc_index = np.repeat(np.arange(len(docs)), counts)
+        self.has_rows = counts > 0
+        self._subfields = {}
+
+    def __len__(self):
+        return len(self.measurements)
+
+    def numeric(self, subfield):
+        # Float column for the subfield; missing and non-numeric values are NaN
+        return self._numeric_columns(subfield)[0]
+
+    def is_numeric(self, subfield):
+        # Boolean column that is True where the subfield holds a number
+        return self._numeric_columns(subfield)[1]
+
+    def _numeric_columns(self, subfield):
+        return self._subfield_columns(subfield)[:2]
+
+    def objects(self, subfield):
+        # Object column for the subfield; missing values are None and nested values never compare equal
+        return self._subfield_columns(subfield)[2]
+
+    def present(self, subfield):
+        # Boolean column that is True where the subfield is set (not missing or None)
+        return self._subfield_columns(subfield)[3]
+
+    def _subfield_columns(self, subfield):
+        # Numeric, numeric mask, object and presence columns of the subfield, built together from one pass
+        if subfield not in self._subfields:
+            values = [m.get(subfield) for m in self.measurements]
+            n_rows = len(values)
+            value_types = set(map(type, values))
+            objects = np.empty(n_rows, dtype=object)
+            if value_types <= _PLAIN_TYPES:
+                objects[:] = values
+                present = objects != None if type(None) in value_types else np.ones(n_rows, dtype=bool)  # noqa: E711
+            else:
+                present = np.zeros(n_rows, dtype=bool)
+                for i, value in enumerate(values):
+                    if value is None:
+                        continue
+                    present[i] = True
+                    objects[i] = _UNCOMPARABLE if isinstance(value, (list, dict, np.ndarray)) else value
+
+            if value_types <= _PLAIN_NUMBER_TYPES:
+                mask = np.ones(n_rows, dtype=bool)
+                numeric = np.array(values, dtype=float)
+            elif value_types <= _PLAIN_TYPES - _PLAIN_NUMBER_TYPES:
+                mask = np.zeros(n_rows, dtype=bool)
+                numeric = np.full(n_rows, np.nan)
+            else:
+                mask = np.fromiter(map(_is_number, values), dtype=bool, count=n_rows)
+                numeric = np.array([v if ok else np.nan for v, ok in zip(values, mask)], dtype=float)
+            self._subfields[subfield] = (numeric, mask, objects, present)
+        return self._subfields[subfield]
+
+    def select(self, reference=None):
+        """
+        Pick one measurement per document: the first measurement with the requested reference if one is given,
+        otherwise the first with best == 1. Documents with a single measurement always use it.
+
+        Parameters
+        ----------
+        reference : str or None
+            Reference to select (Default: None, use best == 1)
+
+        Returns
+        -------
+        rows : np.array
+            Row index of the selected measurement for each document, -1 where nothing was selected
+        """
+
+        n_rows = len(self.measurements)
+        rows = np.full(len(self.counts), -1)
+        if n_rows == 0:
+            return rows
+
+        if reference is not None:
+            candidates = self.objects('reference') == reference
+        else:
+            candidates = self.numeric('best') == 1
+
+        # First candidate of each document; n_rows marks documents without a candidate
+        row_index = np.where(candidates, np.arange(n_rows), n_rows)
+        first = np.full(len(self.counts), n_rows)
+        first[self.has_rows] = np.minimum.reduceat(row_index, self.offsets[self.has_rows])
+        rows[first < n_rows] = first[first < n_rows]
+
+        single = self.counts == 1
+        rows[single] = self.offsets[single]
+        return rows
+
+    def reduce(self, row_mask):
+        # A document matches if any of its measurements matches
+        doc_mask = np.zeros(len(self.counts), dtype=bool)
+        if len(row_mask) > 0:
+            doc_mask[self.has_rows] = np.logical_or.reduceat(row_mask, self.offsets[self.has_rows])
+        return doc_mask
+
+
+class ColumnarProjection(object):
+    def __init__(self, store):
+        """
+        Columnar view of a DocumentStore. Columns are built on first use and rebuilt
+        when the store has been modified since they were built.
+
+        Parameters
+        ----------
+        store : galcat.store.DocumentStore
+            Store to project
+        """
+
+        self.store = store
+        self._version = None
+        self._docs = None
+        self._fields = {}
+        self._top_level = {}
+        self._keys = None
+
+    def _refresh(self):
+        if self._version != self.store.version:
+            self._docs = self.store.as_array()
+            self._fields = {}
+            self._top_level = {}
+            self._keys = None
+            self._version = self.store.version
+
+    @property
+    def docs(self):
+        self._refresh()
+        return self._docs
+
+    def field(self, field):
+        """
+        Get the measurement columns of a field.
+
+        Parameters
+        ----------
+        field : str
+            Name of the field
+
+        Returns
+        -------
+        columns : FieldColumns
+        """
+
+        self._refresh()
+        if field not in self._fields:
+            self._fields[field] = FieldColumns(field, self._docs)
+        return self._fields[field]
+
+    def keys(self):
+        # Top-level keys of all documents (see document_keys)
+        self._refresh()
+        if self._keys is None:
+            self._keys = document_keys(self._docs)
+        return self._keys
+
+    def top_level(self, key):
+        # Object column of a top-level scalar (eg, name); missing or embedded values never compare equal
+        self._refresh()
+        if key not in self._top_level:
+            column = np.empty(len(self._docs), dtype=object)
+            for i, doc in enumerate(self._docs):
+                value = doc.get(key, _UNCOMPARABLE)
+                if isinstance(value, (list, dict, np.ndarray)):
+                    value = _UNCOMPARABLE
+                column[i] = value
+            self._top_level[key] = column
+        return self._top_level[key]
+
+    def query(self, query):
+        """
+        Run a query against the projection.
+
+        Parameters
+        ----------
+        query : dict
+            Query in MongoDB's query language. Supports $gt, $gte, $lt, $lte, $or, equality and implicit AND.
+
+        Returns
+        -------
+        result : np.array
+            Numpy array of document results
+        """
+
+        mask = self.compile(query)
+        return self.docs[mask]
+
+    def compile(self, query):
+        """
+        Compile a query into a boolean mask over the documents.
+
+        Parameters
+        ----------
+        query : dict
+            Query in MongoDB's query language
+
+        Returns
+        -------
+        mask : np.array
+            Boolean array with one entry per document
+        """
+
+        mask = np.ones(len(self.docs), dtype=bool)
+        for key, value in query.items():
+            if key == '$or':
+                if not isinstance(value, list):
+                    raise UnsupportedQuery('$or requires a list of queries')
+                or_mask = np.zeros(len(mask), dtype=bool)
+                for sub_query in value:
+                    or_mask |= self.compile(sub_query)
+                mask &= or_mask
+            elif key.startswith('$'):
+                raise UnsupportedQuery('{} not supported by the columnar engine'.format(key))
+            else:
+                mask &= self._compile_clause(key, value)
+
+        return mask
+
+    def _compile_clause(self, key, value):
+        key_list = key.split('.')
+        if len(key_list) == 1:
+            if isinstance(value, (dict, list)):
+                raise UnsupportedQuery('Operators on top-level fields are not supported: {}'.format(key))
+            if not _is_comparable(value):
+                raise UnsupportedQuery('Cannot compare against {}'.format(value))
+            return self.top_level(key) == value
+        elif len(key_list) > 2:
+            raise UnsupportedQuery('Only field.subfield paths are supported: {}'.format(key))
+
+        columns = self.field(key_list[0])
+        subfield = key_list[1]
+        if isinstance(value, dict):
+            # Like MongoDB, each operator may be satisfied by a different measurement of the document
+            doc_mask = columns.reduce(np.ones(len(columns), dtype=bool))
+            for db_operator, sub_value in value.items():
+                doc_mask &= columns.reduce(self._compare(columns, subfield, db_operator, sub_value))
+            return doc_mask
+
+        return columns.reduce(self._compare(columns, subfield, '$eq', value))
+
+    @staticmethod
+    def _compare(columns, subfield, db_operator, value):
+        # Row mask for a single comparison
+        if not _is_comparable(value):
+            raise UnsupportedQuery('Cannot compare against {}'.format(value))
+
+        if db_operator == '$eq':
+            if _is_number(value):
+                return columns.numeric(subfield) == value
+            return columns.objects(subfield) == value
+
+        if not _is_number(value):
+            raise UnsupportedQuery('Range operators require numeric values')
+
+        column = columns.numeric(subfield)
+        with np.errstate(invalid='ignore'):
+            if db_operator == '$gt':
+                return column > value
+            elif db_operator == '$gte':
+                return column >= value
+            elif db_operator == '$lt':
+                return column < value
+            elif db_operator == '$lte':
+                return column <= value
+        raise UnsupportedQuery('{} not supported by the columnar engine'.format(db_operator))
@@ -1,18 +1,33 @@
 # Core functionality for database implementation
 import os
 import json
+import time
+import numbers
 import warnings
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-from copy import deepcopy
 from astropy import units as u
-from astropy.table import QTable, Table
+from astropy.table import QTable, Table, Column, MaskedColumn
 from astropy.units import Quantity
+from astropy.utils.masked import Masked
 from astropy.coordinates import SkyCoord
 from astropy import uncertainty as unc
+from .store import DocumentStore, LazyDocumentStore, HashIndex
+from .columnar import ColumnarProjection, FieldColumns, UnsupportedQuery, document_keys
+from .loader import LoadReport, list_json_files, iter_json_files, text_digest, file_digest, write_text_atomic
+from .loader import build_manifest, MANIFEST_FILE
+from .snapshot import Snapshot
+from .cache import LRUCache, canonical_key
+from .query import compile_query, QueryPlan
+from .spatial import SpatialIndex
+from .distributions import DistributionCache, STATISTICS
 
 __all__ = ['Database', 'write_curation']
 
+_MISSING = object()  # placeholder for fields that are not in a document
+
 
 def _get_values_from_distribution(distribution, unit=None):
     """Assuming a normal distribution, return value+error; includes unit if provided"""
@@ -35,6 +50,142 @@ def _get_values_from_distribution(distribution, unit=None):
     return out_dict
 
 
+def _list_to_array(items):
+    """
+    Convert a list of (already converted) JSON elements to a numpy array in a single allocation.
+    The result matches appending each element in turn to an empty array with np.append:
+    dicts give an object array, plain values a float or string array and nested arrays are flattened.
+    """
+
+    if len(items) > 0 and all(isinstance(elem, dict) for elem in items):
+        out_array = np.empty(len(items), dtype=object)
+        for i, elem in enumerate(items):
+            out_array[i] = elem
+        return out_array
+
+    if not any(isinstance(elem, (dict, np.ndarray)) for elem in items):
+        return np.append(np.array([]), items)
+
+    # Mixed content: flatten everything into one concatenation
+    parts = [np.array([])]
+    for elem in items:
+        if isinstance(elem, dict):
+            part = np.empty(1, dtype=object)
+            part[0] = elem
+        else:
+            part = np.ravel(elem)
+        parts.append(part)
+    return np.concatenate(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_unit(unit):
+    # Parse a unit string once; returns None if astropy does not recognize it
+    try:
+        return u.Unit(unit)
+    except (ValueError, TypeError):
+        return None
+
+
+def _projection_paths(projection, id_column='name'):
+    """
+    Normalize a projection to a list of field or field.subfield paths, always including the ID column.
+
+    Parameters
+    ----------
+    projection : list or dict
+        List of paths or a MongoDB inclusion projection, eg: ['ra', 'v_mag.value'] or {'ra': 1}
+    id_column : str
+        Field that is always returned (Default: 'name')
+
+    Returns
+    -------
+    paths : list
+        Paths to include
+    """
+
+    if isinstance(projection, str):
+        projection = [projection]
+    if isinstance(projection, dict):
+        if not all(projection.values()):
+            raise RuntimeError('Only inclusion projections are supported: {}'.format(projection))
+        projection = list(projection.keys())
+    return list(dict.fromkeys([id_column] + list(projection)))
+
+
+def _project_document(doc, paths):
+    # New document with only the requested fields. For field.subfield paths only those keys are kept in each
+    # measurement; measurements themselves are shared with the input when the whole field is requested.
+    subfields = {}
+    for path in paths:
+        field, _, sub = path.partition('.')
+        if not sub:
+            subfields[field] = None
+        elif subfields.get(field, ()) is not None:
+            subfields.setdefault(field, set()).add(sub.split('.')[0])
+
+    out_doc = {}
+    for field, keys in subfields.items():
+        if field not in doc:
+            continue
+        value = doc[field]
+        if keys is None or not isinstance(value, (list, np.ndarray)):
+            out_doc[field] = value
+            continue
+        out_value = np.empty(len(value), dtype=object)
+        for i, each_val in enumerate(value):
+            out_value[i] = {k: v for k, v in each_val.items() if k in keys} if isinstance(each_val, dict) \
+                else each_val
+        out_doc[field] = out_value
+    return out_doc
+
+
+def _selection_expression(condition):
+    # Aggregation expression for the field in $$kv: the first measurement matching the condition (or the only
+    # measurement), reduced to its value and unit. The mean is used as the value when a distribution is given.
+    # Plain values are passed through.
+    candidates = {'$cond': [{'$eq': [{'$size': '$$kv.v'}, 1]}, '$$kv.v',
+                            {'$filter': {'input': '$$kv.v', 'as': 'x', 'cond': condition}}]}
+    value = {'$cond': [{'$isArray': '$$m.distribution'}, {'$avg': '$$m.distribution'}, '$$m.value']}
+    selected = {'$map': {'input': {'$slice': [candidates, 1]}, 'as': 'm', 'in': {'value': value, 'unit': '$$m.unit'}}}
+    return {'$cond': [{'$isArray': '$$kv.v'}, selected, '$$kv.v']}
+
+
+def _table_pipeline(query, curation_dict, fields=None):
+    """
+    Compile the measurement selection of query_table to a MongoDB aggregation pipeline.
+    Each output document keeps the fields of the matched document in their original order, with every
+    measurement array reduced to at most one {'value', 'unit'} entry: the measurement with the curated
+    reference, otherwise the one with best == 1 (documents with a single measurement always use it).
+
+    Parameters
+    ----------
+    query : dict
+        Query in MongoDB query language
+    curation_dict : dict
+        Dictionary of field and reference to use for it
+    fields : list
+        Fields to keep (Default: None, all fields)
+
+    Returns
+    -------
+    pipeline : list
+        Aggregation pipeline
+    """
+
+    branches = [{'case': {'$eq': ['$$kv.k', field]},
+                 'then': _selection_expression({'$eq': ['$$x.reference', {'$literal': reference}]})}
+                for field, reference in curation_dict.items()]
+    best = _selection_expression({'$eq': ['$$x.best', 1]})
+    select = {'$switch': {'branches': branches, 'default': best}} if branches else best
+
+    items = {'$objectToArray': '$$ROOT'}
+    if fields is not None:
+        items = {'$filter': {'input': items, 'as': 'kv', 'cond': {'$in': ['$$kv.k', {'$literal': list(fields)}]}}}
+    rows = {'$arrayToObject': {'$map': {'input': items, 'as': 'kv', 'in': {'k': '$$kv.k', 'v': select}}}}
+    return [{'$match': query}, {'$replaceRoot': {'newRoot': rows}}]
+
+
 def _read_curation(curation):
     """
     Read a curation JSON to a dictionary
@@ -83,7 +234,9 @@ def write_curation(curation, existing={}, filename='curation.json'):
 
 class Database(object):
     def __init__(self, directory='data', conn_string='', mongo_db_name='', collection_name='',
-                 references_file='references.json', references_collection='references'):
+                 references_file='references.json', references_collection='references', workers=1,
+                 snapshot_file='', table_cache_size=None, mongo_client=None, plan_cache_size=256,
+                 distribution_dtype=None, lazy=False, memory_budget=None):
         """
         Database connection object which will prepare or load a database.
         It also includes a collection of references.
@@ -96,40 +249,442 @@ class Database(object):
         collection_name
         references_file
         references_collection
+        workers : int
+            Number of parallel workers used to parse the JSON files in directory (Default: 1)
+        snapshot_file : str
+            Optional snapshot file (eg, '.galcat_snapshot.pkl') used to cache the parsed references and documents.
+            Later constructions only parse the files that changed since the snapshot was written. Cannot be combined
+            with lazy. (Default: '')
+        table_cache_size : int
+            Number of query_table results to keep cached, least recently used first out. Cached results are
+            dropped whenever data or references are changed through this object; changes made to a MongoDB
+            database by other clients are not detected, so with MongoDB caching must be enabled explicitly.
+            Use 0 to disable. (Default: None, 16 for the in-memory database and 0 for MongoDB)
+        mongo_client : pymongo.MongoClient
+            Optional MongoDB client (or a stand-in such as mongomock.MongoClient) to use instead of
+            connecting to conn_string. Requires mongo_db_name and collection_name. (Default: None)
+        plan_cache_size : int
+            Number of compiled query plans to keep for the in-memory database, so repeated queries are not
+            parsed again. Use 0 to disable. (Default: 256)
+        distribution_dtype : numpy dtype
+            Type used to store distribution samples, eg: np.float32 to halve their memory use at the cost of
+            precision (also in files written by save_all). (Default: None, float64)
+        lazy : bool
+            Flag to only list the documents in directory at startup (using the sidecar manifest written there,
+            see load_manifest) and read each one on first access. Lookups by name or through an index only
+            read the documents they return; scans still read every document. Cannot be combined with
+            snapshot_file. Ignored with MongoDB. (Default: False)
+        memory_budget : int
+            With lazy, the approximate number of bytes (measured as file size) of unchanged documents to keep
+            in memory; the least recently used are dropped and read again when needed. The columnar query
+            engine is not used under a budget. (Default: None, no limit)
         """
 
         # Load or establish connection
         self.use_mongodb = False
-
-        if conn_string and mongo_db_name and collection_name:
+        self.reference_indexes = {}
+        self._version = 0
+        self.table_cache = LRUCache(16 if table_cache_size is None else table_cache_size)
+        self.plan_cache = LRUCache(plan_cache_size)
+        self._mongo_spatial_index = (None, None)  # (version, index) for MongoDB
+        self.distribution_dtype = distribution_dtype
+        self.distribution_cache = DistributionCache(distribution_dtype or float)
+        self._table_cache_version = None
+
+        if (conn_string or mongo_client is not None) and mongo_db_name and collection_name:
             # Connect to mongoDB
             try:
-                import pymongo
+                if mongo_client is None:
+                    import pymongo
+                    mongo_client = pymongo.MongoClient(conn_string)
                 self.use_mongodb = True
-                client = pymongo.MongoClient(conn_string)
-                database = client[mongo_db_name]  # database
+                if table_cache_size is None:
+                    # Writes by other clients are never seen, so cached tables could be stale
+                    self.table_cache = LRUCache(0)
+                database = mongo_client[mongo_db_name]  # database
                 self.references = database[references_collection]
                 self.db = database[collection_name]  # collection
             except ImportError:
                 print('ERROR : pymongo package required for using MongoDB')
                 self.use_mongodb = False
         else:
-            self.db = np.array([])
+            if lazy and snapshot_file:
+                # Lazily read documents never go through the snapshot, so it would silently go unused
+                msg = 'ERROR: snapshot_file cannot be used with lazy; use one or the other.'
+                print(msg)
+                raise RuntimeError(msg)
+            if lazy:
+                self.db = LazyDocumentStore(self._read_document, memory_budget=memory_budget)
+            else:
+                self.db = DocumentStore()
+            self.columns = ColumnarProjection(self.db)
             if not os.path.exists(references_file):
                 msg = 'ERROR: A json file of references must be provided.'
                 print(msg)
                 raise RuntimeError(msg)
+            snapshot = Snapshot(snapshot_file, self._snapshot_options()) if snapshot_file else None
+            self.load_references(references_file, snapshot=snapshot)
+            if lazy:
+                self.load_report = self.load_manifest(directory)
+            else:
+                self.load_report = self.load_all(directory, workers=workers, snapshot=snapshot)
+
+    @property
+    def version(self):
+        """Counter that changes whenever documents or references are modified; used to invalidate cached results"""
+        if self.use_mongodb:
+            return self._version
+        return self._version + self.db.version
+
+    def load_references(self, references_file, snapshot=None, index_columns=('key', 'id')):
+        """
+        Load (or reload) the references from a JSON file without re-reading the data documents.
+        Hash indexes are built on the requested columns so that query_reference lookups are O(1).
+
+        Parameters
+        ----------
+        references_file : str
+            Name of references JSON file to load
+        snapshot : galcat.snapshot.Snapshot
+            Optional snapshot used to cache the parsed references (Default: None)
+        index_columns : tuple
+            Reference fields to index (Default: ('key', 'id'))
+        """
+
+        self._version += 1
+        if self.use_mongodb:
+            self.update_references_mongodb(references_file)
+            return
+
+        references = snapshot.get_references(references_file) if snapshot else None
+        if references is None:
             with open(references_file, 'r') as f:
-                self.references = json.load(f)
-            self.load_all(directory)
+                references = json.load(f)
+            if snapshot:
+                snapshot.set_references(references_file, references)
+
+        self.references = references
+        self.reference_indexes = {}
+        for column in index_columns:
+            self.create_reference_index(column)
+
+    def create_reference_index(self, column):
+        """
+        Create a hash index on a reference field, eg: 'bibcode'. 'key' and 'id' are indexed by default.
+        With MongoDB the index is created on the references collection.
+
+        Parameters
+        ----------
+        column : str
+            Reference field to index
+        """
+
+        if self.use_mongodb:
+            self.references.create_index(column)
+        else:
+            self.reference_indexes[column] = HashIndex(column, self.references)
+
+    def add_reference(self, reference, id_column='key'):
+        """
+        Add a reference, replacing any existing reference with the same id_column value.
+        The reference indexes are updated accordingly.
+
+        Parameters
+        ----------
+        reference : dict
+            Reference to add, eg: {'key': 'Bellazzini_2006_1', 'id': 1, 'bibcode': '2006MNRAS.366..865B', ...}
+        id_column : str
+            Name of ID column to use to match against existing references (default: key)
+        """
+
+        id_value = reference[id_column]
+        self._version += 1
+        if self.use_mongodb:
+            self.references.replace_one(filter={id_column: id_value}, replacement=reference, upsert=True)
+            return
+
+        old_refs = self.query_reference({id_column: id_value})
+        if len(old_refs) > 0:
+            old_ref = old_refs[0]
+            ind = next(i for i, ref in enumerate(self.references) if ref is old_ref)
+            self.references[ind] = reference
+            for index in self.reference_indexes.values():
+                index.remove(old_ref)
+        else:
+            self.references.append(reference)
+        for index in self.reference_indexes.values():
+            index.add(reference)
+
+    def _snapshot_options(self):
+        # Options that change the converted documents; snapshots written with other options are discarded
+        dtype = None if self.distribution_dtype is None else np.dtype(self.distribution_dtype).str
+        return {'distribution_dtype': dtype, 'id_column': self.db.id_column}
+
+    def load_all(self, directory, workers=1, batch_size=100, use_processes=False, raise_errors=False,
+                 snapshot=None):
+        """
+        Load all JSON files in a directory to the database. Files are parsed (optionally in parallel)
+        and streamed into the database in batches. Files that fail to load are reported rather than
+        stopping the load.
+
+        Parameters
+        ----------
+        directory : str
+            Directory with JSON files. Hidden and non-json files are skipped.
+        workers : int
+            Number of parallel workers used to parse files (Default: 1)
+        batch_size : int
+            Number of parsed documents to insert at a time. With MongoDB each batch is sent as a single
+            unordered bulk write. (Default: 100)
+        use_processes : bool
+            Flag to parse in a process pool instead of a thread pool (Default: False)
+        raise_errors : bool
+            Flag to raise an exception at the first file that fails to load (Default: False)
+        snapshot : str or galcat.snapshot.Snapshot
+            Optional snapshot (or snapshot file name). Unchanged files are taken from the snapshot
+            and the snapshot is rewritten with any changes. A snapshot file written with another
+            distribution_dtype is discarded. Ignored with MongoDB. (Default: None)
 
-    def load_all(self, directory):
-        for filename in os.listdir(directory):
-            # Skip hidden and non-json files
-            if filename.startswith('.') or not filename.endswith('.json'):
+        Returns
+        -------
+        report : galcat.loader.LoadReport
+            Summary of the load with counts, timing and failures
+        """
+
+        report = LoadReport(directory)
+        start = time.perf_counter()
+
+        filenames = list_json_files(directory)
+        report.n_files = len(filenames)
+
+        if self.use_mongodb:
+            self.ensure_indexes()
+
+        if isinstance(snapshot, str) and not self.use_mongodb:
+            snapshot = Snapshot(snapshot, self._snapshot_options())
+        if snapshot is not None and not self.use_mongodb:
+            # Reuse already converted documents for the files that did not change
+            to_parse = []
+            for filename in filenames:
+                doc = snapshot.get_document(filename)
+                if doc is None:
+                    to_parse.append(filename)
+                else:
+                    self.db.upsert(doc)
+                    self.db.mark_persisted(doc.get(self.db.id_column, ''), filename)
+                    report.n_loaded += 1
+                    report.n_cached += 1
+            filenames = to_parse
+        else:
+            snapshot = None
+
+        batch = []
+        for filename, doc, error in iter_json_files(filenames, workers=workers, use_processes=use_processes):
+            if error is not None:
+                if raise_errors:
+                    raise RuntimeError('Failed to load {}: {}'.format(filename, error))
+                report.failures.append((filename, error))
                 continue
 
-            self.load_file_to_db(os.path.join(directory, filename))
+            batch.append((filename, doc))
+            if len(batch) >= batch_size:
+                self._load_batch(batch, report, raise_errors, snapshot)
+                batch = []
+        self._load_batch(batch, report, raise_errors, snapshot)
+
+        if snapshot is not None:
+            snapshot.save()
+
+        report.elapsed = time.perf_counter() - start
+        if not report.ok:
+            print(report.summary())
+
+        return report
+
+    def load_manifest(self, directory, manifest_file=MANIFEST_FILE):
+        """
+        Add the documents of a directory to a lazy database (Database(lazy=True)) without reading them.
+        Names are taken from a sidecar manifest in the directory, which is created or refreshed as needed,
+        so only new or changed files are opened.
+
+        Parameters
+        ----------
+        directory : str
+            Directory with JSON files. Hidden and non-json files are skipped.
+        manifest_file : str
+            Name of the sidecar manifest in the directory (Default: '.galcat_manifest.json')
+
+        Returns
+        -------
+        report : galcat.loader.LoadReport
+            Summary with the number of documents deferred to first access and any files that failed
+        """
+
+        if not isinstance(self.db, LazyDocumentStore):
+            raise RuntimeError('ERROR: load_manifest requires a database created with lazy=True')
+
+        report = LoadReport(directory)
+        start = time.perf_counter()
+        entries, report.failures = build_manifest(directory, id_column=self.db.id_column,
+                                                  manifest_file=manifest_file)
+        report.n_files = len(entries) + len(report.failures)
+        for name, filename, size in entries:
+            self.db.register(name, filename, size)
+        report.n_loaded = report.n_deferred = len(entries)
+
+        report.elapsed = time.perf_counter() - start
+        if not report.ok:
+            print(report.summary())
+        return report
+
+    def _read_document(self, filename):
+        # Parse and convert a single document file (used by the lazy store on first access)
+        with open(filename, 'r') as f:
+            return self._recursive_json_fix(json.load(f))
+
+    def load_documents(self, docs, batch_size=100, raise_errors=False):
+        """
+        Load documents that are already in memory (eg, built by galcat.ingest) to the database in batches.
+        Existing documents with the same name are replaced.
+
+        Parameters
+        ----------
+        docs : iterable
+            JSON-style documents (dicts with lists rather than arrays)
+        batch_size : int
+            Number of documents to insert at a time. With MongoDB each batch is one bulk write. (Default: 100)
+        raise_errors : bool
+            Flag to raise an exception at the first document that fails to load (Default: False)
+
+        Returns
+        -------
+        report : galcat.loader.LoadReport
+            Summary of the load; failures are listed by document name
+        """
+
+        report = LoadReport('<documents>')
+        start = time.perf_counter()
+        if self.use_mongodb:
+            self.ensure_indexes()
+
+        batch = []
+        for doc in docs:
+            report.n_files += 1
+            batch.append((None, doc))
+            if len(batch) >= batch_size:
+                self._load_batch(batch, report, raise_errors)
+                batch = []
+        self._load_batch(batch, report, raise_errors)
+
+        report.elapsed = time.perf_counter() - start
+        if not report.ok:
+            print(report.summary())
+        return report
+
+    def _load_batch(self, batch, report, raise_errors=False, snapshot=None):
+        # Insert a batch of parsed (filename, document) pairs, recording any failures in the report.
+        # The filename is None for documents that did not come from a file.
+        if self.use_mongodb:
+            self._load_batch_mongodb(batch, report, raise_errors)
+            return
+
+        for filename, doc in batch:
+            try:
+                self.load_file_to_db(doc)
+            except Exception as e:
+                if raise_errors:
+                    raise
+                report.failures.append((filename or doc.get('name'), '{}: {}'.format(type(e).__name__, e)))
+            else:
+                report.n_loaded += 1
+                if filename is not None:
+                    self.db.mark_persisted(doc.get(self.db.id_column, ''), filename)
+                if snapshot is not None:
+                    snapshot.set_document(filename, self.db.get(doc.get(self.db.id_column, '')))
+
+    def _load_batch_mongodb(self, batch, report, raise_errors=False):
+        # Send a batch of parsed (filename, document) pairs to MongoDB as one bulk write
+        filenames, docs = [], []
+        for filename, doc in batch:
+            filename = filename or doc.get('name')
+            if 'name' not in doc:
+                if raise_errors:
+                    raise RuntimeError('Failed to load {}: missing name'.format(filename))
+                report.failures.append((filename, 'KeyError: missing name'))
+                continue
+            filenames.append(filename)
+            docs.append(self._recursive_json_reverse_fix(doc))
+
+        if not docs:
+            return
+        self._version += 1
+        failures = self._bulk_replace(self.db, docs, id_column='name', batch_size=len(docs))
+        if failures and raise_errors:
+            i, message = failures[0]
+            raise RuntimeError('Failed to load {}: {}'.format(filenames[i], message))
+        for i, message in failures:
+            report.failures.append((filenames[i], message))
+        report.n_loaded += len(docs) - len(failures)
+
+    @staticmethod
+    def _bulk_replace(collection, docs, id_column, batch_size=1000):
+        """
+        Upsert documents into a MongoDB collection with unordered bulk writes of ReplaceOne operations.
+
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection
+            Collection to write to
+        docs : list
+            Documents to upsert
+        id_column : str
+            Name of field to use for matching
+        batch_size : int
+            Number of operations per bulk write (Default: 1000)
+
+        Returns
+        -------
+        failures : list
+            (position in docs, error message) for every document that could not be written
+        """
+
+        from pymongo import ReplaceOne
+        from pymongo.errors import BulkWriteError
+
+        failures = []
+        batch_size = max(1, batch_size)
+        for start in range(0, len(docs), batch_size):
+            batch = docs[start:start + batch_size]
+            # Unordered writes can be applied in any order, so only keep the last document for each ID
+            last = {}
+            for i, doc in enumerate(batch):
+                last[doc[id_column]] = i
+            positions = sorted(last.values())
+            requests = [ReplaceOne({id_column: batch[i][id_column]}, batch[i], upsert=True) for i in positions]
+            try:
+                collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    failures.append((start + positions[error['index']], error.get('errmsg', '')))
+        return failures
+
+    def ensure_indexes(self, id_column='name', ref_id_column='key'):
+        """
+        Create the unique MongoDB indexes on the document and reference ID columns that the upserts
+        match on. Creating an index that already exists does nothing. Only applies to MongoDB.
+
+        Parameters
+        ----------
+        id_column : str
+            Document ID column (Default: 'name')
+        ref_id_column : str
+            Reference ID column (Default: 'key')
+        """
+
+        if not self.use_mongodb:
+            return
+        self.db.create_index(id_column, unique=True)
+        self.references.create_index(ref_id_column, unique=True)
 
     def load_file_to_db(self, filename, id_column='name'):
         """
@@ -149,18 +704,20 @@ class Database(object):
         else:
             doc = filename
 
+        self._version += 1
         if self.use_mongodb:
             self.load_to_mongodb(doc, id_column=id_column)
         else:
             doc = self._recursive_json_fix(doc)
             # Check if already present and if so update, otherwise add as new
-            name = doc.get(id_column, '')
-            orig_doc = self.query_db({id_column: name})
-            if len(orig_doc) > 0 and orig_doc[0][id_column] == name:
-                ind = np.where(self.db == orig_doc[0])
-                self.db[ind] = doc
-            else:
-                self.db = np.append(self.db, doc)
+            if id_column != self.db.id_column:
+                # Matching on a field other than the primary key requires a scan
+                orig_doc = self.query_db({id_column: doc.get(id_column, '')})
+                if len(orig_doc) > 0:
+                    self.db.remove(orig_doc[0].get(self.db.id_column, ''))
+            self.db.upsert(doc)
+            if isinstance(filename, str):
+                self.db.mark_persisted(doc.get(self.db.id_column, ''), filename)
 
     def load_to_mongodb(self, doc, id_column='name'):
         # Load JSON file to MongoDB
@@ -175,9 +732,10 @@ class Database(object):
         # If none is matched, upsert=True creates a new document.
         result = self.db.replace_one(filter={id_column: id_value}, replacement=doc, upsert=True)
 
-    def update_references_mongodb(self, references_file, id_column='key'):
+    def update_references_mongodb(self, references_file, id_column='key', batch_size=1000):
         """
-        Method to load references from a provided file to the MongoDB database
+        Method to load references from a provided file to the MongoDB database.
+        References are upserted with unordered bulk writes.
 
         Parameters
         ----------
@@ -185,14 +743,21 @@ class Database(object):
             Name of references JSON file to load
         id_column : str
             Name of ID column to use to match against existing documents (default: key)
+        batch_size : int
+            Number of references per bulk write (Default: 1000)
         """
 
         with open(references_file, 'r') as f:
             references = json.load(f)
 
-        for doc in references:
-            id_value = doc[id_column]
-            result = self.references.replace_one(filter={id_column: id_value}, replacement=doc, upsert=True)
+        self._version += 1
+        self.references.create_index(id_column, unique=True)
+        failures = self._bulk_replace(self.references, references, id_column=id_column, batch_size=batch_size)
+        if failures:
+            msg = 'ERROR: Failed to load {} references: {}'.format(
+                len(failures), '; '.join(message for _, message in failures[:5]))
+            print(msg)
+            raise RuntimeError(msg)
 
     def _recursive_json_fix(self, doc):
         """
@@ -214,22 +779,21 @@ class Database(object):
 
         if isinstance(doc, list):
             # Handle lists by converting to numpy arrays
-            out_doc = np.array([])
-            for elem in doc:
-                if isinstance(elem, dict):
-                    elem = self._recursive_json_fix(elem)
-                out_doc = np.append(out_doc, elem)
+            out_doc = _list_to_array([self._recursive_json_fix(elem) if isinstance(elem, dict) else elem
+                                      for elem in doc])
         elif isinstance(doc, dict):
             # Handle dicts by recursively fixing
             for key, val in doc.items():
                 if isinstance(val, dict):
                     out_doc[key] = self._recursive_json_fix(val)
+                elif key == 'distribution' and isinstance(val, list) and self.distribution_dtype is not None:
+                    # Samples are stored as one contiguous array of the requested type
+                    try:
+                        out_doc[key] = np.asarray(val, dtype=self.distribution_dtype)
+                    except (TypeError, ValueError):
+                        out_doc[key] = _list_to_array(val)
                 elif isinstance(val, list):
-                    new_array = np.array([])
-                    for elem in val:
-                        new_val = self._recursive_json_fix(elem)
-                        new_array = np.append(new_array, new_val)
-                    out_doc[key] = new_array
+                    out_doc[key] = _list_to_array([self._recursive_json_fix(elem) for elem in val])
                 else:
                     out_doc[key] = val
         else:
@@ -270,12 +834,12 @@ class Database(object):
             for key, val in doc.items():
                 if isinstance(val, dict):
                     out_doc[key] = self._recursive_json_reverse_fix(val)
-                elif isinstance(val, type(np.array([]))):
-                    new_array = []
-                    for elem in val:
-                        new_val = self._recursive_json_reverse_fix(elem)
-                        new_array.append(new_val)
-                    out_doc[key] = new_array
+                elif isinstance(val, np.ndarray):
+                    if val.dtype == object:
+                        out_doc[key] = [self._recursive_json_reverse_fix(elem) for elem in val]
+                    else:
+                        # Plain numeric or string arrays convert directly
+                        out_doc[key] = val.tolist()
                 else:
                     out_doc[key] = val
         else:
@@ -283,9 +847,10 @@ class Database(object):
 
         return out_doc
 
-    def save_from_db(self, doc, verbose=False, out_dir='', save=True, name=''):
+    def save_from_db(self, doc, verbose=False, out_dir='', save=True, name='', modified_only=False):
         """
         Save a JSON representation of the document. Useful for exporting database contents.
+        Files are written atomically and are left untouched if their contents would not change.
 
         Parameters
         ----------
@@ -299,28 +864,96 @@ class Database(object):
             Flag to indicate if the JSON representation should be saved (Default: True)
         name : str
             Name of output JSON file. If none is provided, the 'name' field is used to name it. (Default: '')
+        modified_only : bool
+            Flag to skip documents that have not changed since they were last read from or written to
+            the output file (Default: False)
+
+        Returns
+        -------
+        filename : str or None
+            Name of the file written or None if nothing was written
         """
 
-        # Save a JSON representation
-        out_doc = self._recursive_json_reverse_fix(doc)
-        out_json = json.dumps(out_doc, indent=4, sort_keys=False)
-        if verbose:
-            print(out_json)
         if save:
             if not name:
                 name = doc['name']
                 name = name.strip().replace(' ', '_') + '.json'
             filename = os.path.join(out_dir, name)
+
+            # Changes are only tracked for documents held by the in-memory store
+            doc_name = doc.get('name', '')
+            tracked = not self.use_mongodb and self.db.get(doc_name) is doc
+            if modified_only and tracked and self.db.is_persisted(doc_name, filename):
+                return None
+
+        # Save a JSON representation
+        out_doc = self._recursive_json_reverse_fix(doc)
+        out_json = json.dumps(out_doc, indent=4, sort_keys=False)
+        if verbose:
+            print(out_json)
+        if not save:
+            return None
+
+        digest = text_digest(out_json)
+        written = None
+        if tracked and self.db.persisted_digest(doc_name, filename) == digest:
+            pass
+        elif file_digest(filename) == digest:
+            pass
+        else:
             print(filename)
-            with open(filename, 'w') as f:
-                f.write(out_json)
-        return
+            write_text_atomic(filename, out_json)
+            written = filename
+
+        if tracked:
+            self.db.mark_persisted(doc_name, filename, digest)
+        return written
+
+    def save_all(self, out_dir='', modified_only=False, workers=1):
+        """
+        Save the database to disk, one JSON file per document.
+
+        Parameters
+        ----------
+        out_dir : str
+            Directory to save JSON files (Default: '')
+        modified_only : bool
+            Flag to skip, without converting them, documents that were not replaced (eg, with add_data) since
+            they were loaded from or last saved to out_dir. Documents edited in place, such as query_db results,
+            are then not saved. Either way files whose contents would not change are never rewritten.
+            (Default: False)
+        workers : int
+            Number of threads used to write files (Default: 1)
+
+        Returns
+        -------
+        written : list
+            Names of the files that were written
+        """
+
+        if isinstance(self.db, LazyDocumentStore):
+            # Documents not in memory are unchanged since they were read from their file, so those read from
+            # out_dir are skipped without reading them
+            doc_list = self.db.names()
+
+            def save(name):
+                filename = os.path.join(out_dir, name.strip().replace(' ', '_') + '.json')
+                if self.db.is_persisted(name, filename) and (modified_only or not self.db.is_loaded(name)):
+                    return None
+                return self.save_from_db(self.db.get(name), out_dir=out_dir, save=True, modified_only=modified_only)
+        else:
+            doc_list = self.query_db({})
 
-    def save_all(self, out_dir=''):
-        # Save entire database to disk
-        doc_list = self.query_db({})
-        for doc in doc_list:
-            self.save_from_db(doc, out_dir=out_dir, save=True)
+            def save(doc):
+                return self.save_from_db(doc, out_dir=out_dir, save=True, modified_only=modified_only)
+
+        if workers is None or workers <= 1:
+            results = [save(doc) for doc in doc_list]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(save, doc_list))
+
+        return [filename for filename in results if filename is not None]
 
     def add_data(self, filename, force=False, id_column='name', auto_save=False, save_dir='data', update_value=False,
                  validate=True):
@@ -364,10 +997,11 @@ class Database(object):
             raise RuntimeError('JSON data is missing name information for field: {}'.format(id_column))
 
         # Get existing data that will be updated
-        old_doc = self.query_db({id_column: name})[0]
+        old_doc = self.query_db({id_column: name})
         if len(old_doc) == 0:
             print('{} does not exist in the database! Use load_file_to_db() to load new objects.'.format(name))
             return
+        old_doc = old_doc[0]
 
         # Loop through the new data, adding it all to old_doc
         for k, v in new_data.items():
@@ -397,12 +1031,11 @@ class Database(object):
                     old_doc[k] = np.append(old_doc[k], [v[i]])
 
         # Replace document in the database
+        self._version += 1
         if self.use_mongodb:
             self.load_to_mongodb(old_doc)
         else:
-            orig_doc = self.query_db({id_column: name})[0]
-            ind = np.where(self.db == orig_doc)
-            self.db[ind] = old_doc
+            self.db.upsert(old_doc)
 
         if not auto_save:
             print('Data for {} has been updated. Consider running save_all() to update JSON on disk.'.format(name))
@@ -410,7 +1043,91 @@ class Database(object):
             print('Auto-saving to {}'.format(save_dir))
             self.save_from_db(old_doc, out_dir=save_dir)
 
-    def query_db(self, query, embed_ref=False, ref_id_column='key'):
+    def create_index(self, path):
+        """
+        Create an index on an embedded field so that equality and $gt/$gte/$lt/$lte queries against it
+        are resolved by bisection rather than by scanning every document. The index is kept up to date
+        as documents are loaded or updated. With MongoDB the index is created on the collection instead.
+        Example:
+            db.create_index('surface_brightness.value')
+
+        Parameters
+        ----------
+        path : str
+            Dotted path to index, eg: 'surface_brightness.value' or 'surface_brightness.error_upper'
+        """
+
+        # Both the in-memory store and a MongoDB collection provide create_index
+        self.db.create_index(path)
+
+    def _spatial_index(self):
+        # The in-memory store maintains the index as documents change; for MongoDB it is rebuilt from
+        # the coordinates whenever data has been changed through this object
+        if not self.use_mongodb:
+            return self.db.create_spatial_index()
+
+        version, index = self._mongo_spatial_index
+        if index is None or version != self.version:
+            index = SpatialIndex()
+            for doc in self.query_db({}, projection=['ra', 'dec']):
+                index.add(doc['name'], doc)
+            self._mongo_spatial_index = (self.version, index)
+        return index
+
+    def cone_search(self, coord, radius, embed_ref=False):
+        """
+        Find the galaxies within a radius of a position, using the best ra/dec of each galaxy.
+        Example:
+            db.cone_search(SkyCoord.from_name('M31'), 10 * u.deg)
+
+        Parameters
+        ----------
+        coord : astropy.coordinates.SkyCoord
+            Center of the search
+        radius : astropy.units.Quantity
+            Search radius
+        embed_ref : bool
+            Flag whether or not references should be embedded in the output documents (Default: False)
+
+        Returns
+        -------
+        result : np.array
+            Numpy array of documents, nearest first
+        """
+
+        names, separations = self._spatial_index().cone_search(coord, radius)
+        if self.use_mongodb:
+            docs = {doc['name']: doc for doc in self.query_db({'name': {'$in': list(names)}})}
+        else:
+            docs = self.db
+        out_result = np.empty(len(names), dtype=object)
+        for i, name in enumerate(names):
+            out_result[i] = docs[name]
+
+        if embed_ref:
+            out_result = self._embed_references(out_result)
+        return out_result
+
+    def crossmatch(self, catalog, max_sep):
+        """
+        Match the sources of an external catalog to the nearest galaxy within max_sep.
+
+        Parameters
+        ----------
+        catalog : astropy.coordinates.SkyCoord
+            Array of source positions
+        max_sep : astropy.units.Quantity
+            Maximum separation of a match
+
+        Returns
+        -------
+        matches : astropy.table.Table
+            One row per matched source with the columns catalog_index, name and separation
+        """
+
+        return self._spatial_index().crossmatch(catalog, max_sep)
+
+    def query_db(self, query, embed_ref=False, ref_id_column='key', engine='manual', projection=None):
         """
         Perform a database query with MongoDB's query language.
         Examples:
@@ -433,6 +1150,14 @@ class Database(object):
             Flag whether or not references should be embedded in the output document (Default: False)
         ref_id_column : str
             Field name to use when matching references (Default: 'key')
+        engine : str
+            Execution path for the in-memory database. 'manual' evaluates the query document by document,
+            'columnar' compiles it to vectorized masks over a columnar projection of all measurements
+            (falls back to 'manual' for queries it cannot compile, and always with a lazy memory_budget since
+            the projection would keep every document in memory). Ignored with MongoDB. (Default: 'manual')
+        projection : list or dict
+            Fields to return, as a list of field or field.subfield paths or a MongoDB inclusion projection.
+            The name is always included. With MongoDB only these fields are transferred. (Default: None, all fields)
 
         Returns
         -------
@@ -440,30 +1165,135 @@ class Database(object):
             Numpy array of document results
         """
 
+        if projection is not None:
+            projection = _projection_paths(projection)
+
         if self.use_mongodb:
-            result = self._query_mongodb(query)
+            result = self._query_mongodb(query, projection)
         else:
-            result = self._query_manual(query)
+            if engine == 'columnar':
+                result = self._query_columnar(query)
+            else:
+                result = self._query_manual(query)
+            if projection is not None:
+                out_result = np.empty(len(result), dtype=object)
+                for i, doc in enumerate(result):
+                    out_result[i] = _project_document(doc, projection)
+                result = out_result
 
         # Embed the reference dict in place of the key
         if embed_ref:
-            result = deepcopy(result)
-            for doc in result:
-                for key, value in doc.items():
-                    if not isinstance(value, (list, np.ndarray)):
-                        continue
-                    for i, each_val in enumerate(value):
-                        ref_key = each_val.get('reference')
-                        if ref_key:
-                            ref = self.query_reference({ref_id_column: ref_key})
-                            if isinstance(ref, (list, np.ndarray)) and len(ref) > 0:
-                                doc[key][i]['reference'] = ref[0]
+            result = self._embed_references(result, ref_id_column=ref_id_column)
 
         return result
 
+    def _embed_references(self, docs, ref_id_column='key'):
+        """
+        Return new documents with the reference dict in place of each reference key.
+        Each distinct key is resolved once. Only the measurements that get a reference are copied
+        (shallowly); everything else, including the reference dicts themselves, is shared with the
+        database and should be treated as read-only.
+
+        Parameters
+        ----------
+        docs : np.array
+            Documents to embed references in
+        ref_id_column : str
+            Field name to use when matching references (Default: 'key')
+
+        Returns
+        -------
+        result : np.array
+            Numpy array of new documents
+        """
+
+        resolved = {}
+        out_result = np.empty(len(docs), dtype=object)
+        for i, doc in enumerate(docs):
+            out_doc = {}
+            for key, value in doc.items():
+                if not isinstance(value, (list, np.ndarray)):
+                    out_doc[key] = value
+                    continue
+
+                new_value = None
+                for j, each_val in enumerate(value):
+                    if not isinstance(each_val, dict):
+                        continue
+                    ref_key = each_val.get('reference')
+                    if not ref_key or not HashIndex.can_lookup(ref_key):
+                        continue
+                    if ref_key not in resolved:
+                        ref = self.query_reference({ref_id_column: ref_key})
+                        resolved[ref_key] = ref[0] if len(ref) > 0 else None
+                    if resolved[ref_key] is None:
+                        continue
+
+                    if new_value is None:
+                        # Copy the container only, not the measurements
+                        new_value = value.copy() if isinstance(value, np.ndarray) else list(value)
+                    new_value[j] = dict(each_val, reference=resolved[ref_key])
+                out_doc[key] = value if new_value is None else new_value
+            out_result[i] = out_doc
+
+        return out_result
+
     def query(self, *args, **kwargs):
         return self.query_db(*args, **kwargs)
 
+    def iter_query(self, query, projection=None, batch_size=1000, embed_ref=False, ref_id_column='key'):
+        """
+        Iterate over the results of a query without building the full result array first.
+        With MongoDB the cursor fetches batch_size documents per round trip and each batch is converted
+        as it is consumed.
+
+        Parameters
+        ----------
+        query : dict
+            Query to perform. Uses MongoDB's query language.
+        projection : list or dict
+            Fields to return, see query_db (Default: None, all fields)
+        batch_size : int
+            Number of documents fetched and converted at a time (Default: 1000)
+        embed_ref : bool
+            Flag whether or not references should be embedded in the output documents (Default: False)
+        ref_id_column : str
+            Field name to use when matching references (Default: 'key')
+
+        Yields
+        ------
+        doc : dict
+            Document result
+        """
+
+        if self.use_mongodb:
+            if projection is not None:
+                projection = {path: 1 for path in _projection_paths(projection)}
+            cursor = self.db.find(query, projection).batch_size(batch_size)
+            batch = []
+            for doc in cursor:
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    yield from self._convert_batch(batch, embed_ref, ref_id_column)
+                    batch = []
+            yield from self._convert_batch(batch, embed_ref, ref_id_column)
+        else:
+            result = self.query_db(query, projection=projection)
+            for start in range(0, len(result), batch_size):
+                batch = result[start:start + batch_size]
+                if embed_ref:
+                    batch = self._embed_references(batch, ref_id_column=ref_id_column)
+                yield from batch
+
+    def _convert_batch(self, batch, embed_ref=False, ref_id_column='key'):
+        # Convert a batch of MongoDB documents to the in-memory format
+        out_result = np.empty(len(batch), dtype=object)
+        for i, doc in enumerate(batch):
+            out_result[i] = self._recursive_json_fix(doc)
+        if embed_ref:
+            out_result = self._embed_references(out_result, ref_id_column=ref_id_column)
+        return out_result
+
     def query_reference(self, query):
         """
         Query references. Examples:
@@ -486,105 +1316,77 @@ class Database(object):
             for r in result:
                 # Remove the internal MongoDB IDs
                 del r['_id']
+        elif len(query) == 1 and list(query.keys())[0] in self.reference_indexes \
+                and HashIndex.can_lookup(list(query.values())[0]):
+            # Single equality lookups go through the hash index
+            key, value = list(query.items())[0]
+            matched = self.reference_indexes[key].get(value)
+            result = np.empty(len(matched), dtype=object)
+            for i, ref in enumerate(matched):
+                result[i] = ref
         else:
-            result = self.references
-            for key, value in query.items():
-                # Use things like dec.value to query [value] for each element in [dec]
-                key_list = key.split('.')
-                if not key_list[0].startswith('$'):
-                    result = self._sub_query(result, key_list[0])
-                    if len(result) >= 1:
-                        result = self._sub_query(result, key_list, value)
-                else:
-                    result = self._sub_query(result, key_list, value)
+            result = compile_query(query).filter(self.references)
 
         return result
 
-    def _query_mongodb(self, query):
-        # Send query to MondoDB
-
-        cursor = self.db.find(query)
+    def _query_mongodb(self, query, projection=None):
+        # Send query to MondoDB, only requesting the projected fields if a list of paths is provided
+        if projection is not None:
+            projection = {path: 1 for path in projection}
+        cursor = self.db.find(query, projection)
         out_result = np.array([self._recursive_json_fix(d) for d in cursor])
 
         return out_result
 
-    def _query_manual(self, query):
-        # Manually execute query to in-memory database
-        out_result = self.db
-        for key, value in query.items():
-            # Use strings like dec.value to query [value] for each element in [dec]
-            key_list = key.split('.')
-            if not key_list[0].startswith('$'):
-                out_result = self._sub_query(out_result, key_list[0])
-                if len(out_result) >= 1:
-                    # important to be >= 1 otherwise it just behaves like an $exist
-                    out_result = self._sub_query(out_result, key_list, value)
-            else:
-                out_result = self._sub_query(out_result, key_list, value)
+    def _query_columnar(self, query):
+        # Execute query as vectorized masks over the columnar projection of the in-memory database
+        if isinstance(self.db, LazyDocumentStore) and self.db.memory_budget is not None:
+            # The projection holds every document, which would defeat the memory budget
+            return self._query_manual(query)
+        try:
+            return self.columns.query(query)
+        except UnsupportedQuery:
+            return self._query_manual(query)
 
-        return out_result
+    def _query_manual(self, query):
+        # Manually execute query to in-memory database with a (cached) query plan
+        return self._query_plan(query).execute(self.db)
+
+    def _query_plan(self, query):
+        # Plans depend on the indexes available, so the index paths are part of the cache key
+        plan_key = canonical_key(query, sorted(self.db.indexes))
+        plan = self.plan_cache.get(plan_key)
+        if plan is None:
+            plan = QueryPlan(query, self.db)
+            self.plan_cache.put(plan_key, plan)
+        return plan
+
+    def explain(self, query):
+        """
+        Show how a query would be executed, without running it. For the in-memory database this reports
+        whether it is answered by the primary key, a secondary index or a scan, along with estimated costs.
+        With MongoDB the server's explain output is returned.
+        Example:
+            db.explain({'name': 'And XXX'})
 
-    def _sub_query(self, doc_list, key, value=None):
-        # Method to perform query, called by _query_manual
+        Parameters
+        ----------
+        query : dict
+            Query in MongoDB query language
 
-        special_operator = False
-        if isinstance(key, list) and key[0].startswith('$'):
-            # Handle cases that start with $ like $or statements
-            special_operator = True
+        Returns
+        -------
+        explanation : dict
+            See galcat.query.QueryPlan.explain
+        """
 
-        if value is None:
-            # Basically check if this key exists
-            out_result = np.array(list(filter(lambda new_doc: key in new_doc, doc_list)))
-        else:
-            if (isinstance(key, list) and len(key) > 1) or special_operator:
-                ind_list = []
-                for i, elem in enumerate(doc_list):
-                    if isinstance(value, dict) or isinstance(value, list):
-                        # Special operator
-                        if isinstance(value, list):
-                            # Handle cases with $or
-                            db_operator = key[0]
-                            sub_value = value
-                        else:
-                            db_operator, sub_value = list(value.items())[0]
-                        if db_operator == '$gt':
-                            temp_list = list(filter(lambda y: y.get(key[1]) > sub_value, elem[key[0]]))
-                        elif db_operator == '$gte':
-                            temp_list = list(filter(lambda y: y.get(key[1]) >= sub_value, elem[key[0]]))
-                        elif db_operator == '$lt':
-                            temp_list = list(filter(lambda y: y.get(key[1]) < sub_value, elem[key[0]]))
-                        elif db_operator == '$lte':
-                            temp_list = list(filter(lambda y: y.get(key[1]) <= sub_value, elem[key[0]]))
-                        elif db_operator == '$exists':
-                            raise RuntimeError('Use of $exists has been rolled back and '
-                                               'only works with the MongoDB implementation.')
-                            # if sub_value:
-                            #     temp_list = list(filter(lambda y: key[1] in y, elem[key[0]]))
-                            # else:
-                            #     temp_list = list(filter(lambda y: key[1] not in y, elem[key[0]]))
-                        elif db_operator == '$or':
-                            # Special logic for $or (run each sub_query in the or list against the current element)
-                            temp_list = []
-                            for sub_sub_query in sub_value:
-                                for k, v in sub_sub_query.items():
-                                    # Use things like dec.value to query [value] for each element in [dec]
-                                    key_list = k.split('.')
-                                    temp = self._sub_query(np.array([elem]), key_list[0])
-                                    if len(temp) > 0:
-                                        temp = self._sub_query(temp, key_list, v)
-                                    temp_list += list(temp)
-                        else:
-                            raise RuntimeError('ERROR: {} not yet supported'.format(db_operator))
-                    else:
-                        temp_list = list(filter(lambda y: y.get(key[1]) == value, elem[key[0]]))
-                    if len(temp_list) > 0:
-                        ind_list.append(i)
-                out_result = doc_list[ind_list]
-            else:
-                # Straight-forward check, for things that are not embedded (eg, name)
-                out_result = np.array(list(filter(lambda doc: doc[key[0]] == value, doc_list)))
+        if self.use_mongodb:
+            return self.db.find(query).explain()
 
-        return out_result
+        cached = canonical_key(query, sorted(self.db.indexes)) in self.plan_cache
+        explanation = self._query_plan(query).explain(self.db)
+        explanation['cached'] = cached
+        return explanation
 
     @staticmethod
     def _store_quantity(val, unit):
@@ -601,12 +1403,12 @@ class Database(object):
     def generate_curation(self, reference, existing_curation={}):
         """
         Generate a curation dictionary for use in query_table or that can be exported.
-        This will loop over all parameters saving only those parameters that contain the reference.
+        This saves only those parameters that contain the reference, using the reference index kept by the database.
 
         Parameters
         ----------
         reference : str or list
-            Reference to use in the curation. If a list, this will recursive build the curation assuming a sorted order
+            Reference to use in the curation. If a list, references earlier in the list take priority
         existing_curation : dict
             Existing curation to append new values to (appended values will overwrite existing ones)
 
@@ -618,22 +1420,35 @@ class Database(object):
         curation = existing_curation.copy()
 
         if isinstance(reference, (list, np.ndarray)):
-            reverse_list = reference[::-1]
-            for ref in reverse_list:
-                curation = self.generate_curation(ref, existing_curation=curation)
+            reference_list = list(reference)
         else:
+            reference_list = [reference]
+
+        # Fields that have measurements from each reference
+        if self.use_mongodb:
+            reference_fields = {ref: set() for ref in reference_list if HashIndex.can_lookup(ref)}
             for doc in self.query_db(query={}):
                 for k, v_list in doc.items():
                     if not isinstance(v_list, (list, np.ndarray)):
                         continue
                     for v in v_list:
-                        if v.get('reference') == reference:
-                            curation[k] = reference
+                        ref = v.get('reference') if isinstance(v, dict) else None
+                        if HashIndex.can_lookup(ref) and ref in reference_fields:
+                            reference_fields[ref].add(k)
+        else:
+            reference_fields = {ref: self.db.reference_index.fields(ref).keys() for ref in reference_list
+                                if HashIndex.can_lookup(ref)}
+
+        # References earlier in the list take priority, so apply them last
+        for ref in reference_list[::-1]:
+            for k in reference_fields.get(ref, []):
+                curation[k] = ref
 
         return curation
 
     def query_table(self, query={}, curation={}, selection={}, reorder_columns_rowidx=0,
-                          add_coordinates=True, use_qtable=True):
+                          add_coordinates=True, use_qtable=True, copy=True, columns=None, server_side=False,
+                          distribution_summary='mean'):
         """
         Get a formatted table of all query results. When multiple results are present for a single value, the best one
         is picked unless the user specifies a selection. This functionality will be revisited in the future.
@@ -657,6 +1472,19 @@ class Database(object):
             exception if this fails, otherwise a warning is generated.
         use_qtable : bool
             If True, the result is a QTable, otherwise, a Table
+        copy : bool
+            Results are cached (see table_cache_size) and a copy of the cached table is returned, so it can be
+            modified safely. Set to False to get the cached table itself, which must then not be modified,
+            to skip the copy. (Default: True)
+        columns : list
+            Fields to include in the table. The name is always included, as are ra and dec when add_coordinates
+            is set. With MongoDB only these fields are requested from the server. (Default: None, all fields)
+        server_side : bool
+            With MongoDB, select the measurements on the server with an aggregation pipeline so that only one
+            value per field and galaxy is transferred. Ignored for the in-memory database and for median
+            distribution summaries. (Default: False)
+        distribution_summary : str
+            Value used for measurements given as a distribution: 'mean' or 'median' of the samples (Default: 'mean')
 
         Returns
         -------
@@ -664,8 +1492,6 @@ class Database(object):
             Astropy QTable of results
         """
 
-        results = self.query_db(query=query)
-
         # Load curation file (JSON of best values to use)
         curation_dict = _read_curation(curation)
 
@@ -673,46 +1499,55 @@ class Database(object):
         if selection:
             curation_dict.update(selection)
 
-        # For each entry in result, select best field.value or what the user has specified
-        tab_data = []
-        for entry in results:
-            out_row = {}
-            for key, val in entry.items():
-                if not isinstance(val, (list, type(np.array([])))):
-                    out_row[key] = val
-                else:
-                    # Select best one to return
-                    if len(val) > 1:
-                        if key in curation_dict.keys():
-                            # If selection listed a key, use the reference information there
-                            ind = np.array([x['reference'] for x in val]) == curation_dict[key]
-                        else:
-                            ind = np.array([x.get('best', 0) for x in val]) == 1
-
-                        # Only proceed if you have any results to consider
-                        if len(val[ind]) > 0:
-                            unit = val[ind][0].get('unit')
-                            if val[ind][0].get('distribution') is not None:
-                                temp_dic = _get_values_from_distribution(val[ind][0].get('distribution'))
-                                temp_val = temp_dic['value']
-                            else:
-                                temp_val = val[ind][0]['value']
-                            out_row[key] = self._store_quantity(temp_val, unit)
-                    else:
-                        unit = val[0].get('unit')
-                        if val[0].get('distribution') is not None:
-                            temp_dic = _get_values_from_distribution(val[0].get('distribution'))
-                            temp_val = temp_dic['value']
-                        else:
-                            temp_val = val[0]['value']
-                        out_row[key] = self._store_quantity(temp_val, unit)
+        # Reuse the cached table unless the database has changed since it was built
+        if self._table_cache_version != self.version:
+            self.table_cache.clear()
+            self._table_cache_version = self.version
+        if columns is not None:
+            columns = _projection_paths(list(columns) + ['ra', 'dec'] if add_coordinates else columns)
+        if distribution_summary not in STATISTICS:
+            raise RuntimeError('ERROR: distribution_summary must be one of {}'.format(STATISTICS))
+        server_side = bool(server_side and self.use_mongodb and distribution_summary == 'mean')
+        cache_key = canonical_key(query, curation_dict, reorder_columns_rowidx, add_coordinates, use_qtable, columns,
+                                  server_side, distribution_summary)
+        tab = self.table_cache.get(cache_key)
+        if tab is None:
+            tab = self._query_table(query, curation_dict, reorder_columns_rowidx, add_coordinates, use_qtable,
+                                    columns, server_side, distribution_summary)
+            self.table_cache.put(cache_key, tab)
+
+        return tab.copy() if copy else tab
+
+    def _query_table(self, query, curation_dict, reorder_columns_rowidx, add_coordinates, use_qtable,
+                     fields=None, server_side=False, distribution_summary='mean'):
+        # Build the table for query_table
+        if server_side:
+            # Measurements are selected by the server, leaving a single measurement per field
+            cursor = self.db.aggregate(_table_pipeline(query, curation_dict, fields))
+            results = np.array([self._recursive_json_fix(d) for d in cursor])
+            curation_dict = {}
+        elif self.use_mongodb and fields is not None:
+            results = self.query_db(query=query, projection=fields)
+        else:
+            # The in-memory documents are not copied; unwanted fields are skipped when building the columns
+            results = self.query_db(query=query)
 
-            tab_data.append(out_row)
+        # For each entry in result, select best field.value or what the user has specified
+        columns, row_keys = self._table_columns(results, curation_dict, fields, distribution_summary)
 
         if use_qtable:
-            tab = QTable(tab_data)
+            tab = QTable(columns[0]) if len(results) > 0 else QTable([])
         else:
-            tab = Table(tab_data)
+            tab = Table(columns[0]) if len(results) > 0 else Table([])
+
+        # Mask entries for documents that do not have a column, as astropy does for rows with missing keys
+        for name, indexes in columns[1].items():
+            col = tab[name]
+            if isinstance(col, Column) and not isinstance(col, MaskedColumn):
+                tab[name] = MaskedColumn(col, copy=False)
+            elif isinstance(col, Quantity) and not isinstance(col, Masked):
+                tab[name] = Masked(col)
+            tab[name][indexes] = np.ma.masked
 
         if add_coordinates:
             if 'coord' in tab.colnames:
@@ -730,16 +1565,146 @@ class Database(object):
                 else:
                     tab['coord'] = coo
 
-        if reorder_columns_rowidx is None and len(tab_data) > 0:
+        if reorder_columns_rowidx is None and len(results) > 0:
             return tab
-        elif len(tab_data) == 0:
+        elif len(results) == 0:
             return tab
         else:
-            reorder_row_colnames = list(tab_data[reorder_columns_rowidx].keys())
+            reorder_row_colnames = row_keys(reorder_columns_rowidx)
             for colname in tab.colnames:
                 if colname not in reorder_row_colnames:
                     reorder_row_colnames.append(colname)
             return tab[reorder_row_colnames]
 
+    def _table_columns(self, results, curation_dict, fields=None, distribution_summary='mean'):
+        """
+        Build the columns for query_table, one array per field rather than one dict per row.
+        For each field the measurement is selected per document with FieldColumns.select and the values
+        of a column sharing a single unit are stored as one Quantity.
+
+        Parameters
+        ----------
+        results : np.array
+            Documents to tabulate
+        curation_dict : dict
+            Dictionary of field and reference to use for it (otherwise will pick best=1)
+        fields : list
+            Fields to include (Default: None, all fields)
+        distribution_summary : str
+            'mean' or 'median' of distributions (Default: 'mean')
+
+        Returns
+        -------
+        columns : tuple
+            (dict of column name -> column data, dict of column name -> indexes of documents without that column)
+        row_keys : function
+            Function returning the column names of a given row, in document order
+        """
+
+        n_docs = len(results)
+        use_projection = not self.use_mongodb and self.db.is_full_array(results)
+
+        # All keys in order of first appearance, noting which hold plain (non-array) values
+        all_keys, scalar_keys = self.columns.keys() if use_projection else document_keys(results)
+        if fields is not None:
+            all_keys = {key: None for key in all_keys if key in fields}
+
+        present = {}
+        data = {}
+        for key in all_keys:
+            if key in scalar_keys:
+                key_present = np.zeros(n_docs, dtype=bool)
+                values = [None] * n_docs
+                for i, doc in enumerate(results):
+                    val = doc.get(key, _MISSING)
+                    if val is not _MISSING and not isinstance(val, (list, np.ndarray)):
+                        key_present[i] = True
+                        values[i] = val
+            else:
+                key_present, values = None, None
+
+            field_columns = self.columns.field(key) if use_projection else FieldColumns(key, results)
+            rows = field_columns.select(curation_dict[key] if key in curation_dict else None)
+            if key_present is None:
+                key_present = rows >= 0
+                column = self._measurement_column(field_columns, rows[key_present], distribution_summary)
+            else:
+                # Plain values and measurements for the same key: fill in the measurements one by one
+                for i in np.where(rows >= 0)[0]:
+                    key_present[i] = True
+                    values[i] = self._measurement_column(field_columns, rows[i:i + 1], distribution_summary)[0]
+                column = [values[i] for i in np.where(key_present)[0]]
+
+            if key_present.any():
+                present[key] = key_present
+                data[key] = column
+
+        # Column order matches what astropy would infer from a list of row dicts
+        first_row = {key: int(np.argmax(mask)) for key, mask in present.items()}
+        names = sorted(present.keys(),
+                       key=lambda k: (first_row[k], list(results[first_row[k]].keys()).index(k)))
+
+        out_columns = {}
+        missing_indexes = {}
+        for name in names:
+            mask, column = present[name], data[name]
+            if mask.all():
+                out_columns[name] = column
+                continue
+
+            # Fill the missing entries with the first value so they can be masked once the table is built
+            missing_indexes[name] = list(np.where(~mask)[0])
+            if isinstance(column, Quantity):
+                full = np.full(n_docs, column.value[0])
+                full[mask] = column.value
+                out_columns[name] = Quantity(full, unit=column.unit)
+            else:
+                full = [column[0]] * n_docs
+                for i, val in zip(np.where(mask)[0], column):
+                    full[i] = val
+                out_columns[name] = full
+
+        def row_keys(row):
+            return [key for key in results[row].keys() if key in present and present[key][row]]
+
+        return (out_columns, missing_indexes), row_keys
+
+    def _measurement_column(self, field_columns, rows, distribution_summary='mean'):
+        """
+        Values of the selected measurements with units attached. When all measurements share one valid unit
+        a single Quantity is returned, otherwise a list of values (Quantity where a unit is given).
+        Distributions are summarized together in one batch (and cached per measurement).
+        """
+
+        measurements = field_columns.measurements
+        has_distribution = field_columns.present('distribution')[rows]
+        if has_distribution.any():
+            values = [measurements[r].get('value') for r in rows]
+            distribution_rows = np.where(has_distribution)[0]
+            summary = self.distribution_cache.summarize(
+                [measurements[rows[i]]['distribution'] for i in distribution_rows], distribution_summary)
+            for i, value in zip(distribution_rows, summary['value']):
+                values[i] = value
+            all_numeric = all(isinstance(v, numbers.Real) for v in values)
+        else:
+            values = None
+            all_numeric = bool(field_columns.is_numeric('value')[rows].all())
+
+        units = set(field_columns.objects('unit')[rows].tolist())
+        unit = units.pop() if len(units) == 1 else _MISSING
+        parsed_unit = _parse_unit(unit) if unit and unit is not _MISSING else None
+        if parsed_unit is not None and all_numeric:
+            # Without distributions the numeric column already holds the values as floats
+            values = field_columns.numeric('value')[rows] if values is None else np.array(values, dtype=float)
+            return Quantity(values, unit=parsed_unit, copy=False)
+
+        if values is None:
+            values = [measurements[r]['value'] for r in rows]
+        if not unit:
+            return values
+
+        # Mixed or unrecognized units
+        return [self._store_quantity(val, measurements[r].get('unit')) for val, r in zip(values, rows)]
+
     def table(self, *args, **kwargs):
         return self.query_table(*args, **kwargs)
@@ -0,0 +1,151 @@
+# Vectorized summaries of measurement distributions (posterior samples)
+import weakref
+import numpy as np
+
+__all__ = ['summarize_distributions', 'DistributionCache', 'STATISTICS']
+
+STATISTICS = ('mean', 'median')
+
+
+def _flatten(distributions, dtype=float):
+    # Concatenate 1D sample arrays into one flat array with the number of samples of each
+    arrays = []
+    for distribution in distributions:
+        try:
+            samples = np.asarray(distribution, dtype=dtype)
+        except (TypeError, ValueError):
+            samples = np.array([np.nan], dtype=dtype)
+        if samples.ndim != 1:
+            samples = np.array([np.nan], dtype=dtype)
+        arrays.append(samples)
+    counts = np.fromiter(map(len, arrays), dtype=int, count=len(arrays))
+    flat = np.concatenate(arrays) if arrays else np.array([], dtype=dtype)
+    return flat, counts
+
+
+def summarize_distributions(distributions, statistic='mean', dtype=float):
+    """
+    Summarize many distributions at once. The samples are concatenated into one contiguous array and
+    reduced per distribution with NumPy, rather than wrapping each distribution in astropy.uncertainty.
+
+    Parameters
+    ----------
+    distributions : list
+        1D sample arrays or lists, one per measurement
+    statistic : str
+        'mean' for the mean and standard deviation (as Distribution.pdf_mean/pdf_std) or 'median' for
+        the median with the 16th and 84th percentiles (Default: 'mean')
+    dtype : numpy dtype
+        Type the samples are converted to, eg: np.float32 (Default: float). Sums are accumulated in float64.
+
+    Returns
+    -------
+    summary : dict
+        Arrays with one entry per distribution: 'value' and 'error' for the mean, 'value', 'error_lower' and
+        'error_upper' (distance of the 16th and 84th percentiles from the median) for the median.
+        Empty or non-numeric distributions give NaN.
+    """
+
+    if statistic not in STATISTICS:
+        raise RuntimeError('ERROR: Unknown distribution summary {}, use one of {}'.format(statistic, STATISTICS))
+
+    flat, counts = _flatten(distributions, dtype)
+    n = len(counts)
+    filled = counts > 0
+    offsets = np.cumsum(counts) - counts
+    segment_offsets = offsets[filled]
+    segment_counts = counts[filled]
+
+    if statistic == 'mean':
+        mean = np.full(n, np.nan)
+        std = np.full(n, np.nan)
+        if len(flat) > 0:
+            sums = np.add.reduceat(flat, segment_offsets, dtype=np.float64)
+            mean[filled] = sums / segment_counts
+            deviations = flat - np.repeat(mean[filled], segment_counts)
+            squares = np.add.reduceat(deviations * deviations, segment_offsets, dtype=np.float64)
+            std[filled] = np.sqrt(squares / segment_counts)
+        return {'value': mean, 'error': std}
+
+    median = np.full(n, np.nan)
+    lower = np.full(n, np.nan)
+    upper = np.full(n, np.nan)
+    # Distributions with the same number of samples are gathered into a 2D block and reduced together
+    for length in np.unique(segment_counts):
+        which = np.where(counts == length)[0]
+        block = flat[offsets[which][:, None] + np.arange(length)].astype(np.float64)
+        lower[which], median[which], upper[which] = np.percentile(block, [16, 50, 84], axis=1)
+    return {'value': median, 'error_lower': median - lower, 'error_upper': upper - median}
+
+
+class DistributionCache(object):
+    def __init__(self, dtype=float):
+        """
+        Cache of distribution summaries per measurement, so repeated table builds do not recompute them.
+        Entries are keyed on the identity of the sample array and dropped when the array is garbage collected.
+        Distributions that are not numpy arrays (eg, plain lists) are summarized but not cached.
+
+        Parameters
+        ----------
+        dtype : numpy dtype
+            Type the samples are summarized in (Default: float)
+        """
+
+        self.dtype = dtype
+        self._entries = {}  # (id(array), statistic) -> (weakref to array, summary tuple)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _get(self, distribution, statistic):
+        entry = self._entries.get((id(distribution), statistic))
+        if entry is not None and entry[0]() is distribution:
+            return entry[1]
+        return None
+
+    def _put(self, distribution, statistic, summary):
+        if not isinstance(distribution, np.ndarray):
+            return
+        key = (id(distribution), statistic)
+        entries = self._entries
+
+        def _drop(ref):
+            if key in entries and entries[key][0] is ref:
+                del entries[key]
+
+        entries[key] = (weakref.ref(distribution, _drop), summary)
+
+    def summarize(self, distributions, statistic='mean'):
+        """
+        Summarize distributions as summarize_distributions does, only computing those not already cached.
+
+        Parameters
+        ----------
+        distributions : list
+            Sample arrays, one per measurement
+        statistic : str
+            'mean' or 'median' (Default: 'mean')
+
+        Returns
+        -------
+        summary : dict
+            See summarize_distributions
+        """
+
+        summaries = [self._get(d, statistic) for d in distributions]
+        missing = [i for i, s in enumerate(summaries) if s is None]
+        if missing:
+            computed = summarize_distributions([distributions[i] for i in missing], statistic, self.dtype)
+            names = list(computed.keys())
+            for j, i in enumerate(missing):
+                summaries[i] = tuple(computed[name][j] for name in names)
+                self._put(distributions[i], statistic, summaries[i])
+
+        names = ['value', 'error'] if statistic == 'mean' else ['value', 'error_lower', 'error_upper']
+        out_summary = {}
+        for k, name in enumerate(names):
+            out_summary[name] = np.array([s[k] for s in summaries], dtype=float)
+        return out_summary
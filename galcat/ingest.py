@@ -0,0 +1,358 @@
+# Ingest of the fixed-width NearbyGalaxies.dat table (McConnachie 2012, updated)
+import os
+import json
+import numpy as np
+import pandas as pd
+from .loader import text_digest, file_digest, write_text_atomic
+
+__all__ = ['COLUMN_SPECS', 'MEASUREMENT_SPECS', 'SENTINELS', 'HEADER_LINES', 'ChangeLog',
+           'read_nearby_galaxies', 'build_documents', 'ingest_nearby_galaxies', 'sync_nearby_galaxies']
+
+HEADER_LINES = 37  # lines before the first galaxy
+
+# Column name, start and end character of each column used (as slices of the line)
+COLUMN_SPECS = [
+    ('name', 0, 19),
+    ('rah', 19, 21), ('ram', 22, 24), ('ras', 25, 29),
+    ('decd', 30, 33), ('decm', 34, 36), ('decs', 37, 39),
+    ('ebv', 41, 45),
+    ('dm', 46, 51), ('dm_upp', 53, 56), ('dm_low', 58, 61),
+    ('rv', 62, 68), ('rv_upp', 69, 73), ('rv_low', 74, 78),
+    ('vm', 79, 83), ('vm_upp', 84, 87), ('vm_low', 88, 91),
+    ('pa', 92, 97), ('pa_upp', 98, 102), ('pa_low', 103, 107),
+    ('el', 108, 112), ('el_upp', 113, 117), ('el_low', 118, 122),
+    ('muv', 123, 127), ('muv_upp', 128, 131), ('muv_low', 132, 135),
+    ('rh', 136, 142), ('rh_upp', 143, 148), ('rh_low', 149, 154),
+    ('sigma', 155, 159), ('sigma_upp', 160, 164), ('sigma_low', 165, 169),
+]
+
+# Document field, value column, error columns (or None) and unit (or None), in document order.
+# ra and dec are computed from the sexagesimal columns.
+MEASUREMENT_SPECS = [
+    ('ra', 'ra', None, 'deg'),
+    ('dec', 'dec', None, 'deg'),
+    ('ebv', 'ebv', None, None),
+    ('distance_modulus', 'dm', ('dm_upp', 'dm_low'), None),
+    ('radial_velocity', 'rv', ('rv_upp', 'rv_low'), None),
+    ('v_mag', 'vm', ('vm_upp', 'vm_low'), 'mag'),
+    ('position_angle', 'pa', ('pa_upp', 'pa_low'), 'deg'),
+    ('ellipticity', 'el', ('el_upp', 'el_low'), None),
+    ('surface_brightness', 'muv', ('muv_upp', 'muv_low'), 'mag/(arcsec*arcsec)'),
+    ('half-light_radius', 'rh', ('rh_upp', 'rh_low'), 'arcmin'),
+    ('stellar_radial_velocity_dispersion', 'sigma', ('sigma_upp', 'sigma_low'), 'km/s'),
+]
+
+# (value, upper error) pairs of "nines" that mark an unknown value; such measurements are dropped
+SENTINELS = [(99.99, 9.99), (999.9, 99.9), (99.9, 99.9), (99.9, 9.9),
+             (9.9, 9.9), (99.0, 9.0), (999.0, 99.0), (9.99, 9.99)]
+
+
+def read_nearby_galaxies(filename, skip_lines=HEADER_LINES):
+    """
+    Read the fixed-width table in one pass.
+
+    Parameters
+    ----------
+    filename : str
+        Path to NearbyGalaxies.dat
+    skip_lines : int
+        Number of header lines to skip (Default: 37)
+
+    Returns
+    -------
+    table : pandas.DataFrame
+        One row per galaxy with the columns of COLUMN_SPECS
+    """
+
+    names = [spec[0] for spec in COLUMN_SPECS]
+    colspecs = [(spec[1], spec[2]) for spec in COLUMN_SPECS]
+    return pd.read_fwf(filename, colspecs=colspecs, names=names, header=None, skiprows=skip_lines,
+                       dtype={'name': str}, keep_default_na=False, na_values=[''])
+
+
+def _round(values, digits=5):
+    # Python's round (correctly rounded) rather than np.round, so values match those of a per-line parse
+    return [round(v, digits) for v in values.tolist()]
+
+
+def _sentinel_mask(value, upper):
+    # True where the (value, upper error) pair is one of the "nines" sentinels
+    mask = np.zeros(len(value), dtype=bool)
+    for sentinel_value, sentinel_upper in SENTINELS:
+        mask |= (value == sentinel_value) & (upper == sentinel_upper)
+    return mask
+
+
+def build_documents(table):
+    """
+    Build the galaxy documents from the parsed table. Coordinates are converted to degrees and
+    measurements with sentinel values are dropped, all with array operations over the whole table.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        Output of read_nearby_galaxies
+
+    Returns
+    -------
+    docs : list
+        JSON-style documents, one per galaxy
+    """
+
+    names = table['name'].fillna('').str.strip()
+    names = names.where(~names.str.startswith('*'), names.str[1:]).tolist()
+
+    columns = {name: table[name].to_numpy(dtype=float) for name, _, _ in COLUMN_SPECS[1:]}
+    columns['ra'] = np.array(_round(15 * (columns['rah'] + columns['ram'] / 60. + columns['ras'] / 3600.)))
+    sign = np.where(columns['decd'] < 0, -1, 1)
+    columns['dec'] = np.array(_round(sign * (np.abs(columns['decd']) + columns['decm'] / 60. +
+                                             columns['decs'] / 3600.)))
+
+    # Per field: list of measurement dicts (None where the value is a sentinel)
+    fields = []
+    for field, value_column, error_columns, unit in MEASUREMENT_SPECS:
+        values = columns[value_column].tolist()
+        if error_columns is None:
+            measurements = []
+            for value in values:
+                measurement = {'value': value, 'best': 1, 'reference': ''}
+                if unit:
+                    measurement['unit'] = unit
+                measurements.append(measurement)
+        else:
+            upper, lower = columns[error_columns[0]], columns[error_columns[1]]
+            missing = _sentinel_mask(columns[value_column], upper).tolist()
+            measurements = []
+            for value, err_upp, err_low, is_missing in zip(values, upper.tolist(), lower.tolist(), missing):
+                if is_missing:
+                    measurements.append(None)
+                    continue
+                measurement = {'value': value, 'error_upper': err_upp, 'error_lower': err_low, 'best': 1}
+                if unit:
+                    measurement['unit'] = unit
+                measurement['reference'] = ''
+                measurements.append(measurement)
+        fields.append((field, measurements))
+
+    docs = []
+    for i, name in enumerate(names):
+        doc = {'name': name}
+        for field, measurements in fields:
+            if measurements[i] is not None:
+                doc[field] = [measurements[i]]
+        docs.append(doc)
+    return docs
+
+
+def ingest_nearby_galaxies(filename='input/NearbyGalaxies.dat', db=None, out_dir='data', write_json=True,
+                           skip_lines=HEADER_LINES, batch_size=100):
+    """
+    Parse NearbyGalaxies.dat and load the galaxies to a Database and/or write one JSON file per galaxy.
+    Files whose contents would not change are not rewritten.
+
+    Parameters
+    ----------
+    filename : str
+        Path to NearbyGalaxies.dat (Default: 'input/NearbyGalaxies.dat')
+    db : galcat.core.Database
+        Database to load the documents to (Default: None)
+    out_dir : str
+        Directory for the JSON files (Default: 'data')
+    write_json : bool
+        Flag to write the JSON files (Default: True)
+    skip_lines : int
+        Number of header lines to skip (Default: 37)
+    batch_size : int
+        Number of documents to load to the database at a time (Default: 100)
+
+    Returns
+    -------
+    docs : list
+        The documents that were built
+    """
+
+    docs = build_documents(read_nearby_galaxies(filename, skip_lines=skip_lines))
+
+    if db is not None:
+        db.load_documents(docs, batch_size=batch_size)
+
+    if write_json:
+        for doc in docs:
+            out_json = json.dumps(doc, indent=4, sort_keys=False)
+            out_file = os.path.join(out_dir, doc['name'].strip().replace(' ', '_') + '.json')
+            digest = text_digest(out_json)
+            if file_digest(out_file) != digest:
+                write_text_atomic(out_file, out_json)
+            if db is not None and not db.use_mongodb:
+                db.db.mark_persisted(doc['name'], out_file, digest)
+
+    return docs
+
+
+class ChangeLog(object):
+    def __init__(self, source=''):
+        """
+        Record of the changes applied by an incremental sync, one entry per galaxy and field.
+
+        Parameters
+        ----------
+        source : str
+            File the changes came from
+        """
+
+        self.source = source
+        self.n_rows = 0
+        self.n_unchanged = 0  # rows skipped because their hash matched the previous sync
+        self.entries = []  # list of (name, field, action, old measurement, new measurement)
+        self.written = []  # JSON files written
+
+    def __repr__(self):
+        return self.summary()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, name, field, action, old=None, new=None):
+        self.entries.append((name, field, action, old, new))
+
+    def names(self, actions=None):
+        # Galaxies with at least one change (optionally only of the given actions), in the order they were changed
+        return list(dict.fromkeys(entry[0] for entry in self.entries if actions is None or entry[2] in actions))
+
+    def summary(self):
+        n_new = len(self.names(['new']))
+        n_dropped = len(self.names(['dropped']))
+        out_str = ('Synced {} rows from {}: {} galaxies new, {} changed, {} dropped upstream, '
+                   '{} rows unchanged since last sync').format(
+            self.n_rows, self.source, n_new, len(self.names()) - n_new - n_dropped, n_dropped, self.n_unchanged)
+        for name, field, action, old, new in self.entries:
+            if action == 'updated':
+                out_str += '\n  {} {} {}: {} -> {}'.format(action.upper(), name, field, old.get('value'),
+                                                         new.get('value'))
+            else:
+                out_str += '\n  {} {} {}'.format(action.upper(), name, field or '')
+        return out_str
+
+
+def _row_digest(doc):
+    # Hash of a parsed row, independent of key order
+    return text_digest(json.dumps(doc, sort_keys=True))
+
+
+def _source_measurement(values, reference):
+    # First stored measurement of a field that came from the source reference
+    if values is None:
+        return None
+    for measurement in values:
+        if isinstance(measurement, dict) and measurement.get('reference') == reference:
+            return measurement
+    return None
+
+
+def _same_measurement(stored, parsed):
+    # Compare everything the source provides except the best flag, which curators may change
+    return all(stored.get(k) == v for k, v in parsed.items() if k != 'best')
+
+
+def sync_nearby_galaxies(db, filename='input/NearbyGalaxies.dat', state_file=None, source_reference='',
+                         save_dir=None, skip_lines=HEADER_LINES, verbose=False):
+    """
+    Incrementally apply an updated NearbyGalaxies.dat to a Database. Each parsed row is hashed and
+    compared with the hash from the previous sync (if a state file is given); rows that changed are compared
+    field by field against the stored measurement with the source reference. Only measurements that differ
+    are applied, through add_data with update_value=True, so curated measurements from other references
+    are kept. The best flag of an existing source measurement is preserved.
+    Galaxies missing from the database are loaded as new documents. Measurements that the source no longer
+    provides are logged as 'removed', and galaxies of the previous sync that are no longer in the table as
+    'dropped'; both are left in the database.
+
+    Parameters
+    ----------
+    db : galcat.core.Database
+        Database to update
+    filename : str
+        Path to NearbyGalaxies.dat (Default: 'input/NearbyGalaxies.dat')
+    state_file : str
+        JSON file with the row hashes of the previous sync; it is updated afterwards (Default: None)
+    source_reference : str
+        Reference of the measurements that come from the table (Default: '')
+    save_dir : str
+        If given, the JSON files of the changed galaxies are written to this directory (Default: None)
+    skip_lines : int
+        Number of header lines to skip (Default: 37)
+    verbose : bool
+        Flag to print the change log (Default: False)
+
+    Returns
+    -------
+    changes : galcat.ingest.ChangeLog
+        The changes that were applied
+    """
+
+    docs = build_documents(read_nearby_galaxies(filename, skip_lines=skip_lines))
+    changes = ChangeLog(filename)
+
+    state = {}
+    if state_file is not None and os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+
+    new_state = {}
+    for doc in docs:
+        changes.n_rows += 1
+        name = doc['name']
+        digest = _row_digest(doc)
+        new_state[name] = digest
+        if state.get(name) == digest:
+            changes.n_unchanged += 1
+            continue
+
+        stored = db.query_db({'name': name})
+        if len(stored) == 0:
+            db.load_documents([doc])
+            changes.add(name, None, 'new')
+            continue
+        stored = stored[0]
+
+        update = {}
+        for field, values in doc.items():
+            if field == 'name':
+                continue
+            parsed = dict(values[0], reference=source_reference)
+            old = _source_measurement(stored.get(field), source_reference)
+            if old is None:
+                others = stored.get(field)
+                if others is not None and any(isinstance(m, dict) and m.get('best') == 1 for m in others):
+                    parsed['best'] = 0  # leave the curated best measurement in place
+                update[field] = [parsed]
+                changes.add(name, field, 'added', None, parsed)
+            elif not _same_measurement(old, parsed):
+                parsed['best'] = old.get('best', parsed['best'])
+                update[field] = [parsed]
+                changes.add(name, field, 'updated', dict(old), parsed)
+
+        for field in stored.keys():
+            if field not in doc and _source_measurement(stored.get(field), source_reference) is not None:
+                changes.add(name, field, 'removed', dict(_source_measurement(stored[field], source_reference)))
+
+        if update:
+            update['name'] = name
+            db.add_data(update, update_value=True, validate=False)
+
+    # Galaxies of the previous sync that are gone from the table (only known with a state file)
+    for name in state:
+        if name not in new_state:
+            changes.add(name, None, 'dropped')
+
+    if save_dir is not None:
+        for name in changes.names(['new', 'added', 'updated', 'removed']):
+            out_file = db.save_from_db(db.query_db({'name': name})[0], out_dir=save_dir)
+            if out_file is not None:
+                changes.written.append(out_file)
+
+    if state_file is not None:
+        write_text_atomic(state_file, json.dumps(new_state, indent=4, sort_keys=True))
+
+    if verbose:
+        print(changes.summary())
+    return changes
@@ -0,0 +1,246 @@
+# Bulk loading and saving of JSON documents
+import os
+import json
+import shutil
+import contextlib
+import hashlib
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+__all__ = ['LoadReport', 'list_json_files', 'read_json_file', 'iter_json_files', 'text_digest', 'file_digest',
+           'open_atomic', 'write_text_atomic', 'build_manifest', 'MANIFEST_FILE']
+
+MANIFEST_FILE = '.galcat_manifest.json'  # sidecar index of the JSON files of a directory
+
+
+class LoadReport(object):
+    def __init__(self, directory=''):
+        """
+        Summary of a bulk load: how many files were loaded, which ones failed and how long it took.
+
+        Parameters
+        ----------
+        directory : str
+            Directory that was loaded
+        """
+
+        self.directory = directory
+        self.n_files = 0
+        self.n_loaded = 0
+        self.n_cached = 0  # documents reused from a snapshot rather than parsed
+        self.n_deferred = 0  # documents indexed to be parsed on first access (lazy loading)
+        self.failures = []  # list of (filename, error message)
+        self.elapsed = 0.
+
+    def __repr__(self):
+        return self.summary()
+
+    @property
+    def files_per_second(self):
+        if self.elapsed <= 0:
+            return 0.
+        return self.n_files / self.elapsed
+
+    @property
+    def ok(self):
+        return len(self.failures) == 0
+
+    def summary(self):
+        out_str = 'Loaded {} of {} files from {} in {:.3f} s ({:.1f} files/s)'.format(
+            self.n_loaded, self.n_files, self.directory, self.elapsed, self.files_per_second)
+        if self.n_cached:
+            out_str += ', {} from snapshot'.format(self.n_cached)
+        if self.n_deferred:
+            out_str += ', {} deferred to first access'.format(self.n_deferred)
+        for filename, message in self.failures:
+            out_str += '\n  FAILED {}: {}'.format(filename, message)
+        return out_str
+
+
+def list_json_files(directory):
+    # JSON files in the directory, skipping hidden and non-json files
+    return [os.path.join(directory, filename) for filename in sorted(os.listdir(directory))
+            if not filename.startswith('.') and filename.endswith('.json')]
+
+
+def read_json_file(filename):
+    """
+    Parse a single JSON file. Errors are returned rather than raised so a bad file does not stop a bulk load.
+
+    Returns
+    -------
+    result : tuple
+        (filename, document or None, error message or None)
+    """
+
+    try:
+        with open(filename, 'r') as f:
+            doc = json.load(f)
+    except (OSError, ValueError) as e:
+        return filename, None, '{}: {}'.format(type(e).__name__, e)
+    return filename, doc, None
+
+
+def iter_json_files(filenames, workers=1, use_processes=False):
+    """
+    Parse JSON files, yielding results in order as they become available.
+
+    Parameters
+    ----------
+    filenames : list
+        Files to parse
+    workers : int
+        Number of parallel workers. With 1 (default) files are parsed in the calling thread.
+    use_processes : bool
+        Flag to parse in a process pool rather than a thread pool (Default: False)
+
+    Yields
+    ------
+    result : tuple
+        (filename, document or None, error message or None), see read_json_file
+    """
+
+    if workers is None or workers <= 1:
+        for filename in filenames:
+            yield read_json_file(filename)
+        return
+
+    # Only keep a bounded number of files in flight so parsed documents are streamed rather than accumulated
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        pending = deque()
+        for filename in filenames:
+            pending.append(executor.submit(read_json_file, filename))
+            if len(pending) >= 4 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def text_digest(text):
+    # Digest of a string as it is written to disk
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def file_digest(filename):
+    # Digest of the contents of a file or None if it cannot be read
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+@contextlib.contextmanager
+def open_atomic(filename):
+    """
+    Open a text file for writing atomically: writes go to a hidden temporary file in the same directory
+    which is renamed over the target when the block exits without an exception, so readers never see a
+    partially written file. Useful to stream large files to disk.
+    Example:
+        with open_atomic('references.json') as f:
+            f.write(text)
+
+    Parameters
+    ----------
+    filename : str
+        File to write
+    """
+
+    out_dir = os.path.dirname(os.path.abspath(filename))
+    fd, temp_name = tempfile.mkstemp(dir=out_dir, prefix='.tmp_', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            yield f
+        # Keep the permissions of the file being replaced (mkstemp creates files readable only by the owner)
+        if os.path.exists(filename):
+            shutil.copymode(filename, temp_name)
+        else:
+            os.chmod(temp_name, 0o644)
+        os.replace(temp_name, filename)
+    except BaseException:
+        os.remove(temp_name)
+        raise
+
+
+def write_text_atomic(filename, text):
+    """
+    Write a text file atomically: the text is written to a hidden temporary file in the same directory
+    which is then renamed over the target, so readers never see a partially written file.
+
+    Parameters
+    ----------
+    filename : str
+        File to write
+    text : str
+        Contents of the file
+    """
+
+    with open_atomic(filename) as f:
+        f.write(text)
+
+
+def build_manifest(directory, id_column='name', manifest_file=MANIFEST_FILE):
+    """
+    List the documents of a directory without converting them. Names are read from a sidecar manifest
+    (manifest_file in the directory) for files whose modification time and size are unchanged; other files
+    are parsed once to read their name and the manifest is rewritten. A missing or unwritable manifest is
+    not an error.
+
+    Parameters
+    ----------
+    directory : str
+        Directory with JSON files
+    id_column : str
+        Field holding the document name (Default: 'name')
+    manifest_file : str
+        Name of the sidecar manifest in the directory (Default: '.galcat_manifest.json')
+
+    Returns
+    -------
+    entries : list
+        (name, filename, size in bytes) of each document, in file name order
+    failures : list
+        (filename, error message) of files that could not be read
+    """
+
+    manifest_path = os.path.join(directory, manifest_file)
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('id_column') != id_column:
+            manifest = {}
+    except (OSError, ValueError, AttributeError):
+        manifest = {}
+    old_files = manifest.get('files', {})
+
+    entries, failures = [], []
+    new_files = {}
+    for filename in list_json_files(directory):
+        base_name = os.path.basename(filename)
+        try:
+            stat = os.stat(filename)
+        except OSError as e:
+            failures.append((filename, '{}: {}'.format(type(e).__name__, e)))
+            continue
+
+        entry = old_files.get(base_name)
+        if not entry or entry.get('mtime') != stat.st_mtime or entry.get('size') != stat.st_size:
+            _, doc, error = read_json_file(filename)
+            if error is None and (not isinstance(doc, dict) or id_column not in doc):
+                error = 'missing {}'.format(id_column)
+            if error is not None:
+                failures.append((filename, error))
+                continue
+            entry = {'name': doc[id_column], 'mtime': stat.st_mtime, 'size': stat.st_size}
+        new_files[base_name] = entry
+        entries.append((entry['name'], filename, entry['size']))
+
+    if new_files != old_files:
+        try:
+            write_text_atomic(manifest_path, json.dumps({'id_column': id_column, 'files': new_files}, indent=1))
+        except OSError:
+            pass
+
+    return entries, failures
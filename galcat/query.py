@@ -0,0 +1,474 @@
+# Query compiler for the in-memory database
+import re
+import copy
+import math
+import numpy as np
+from .store import _index_class
+
+__all__ = ['compile_query', 'QueryPlan', 'Predicate', 'Comparison', 'ElemMatch', 'And', 'Or', 'Nor', 'Not']
+
+LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+COMPARISON_OPERATORS = ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$exists', '$regex')
+
+# Rough fraction of documents expected to pass each operator, used to evaluate the most selective
+# predicates of a conjunction first
+_SELECTIVITY = {'$eq': 0.05, '$in': 0.1, '$regex': 0.2, '$gt': 0.4, '$gte': 0.4, '$lt': 0.4, '$lte': 0.4,
+                '$exists': 0.5, '$nin': 0.9, '$ne': 0.95}
+_REGEX_FLAGS = {'i': re.IGNORECASE, 'm': re.MULTILINE, 'x': re.VERBOSE, 's': re.DOTALL}
+_ARRAY_TYPES = (list, tuple, np.ndarray)
+
+
+def _resolve(doc, parts):
+    # Values reachable through a dotted path, descending into arrays of embedded documents as MongoDB does
+    values = [doc]
+    for part in parts:
+        next_values = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    next_values.append(value[part])
+            elif isinstance(value, _ARRAY_TYPES):
+                for elem in value:
+                    if isinstance(elem, dict) and part in elem:
+                        next_values.append(elem[part])
+        values = next_values
+    return values
+
+
+def _candidates(values):
+    # Arrays match on any of their elements as well as on the whole array
+    for value in values:
+        if isinstance(value, _ARRAY_TYPES):
+            yield from value
+        yield value
+
+
+def _equals(a, b):
+    if isinstance(a, _ARRAY_TYPES) or isinstance(b, _ARRAY_TYPES):
+        if not (isinstance(a, _ARRAY_TYPES) and isinstance(b, _ARRAY_TYPES)) or len(a) != len(b):
+            return False
+        return all(_equals(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict) or isinstance(b, dict):
+        if not (isinstance(a, dict) and isinstance(b, dict)) or list(a.keys()) != list(b.keys()):
+            return False
+        return all(_equals(a[k], b[k]) for k in a)
+    return a == b
+
+
+def _compare(a, b, db_operator):
+    # Ordering comparisons only apply to values of the same class (numbers with numbers, strings with strings)
+    type_class = _index_class(a)
+    if type_class is None or type_class != _index_class(b):
+        return False
+    if db_operator == '$gt':
+        return a > b
+    elif db_operator == '$gte':
+        return a >= b
+    elif db_operator == '$lt':
+        return a < b
+    return a <= b
+
+
+def _compile_regex(pattern, options=''):
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    flags = 0
+    for option in options:
+        if option not in _REGEX_FLAGS:
+            raise RuntimeError('ERROR: Unsupported $regex option {}'.format(option))
+        flags |= _REGEX_FLAGS[option]
+    return re.compile(pattern, flags)
+
+
+class Predicate(object):
+    """Base class of the compiled query nodes"""
+
+    selectivity = 1.
+    cost = 1.
+
+    def matches(self, doc):
+        raise NotImplementedError
+
+    def filter(self, docs):
+        """
+        Evaluate the predicate once per document.
+
+        Parameters
+        ----------
+        docs : iterable
+            Documents to filter
+
+        Returns
+        -------
+        result : np.array
+            Numpy array of the matching documents, in input order
+        """
+
+        matched = [doc for doc in docs if self.matches(doc)]
+        out_result = np.empty(len(matched), dtype=object)
+        for i, doc in enumerate(matched):
+            out_result[i] = doc
+        return out_result
+
+
+class Comparison(Predicate):
+    def __init__(self, path, db_operator, value, options=''):
+        """
+        Single operator applied to the values at a dotted path, eg: {'v_mag.value': {'$gt': 20}}.
+        A document matches if any value at the path matches, with the exception of $ne and $nin
+        which match only if none do. The empty path compares the document itself.
+
+        Parameters
+        ----------
+        path : str
+            Dotted path, eg: 'v_mag.value'
+        db_operator : str
+            One of $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $exists or $regex
+        value : object
+            Operand
+        options : str
+            Options of a $regex (Default: '')
+        """
+
+        if db_operator not in COMPARISON_OPERATORS:
+            raise RuntimeError('ERROR: {} not yet supported'.format(db_operator))
+        if db_operator in ('$in', '$nin') and not isinstance(value, _ARRAY_TYPES):
+            raise RuntimeError('ERROR: {} requires a list of values'.format(db_operator))
+
+        self.path = path
+        self.parts = path.split('.') if path else []
+        self.db_operator = db_operator
+        self.selectivity = _SELECTIVITY[db_operator]
+        if db_operator == '$regex':
+            self.cost = 3.
+            value = _compile_regex(value, options)
+        elif db_operator in ('$in', '$nin'):
+            value = list(value)
+            self.cost = 1. + 0.1 * len(value)
+            if db_operator == '$in':
+                self.selectivity = min(0.9, _SELECTIVITY['$eq'] * max(1, len(value)))
+        self.value = value
+
+    def __repr__(self):
+        return '<Comparison {} {} {!r}>'.format(self.path, self.db_operator, self.value)
+
+    def matches(self, doc):
+        values = _resolve(doc, self.parts)
+        db_operator = self.db_operator
+        if db_operator == '$exists':
+            return bool(values) == bool(self.value)
+        elif db_operator == '$eq':
+            return self._eq(values, self.value)
+        elif db_operator == '$ne':
+            return not self._eq(values, self.value)
+        elif db_operator == '$in':
+            return any(self._eq(values, v) for v in self.value)
+        elif db_operator == '$nin':
+            return not any(self._eq(values, v) for v in self.value)
+        elif db_operator == '$regex':
+            return self._regex(values, self.value)
+        return any(_compare(v, self.value, db_operator) for v in _candidates(values))
+
+    @staticmethod
+    def _eq(values, value):
+        if isinstance(value, re.Pattern):
+            return Comparison._regex(values, value)
+        if value is None:
+            # Null matches missing fields as well as explicit nulls
+            return not values or any(v is None for v in _candidates(values))
+        return any(_equals(v, value) for v in _candidates(values))
+
+    @staticmethod
+    def _regex(values, pattern):
+        return any(isinstance(v, str) and pattern.search(v) is not None for v in _candidates(values))
+
+
+class ElemMatch(Predicate):
+    def __init__(self, path, predicate, documents=True):
+        """
+        Matches documents with an array at the path where at least one element satisfies the predicate.
+
+        Parameters
+        ----------
+        path : str
+            Dotted path of the array, eg: 'v_mag'
+        predicate : Predicate
+            Predicate applied to each element
+        documents : bool
+            Flag to only consider embedded documents (a query on the fields of the elements) rather than
+            all elements (conditions on the elements themselves) (Default: True)
+        """
+
+        self.path = path
+        self.parts = path.split('.')
+        self.predicate = predicate
+        self.documents = documents
+        self.selectivity = predicate.selectivity
+        self.cost = 2. + predicate.cost
+
+    def __repr__(self):
+        return '<ElemMatch {} {!r}>'.format(self.path, self.predicate)
+
+    def matches(self, doc):
+        for value in _resolve(doc, self.parts):
+            if not isinstance(value, _ARRAY_TYPES):
+                continue
+            if any(self.predicate.matches(elem) for elem in value
+                   if not self.documents or isinstance(elem, dict)):
+                return True
+        return False
+
+
+class And(Predicate):
+    def __init__(self, children):
+        """
+        Conjunction. Children are evaluated most selective (then cheapest) first and evaluation stops
+        at the first child that does not match.
+
+        Parameters
+        ----------
+        children : list
+            Predicates to combine
+        """
+
+        self.children = sorted(children, key=lambda p: (p.selectivity, p.cost))
+        self.selectivity = float(np.prod([p.selectivity for p in children])) if children else 1.
+        self.cost = sum(p.cost for p in children)
+
+    def __repr__(self):
+        return '<And {!r}>'.format(self.children)
+
+    def matches(self, doc):
+        return all(p.matches(doc) for p in self.children)
+
+
+class Or(Predicate):
+    def __init__(self, children):
+        """
+        Disjunction. Children are evaluated least selective first and evaluation stops at the first match.
+
+        Parameters
+        ----------
+        children : list
+            Predicates to combine
+        """
+
+        self.children = sorted(children, key=lambda p: (-p.selectivity, p.cost))
+        self.selectivity = min(1., sum(p.selectivity for p in children))
+        self.cost = sum(p.cost for p in children)
+
+    def __repr__(self):
+        return '<Or {!r}>'.format(self.children)
+
+    def matches(self, doc):
+        return any(p.matches(doc) for p in self.children)
+
+
+class Nor(Or):
+    # Matches documents that match none of the children
+    def __init__(self, children):
+        super(Nor, self).__init__(children)
+        self.selectivity = 1. - self.selectivity
+
+    def __repr__(self):
+        return '<Nor {!r}>'.format(self.children)
+
+    def matches(self, doc):
+        return not Or.matches(self, doc)
+
+
+class Not(Predicate):
+    # Negation of an operator expression; like MongoDB, also matches documents without the field
+    def __init__(self, predicate):
+        self.predicate = predicate
+        self.selectivity = 1. - predicate.selectivity
+        self.cost = predicate.cost
+
+    def __repr__(self):
+        return '<Not {!r}>'.format(self.predicate)
+
+    def matches(self, doc):
+        return not self.predicate.matches(doc)
+
+
+def _is_operator_expression(value):
+    return isinstance(value, dict) and len(value) > 0 and all(str(k).startswith('$') for k in value)
+
+
+def _compile_field(path, value):
+    # Compile the condition on a single path: an operator expression or a value to match
+    if isinstance(value, re.Pattern):
+        return Comparison(path, '$regex', value)
+    if not _is_operator_expression(value):
+        return Comparison(path, '$eq', value)
+
+    children = []
+    for db_operator, sub_value in value.items():
+        if db_operator == '$options':
+            if '$regex' not in value:
+                raise RuntimeError('ERROR: $options requires $regex')
+            continue
+        elif db_operator == '$regex':
+            children.append(Comparison(path, '$regex', sub_value, value.get('$options', '')))
+        elif db_operator == '$elemMatch':
+            if not isinstance(sub_value, dict):
+                raise RuntimeError('ERROR: $elemMatch requires a query')
+            if _is_operator_expression(sub_value) and not any(k in LOGICAL_OPERATORS for k in sub_value):
+                # Conditions on the elements themselves, eg: {'$elemMatch': {'$gt': 1, '$lt': 3}}
+                children.append(ElemMatch(path, _compile_field('', sub_value), documents=False))
+            else:
+                children.append(ElemMatch(path, compile_query(sub_value)))
+        elif db_operator == '$not':
+            children.append(Not(_compile_field(path, sub_value)))
+        else:
+            children.append(Comparison(path, db_operator, sub_value))
+
+    return children[0] if len(children) == 1 else And(children)
+
+
+def compile_query(query):
+    """
+    Parse a query in MongoDB's query language into a predicate tree that can be evaluated once per document.
+    Supports $and, $or, $nor, $not, $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $exists, $regex and $elemMatch.
+    Dotted paths such as 'v_mag.value' match if any measurement in 'v_mag' matches.
+
+    Parameters
+    ----------
+    query : dict
+        Query to compile
+
+    Returns
+    -------
+    predicate : Predicate
+        Compiled query; call predicate.matches(doc) or predicate.filter(docs)
+    """
+
+    if not isinstance(query, dict):
+        raise RuntimeError('ERROR: Queries must be dictionaries, not {}'.format(type(query).__name__))
+
+    children = []
+    for key, value in query.items():
+        if key in LOGICAL_OPERATORS:
+            if not isinstance(value, list) or len(value) == 0:
+                raise RuntimeError('ERROR: {} requires a non-empty list of queries'.format(key))
+            sub_queries = [compile_query(sub_query) for sub_query in value]
+            if key == '$and':
+                children.append(And(sub_queries))
+            elif key == '$or':
+                children.append(Or(sub_queries))
+            else:
+                children.append(Nor(sub_queries))
+        elif key.startswith('$'):
+            raise RuntimeError('ERROR: {} not yet supported'.format(key))
+        else:
+            children.append(_compile_field(key, value))
+
+    return children[0] if len(children) == 1 else And(children)
+
+
+class QueryPlan(object):
+    def __init__(self, query, store):
+        """
+        Reusable execution plan of a query against a DocumentStore. Clauses that the primary key or a secondary
+        index can answer are looked up first (primary key first) and the remaining clauses are compiled once
+        to a predicate that is evaluated on the candidate documents.
+
+        Parameters
+        ----------
+        query : dict
+            Query in MongoDB's query language
+        store : galcat.store.DocumentStore
+            Store the plan is made for; the plan is only valid while the store has the same indexes
+        """
+
+        self.query = copy.deepcopy(query)
+        self.index_clauses = []  # (key, value, access), access is 'primary_key' or 'index'
+        scan_query = {}
+        for key, value in self.query.items():
+            access = store.index_access(key, value)
+            if access is None:
+                scan_query[key] = value
+            else:
+                self.index_clauses.append((key, value, access))
+        self.index_clauses.sort(key=lambda clause: clause[2] != 'primary_key')
+        self.scan_query = scan_query
+        self.predicate = compile_query(scan_query) if scan_query else None
+
+    def __repr__(self):
+        return '<QueryPlan {}>'.format(self.access_path)
+
+    @property
+    def access_path(self):
+        if not self.index_clauses:
+            return 'scan'
+        return self.index_clauses[0][2]
+
+    def execute(self, store):
+        """
+        Run the plan.
+
+        Parameters
+        ----------
+        store : galcat.store.DocumentStore
+            Store to query
+
+        Returns
+        -------
+        result : np.array
+            Numpy array of the matching documents, in insertion order
+        """
+
+        names = None
+        for key, value, access in self.index_clauses:
+            matched = store.index_lookup(key, value)
+            names = matched if names is None else names & matched
+            if not names:
+                break
+
+        if names is None and self.predicate is None:
+            return store.as_array()
+        docs = store.scan() if names is None else store.select(names)
+        if self.predicate is not None:
+            docs = self.predicate.filter(docs)
+        return docs
+
+    def explain(self, store):
+        """
+        Describe the plan with rough cost estimates. Index clauses are estimated from the number of matching
+        index entries, scanned clauses from the selectivity of their operators.
+
+        Parameters
+        ----------
+        store : galcat.store.DocumentStore
+            Store the plan runs against
+
+        Returns
+        -------
+        explanation : dict
+            access_path ('primary_key', 'index' or 'scan'), index_clauses, scan_clauses, n_documents,
+            estimated_candidates, estimated_rows and estimated_cost (in units of one predicate evaluation)
+        """
+
+        n_docs = len(store)
+        candidates = n_docs
+        cost = 0.
+        for key, value, access in self.index_clauses:
+            cost += math.log2(n_docs + 1)
+            if access == 'primary_key':
+                count = 1 if value in store else 0
+            else:
+                count = store.indexes[key].count(value)
+            candidates = min(candidates, count)
+
+        rows = candidates
+        if self.predicate is not None:
+            cost += candidates * self.predicate.cost
+            rows = candidates * self.predicate.selectivity
+
+        return {'access_path': self.access_path,
+                'index_clauses': [key for key, _, _ in self.index_clauses],
+                'scan_clauses': list(self.scan_query.keys()),
+                'n_documents': n_docs,
+                'estimated_candidates': candidates,
+                'estimated_rows': rows,
+                'estimated_cost': cost}
@@ -0,0 +1,503 @@
+# Parsing of References.dat and resolution of references to ADS bibcodes and DOIs, with an on-disk cache
+import os
+import re
+import json
+import time
+import threading
+import unicodedata
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .loader import write_text_atomic, open_atomic
+
+__all__ = ['ReferenceResolver', 'ADSBackend', 'FakeBackend', 'RateLimiter', 'reference_key',
+           'iter_reference_records', 'parse_reference', 'iter_references', 'write_references_json']
+
+# Journal macros of the AASTeX style entries
+JOURNAL_MACROS = {'apj': 'ApJ', 'apjl': 'ApJ', 'apjs': 'ApJS', 'aj': 'AJ', 'mnras': 'MNRAS', 'aap': 'A&A',
+                  'aaps': 'A&AS', 'pasp': 'PASP', 'nat': 'Nature', 'araa': 'ARA&A'}
+
+MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December')
+
+# Accents that precede the letter they belong to in the text export, and their combining characters
+_ACCENTS = {'\u02dc': '\u0303', '\u00a8': '\u0308', '\u00b4': '\u0301', '`': '\u0300', '\u02c6': '\u0302',
+            '~': '\u0303', '"': '\u0308', "'": '\u0301', '^': '\u0302'}
+
+
+def _normalize(text):
+    # Lower case with collapsed whitespace, so small formatting differences give the same cache key
+    return re.sub(r'\s+', ' ', str(text if text is not None else '')).strip().lower()
+
+
+def _surname(author):
+    # 'Bellazzini, M.' -> 'bellazzini'
+    return _normalize(str(author).split(',')[0])
+
+
+def reference_key(ref):
+    """
+    Cache key of a reference: first author surname, year and title.
+
+    Parameters
+    ----------
+    ref : dict
+        Reference with 'authors', 'year' and 'title'
+
+    Returns
+    -------
+    key : str
+        'surname|year|title', normalized
+    """
+
+    authors = ref.get('authors') or ['']
+    return '|'.join([_surname(authors[0]), _normalize(ref.get('year')), _normalize(ref.get('title'))])
+
+
+class RateLimiter(object):
+    def __init__(self, rate=5.):
+        """
+        Thread-safe limit on how often calls may start.
+
+        Parameters
+        ----------
+        rate : float
+            Maximum number of calls per second; None or 0 for no limit (Default: 5.)
+        """
+
+        self.interval = 1. / rate if rate else 0.
+        self._lock = threading.Lock()
+        self._next = 0.
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class ADSBackend(object):
+    def __init__(self, token=None, rows=5):
+        """
+        Search backend using the ads package (imported when the backend is created).
+
+        Parameters
+        ----------
+        token : str
+            ADS API token; if None, the ads package looks for it in its usual places (Default: None)
+        rows : int
+            Maximum number of papers returned per search (Default: 5)
+        """
+
+        try:
+            import ads
+        except ImportError:
+            raise RuntimeError('ERROR: The ads package is required for ADSBackend, install it with pip install ads')
+        if token is not None:
+            ads.config.token = token
+        self._ads = ads
+        self.rows = rows
+
+    def search(self, first_author, year, title):
+        # References given as short citations have no title, so they are searched by author and year only
+        criteria = {'first_author': first_author, 'year': year}
+        if title:
+            criteria['title'] = title
+        papers = self._ads.SearchQuery(rows=self.rows, fl=['bibcode', 'doi', 'title', 'year', 'author'], **criteria)
+        out_list = []
+        for p in papers:
+            out_list.append({'bibcode': p.bibcode or '',
+                             'doi': p.doi[0] if p.doi else '',
+                             'title': p.title[0] if p.title else '',
+                             'year': p.year,
+                             'author': list(p.author or [])})
+        return out_list
+
+
+class FakeBackend(object):
+    def __init__(self, papers, delay=0.):
+        """
+        Local stand-in for ADS, for tests and offline runs. Papers match on the first author surname, year
+        and a case-insensitive title.
+
+        Parameters
+        ----------
+        papers : list
+            Dicts with 'bibcode', 'doi', 'title', 'year' and 'author' (a list of names)
+        delay : float
+            Seconds to sleep per search, to mimic network latency (Default: 0.)
+        """
+
+        self.papers = papers
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def search(self, first_author, year, title):
+        with self._lock:
+            self.calls.append((first_author, year, title))
+        if self.delay:
+            time.sleep(self.delay)
+        return [dict(p) for p in self.papers
+                if p.get('author') and _surname(p['author'][0]) == _surname(first_author) and
+                _normalize(p.get('year')) == _normalize(year) and
+                (not title or _normalize(p.get('title')) == _normalize(title))]
+
+
+class ReferenceResolver(object):
+    def __init__(self, backend, cache_file=None, workers=4, rate_limit=5., batch_size=50):
+        """
+        Resolve references without a bibcode or DOI by searching a backend (eg, ADS) by first author, year and
+        title (if the reference has one). Searches run concurrently in a thread pool, limited to rate_limit per second. Results, including
+        searches that found nothing, are kept in a JSON cache keyed by (first author, year, title) that is
+        written after every batch, so repeated or interrupted runs only search what is left.
+
+        Parameters
+        ----------
+        backend : object
+            Object with a search(first_author, year, title) method returning a list of paper dicts,
+            eg: ADSBackend or FakeBackend
+        cache_file : str
+            JSON file for the cache; None to only cache in memory (Default: None)
+        workers : int
+            Number of concurrent searches (Default: 4)
+        rate_limit : float
+            Maximum number of searches started per second; None for no limit (Default: 5.)
+        batch_size : int
+            Number of searches between cache writes (Default: 50)
+        """
+
+        self.backend = backend
+        self.cache_file = cache_file
+        self.workers = max(1, workers)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.batch_size = max(1, batch_size)
+        self.cache = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                self.cache = json.load(f)
+
+    def save_cache(self):
+        if self.cache_file is not None:
+            write_text_atomic(self.cache_file, json.dumps(self.cache, indent=2, sort_keys=True))
+
+    def _search(self, ref):
+        self.rate_limiter.wait()
+        authors = ref.get('authors') or ['']
+        return self.backend.search(authors[0], ref.get('year'), ref.get('title'))
+
+    def search(self, refs):
+        """
+        Search the backend for every reference not already in the cache.
+
+        Parameters
+        ----------
+        refs : list
+            References (dicts with 'authors', 'year' and 'title')
+
+        Returns
+        -------
+        failures : dict
+            Cache key -> error message for searches that raised; these are not cached
+        """
+
+        pending = {}
+        for ref in refs:
+            key = reference_key(ref)
+            if key not in self.cache and key not in pending:
+                pending[key] = ref
+
+        failures = {}
+        keys = list(pending.keys())
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for start in range(0, len(keys), self.batch_size):
+                batch = keys[start:start + self.batch_size]
+                futures = [executor.submit(self._search, pending[key]) for key in batch]
+                for key, future in zip(batch, futures):
+                    try:
+                        self.cache[key] = future.result()
+                    except Exception as e:
+                        failures[key] = '{}: {}'.format(type(e).__name__, e)
+                self.save_cache()
+
+        return failures
+
+    def resolve(self, refs, verbose=False):
+        """
+        Fill in the bibcode and DOI of references that are missing either, when exactly one paper matches,
+        as well as the title if the reference has none. The references are updated in place.
+
+        Parameters
+        ----------
+        refs : list
+            References as in references.json
+        verbose : bool
+            Flag to print the references that were updated (Default: False)
+
+        Returns
+        -------
+        summary : dict
+            Number of references 'updated', 'ambiguous' (several matches), 'not_found' and 'failed',
+            and the number of 'searches' sent to the backend
+        """
+
+        todo = [ref for ref in refs if ref.get('bibcode', '') == '' or ref.get('doi', '') == '']
+        n_cached = len(self.cache)
+        failures = self.search(todo)
+
+        summary = {'updated': 0, 'ambiguous': 0, 'not_found': 0, 'failed': 0,
+                   'searches': len(self.cache) - n_cached + len(failures)}
+        for ref in todo:
+            key = reference_key(ref)
+            if key in failures:
+                print('Warning: search failed for {}: {}'.format(ref.get('key', key), failures[key]))
+                summary['failed'] += 1
+                continue
+
+            papers = self.cache[key]
+            if len(papers) == 1:
+                ref['bibcode'] = papers[0].get('bibcode', '') or ref.get('bibcode', '')
+                ref['doi'] = papers[0].get('doi', '') or ref.get('doi', '')
+                if not ref.get('title'):
+                    ref['title'] = papers[0].get('title', '')
+                summary['updated'] += 1
+                if verbose:
+                    print(ref)
+            elif len(papers) > 1:
+                print('Warning: more than one paper matched {}'.format(ref.get('key', key)))
+                for p in papers:
+                    print(p.get('year'), (p.get('author') or [''])[0], p.get('title'), p.get('bibcode'), p.get('doi'))
+                summary['ambiguous'] += 1
+            else:
+                summary['not_found'] += 1
+
+        return summary
+
+
+# Patterns used to parse References.dat
+_AUTHOR = re.compile(r'(?P<name>[^,]*?Collaboration)(?=[,\s])|'
+                     r'(?P<surname>[^,]+?(?:,\s*(?:Jr|Sr)\.)?),\s*'
+                     r'(?P<initials>(?:[A-Z][a-z]?\.(?:-|\s?(?=[A-Z][a-z]?\.))?)+)')
+_AUTHOR_SEPARATOR = re.compile(r',?\s+and\s+|,\s+')
+_ET_AL = re.compile(r',?\s*et al\.?')
+_TEX_ACCENT = re.compile(r'\{?\\([\'`"^~])\{?([A-Za-z])\}?\}?')
+_DETACHED_ACCENT = re.compile('([\u02dc\u00a8\u00b4\u02c6])\\s*([A-Za-z\u0131])')
+_GRAVE_ACCENT = re.compile(r'(?<=[A-Za-z])`([A-Za-z])')  # only within a word, eg: Macci`o
+_BOOK_YEAR = re.compile(r'\((\d{4})[a-z]?\)\.?$')
+_AASTEX_YEAR = re.compile(r'(\d{4})[a-z]?,\s*(.*)$')
+_MONTH = re.compile(r'\s+(?:{})$'.format('|'.join(MONTHS)))
+_SENTENCE_BREAK = re.compile(r'(?<=[.?!])\s+')
+_PUBLICATION = re.compile(r'(.+?)\s+(\d+),\s*(\S+)$')
+
+
+def _fix_text(text):
+    # Collapse whitespace, join detached accents to their letters and expand the TeX used in the file
+    if '\\' in text:
+        text = _TEX_ACCENT.sub(lambda m: m.group(2) + _ACCENTS[m.group(1)], text)
+        text = text.replace('\\&', 'and').replace('\\ ', ' ')
+    text = _DETACHED_ACCENT.sub(lambda m: m.group(2).replace('ı', 'i') + _ACCENTS[m.group(1)], text)
+    if '`' in text:
+        text = _GRAVE_ACCENT.sub(lambda m: m.group(1) + _ACCENTS['`'], text)
+    text = ' '.join(text.replace('~', ' ').split())
+    return unicodedata.normalize('NFC', text)
+
+
+def _key_name(author):
+    # ASCII surname for reference keys: 'Peñarrubia, J.' -> 'Penarrubia'
+    surname = unicodedata.normalize('NFKD', str(author).split(',')[0])
+    return re.sub(r'[^A-Za-z0-9]', '', surname) or 'Anonymous'
+
+
+def _split_authors(text):
+    # Consume 'Surname, I. I., ..., and Surname, I.' from the start of the text; returns (authors, rest)
+    authors = []
+    pos = 0
+    match = _AUTHOR.match(text)
+    while match is not None:
+        if match.group('name'):
+            authors.append(match.group('name').strip())
+        else:
+            authors.append('{}, {}'.format(match.group('surname').strip(), match.group('initials').strip()))
+        pos = match.end()
+
+        et_al = _ET_AL.match(text, pos)
+        if et_al is not None:
+            pos = et_al.end()
+            break
+        separator = _AUTHOR_SEPARATOR.match(text, pos)
+        if separator is None:
+            break
+        match = _AUTHOR.match(text, separator.end())
+        if match is not None:
+            pos = separator.end()
+    return authors, text[pos:].strip()
+
+
+def iter_reference_records(filename):
+    """
+    Split a References.dat file into records on the [n] markers, reading one line at a time.
+
+    Parameters
+    ----------
+    filename : str
+        File to read
+
+    Yields
+    ------
+    record : tuple
+        (n, text of the record with the lines joined)
+    """
+
+    marker = re.compile(r'^\s*\[(\d+)\]\s*')
+    number, lines = None, []
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            match = marker.match(line)
+            if match is not None:
+                if number is not None:
+                    yield number, ' '.join(lines)
+                number, lines = int(match.group(1)), [line[match.end():].strip()]
+            elif number is not None and line.strip():
+                lines.append(line.strip())
+    if number is not None:
+        yield number, ' '.join(lines)
+
+
+def parse_reference(n, text):
+    r"""
+    Parse one record. Two styles are understood:
+        Author, I., ..., and Last, I. Title. Journal vol, pages Month (Year).
+        Author, I.~I., ..., \& Last, I.\ Year, \journal, vol, pages
+
+    Parameters
+    ----------
+    n : int
+        Number of the reference, used as its id
+    text : str
+        Record without the [n] marker
+
+    Returns
+    -------
+    ref : dict
+        Reference with id, year (None if not found), doi and bibcode (empty), authors, journal, title,
+        volume and pages
+    """
+
+    text = _fix_text(text)
+    authors, rest = _split_authors(text)
+    ref = {'id': n, 'year': None, 'doi': '', 'bibcode': '', 'authors': authors, 'journal': '', 'title': '',
+           'volume': '', 'pages': ''}
+
+    book_style = _BOOK_YEAR.search(rest)
+    aastex_style = _AASTEX_YEAR.match(rest)
+    if book_style is not None:
+        ref['year'] = int(book_style.group(1))
+        rest = _MONTH.sub('', rest[:book_style.start()].rstrip())
+        # The title ends at the last sentence break before the journal
+        breaks = list(_SENTENCE_BREAK.finditer(rest))
+        if breaks:
+            ref['title'] = rest[:breaks[-1].start()].rstrip('.')
+            rest = rest[breaks[-1].end():]
+        publication = _PUBLICATION.match(rest)
+        if publication is not None:
+            ref['journal'], ref['volume'], ref['pages'] = publication.groups()
+        else:
+            ref['journal'] = rest.rstrip(',')
+    elif aastex_style is not None:
+        ref['year'] = int(aastex_style.group(1))
+        parts = [part.strip() for part in aastex_style.group(2).split(',')]
+        journal = parts[0]
+        if journal.startswith('\\'):
+            journal = JOURNAL_MACROS.get(journal[1:].lower(), journal[1:])
+        ref['journal'] = journal
+        if len(parts) > 2:
+            ref['volume'], ref['pages'] = parts[1], parts[2]
+        elif len(parts) == 2:
+            ref['pages'] = parts[1]
+    else:
+        ref['journal'] = rest
+
+    return ref
+
+
+def iter_references(filename):
+    """
+    Parse a References.dat file one record at a time and give each reference a key of the form
+    Author_Year_n, where n counts the references by the same first author in the same year.
+
+    Parameters
+    ----------
+    filename : str
+        File to read
+
+    Yields
+    ------
+    ref : dict
+        Parsed reference with its key first
+    """
+
+    counts = defaultdict(int)
+    for n, text in iter_reference_records(filename):
+        ref = parse_reference(n, text)
+        author = _key_name(ref['authors'][0]) if ref['authors'] else 'Anonymous'
+        year = ref['year'] if ref['year'] is not None else 'nd'
+        counts[(author, year)] += 1
+        key = '{}_{}_{}'.format(author, year, counts[(author, year)])
+        yield dict([('key', key)] + list(ref.items()))
+
+
+def write_references_json(dat_file='input/References.dat', out_file='references.json', db=None, merge=True):
+    """
+    Convert References.dat to the references JSON used by the Database. References are written as they
+    are parsed and the file is replaced atomically once complete.
+
+    Parameters
+    ----------
+    dat_file : str
+        References.dat file to read (Default: 'input/References.dat')
+    out_file : str
+        JSON file to write (Default: 'references.json')
+    db : galcat.core.Database
+        If given, its references are reloaded from out_file (data documents are not re-read) (Default: None)
+    merge : bool
+        Flag to merge with the references in the existing out_file by key. Fields that are set there (eg, hand
+        edits or the doi and bibcode found with ReferenceResolver) take precedence over the parsed ones and
+        references that are not in dat_file are kept at the end. Set to False to start from dat_file alone.
+        (Default: True)
+
+    Returns
+    -------
+    n_refs : int
+        Number of references written
+    """
+
+    existing = OrderedDict()
+    if merge and os.path.exists(out_file):
+        with open(out_file, 'r', encoding='utf-8') as f:
+            for ref in json.load(f):
+                existing[ref.get('key')] = ref
+
+    def iter_merged():
+        for ref in iter_references(dat_file):
+            old_ref = existing.pop(ref['key'], {})
+            ref.update((field, value) for field, value in old_ref.items() if value not in ('', None, []))
+            yield ref
+        for ref in existing.values():
+            yield ref
+
+    n_refs = 0
+    with open_atomic(out_file) as f:
+        f.write('[')
+        for ref in iter_merged():
+            out_json = json.dumps(ref, indent=2, sort_keys=False)
+            f.write(',\n  ' if n_refs else '\n  ')
+            f.write(out_json.replace('\n', '\n  '))
+            n_refs += 1
+        f.write('\n]' if n_refs else ']')
+
+    if db is not None:
+        db.load_references(out_file)
+    return n_refs
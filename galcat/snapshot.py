@@ -0,0 +1,107 @@
+# On-disk snapshot of a loaded database for fast startup
+import os
+import pickle
+import tempfile
+
+__all__ = ['Snapshot']
+
+SNAPSHOT_FORMAT = 2
+
+
+def _fingerprint(filename):
+    # Files are considered unchanged if their modification time and size are unchanged
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Snapshot(object):
+    def __init__(self, filename, options=None):
+        """
+        Pickled snapshot of converted documents and references, keyed by source file.
+        A Database reuses the entries of files whose modification time and size have not changed
+        since the snapshot was written, and only parses the files that changed.
+
+        Parameters
+        ----------
+        filename : str
+            Snapshot file to read (if it exists) and write
+        options : dict
+            Load-time options that change how documents are converted (eg, distribution_dtype).
+            They are stored with the snapshot, and a snapshot written with other options is discarded.
+            (Default: None, no options)
+        """
+
+        self.filename = filename
+        self.options = dict(options or {})
+        self.changed = False
+        self._old_files = {}
+        self.files = {}  # path -> (fingerprint, document), for the files seen in this load
+        self.references = {}  # path -> (fingerprint, references list)
+
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'rb') as f:
+                    contents = pickle.load(f)
+                if contents.get('format') == SNAPSHOT_FORMAT and contents.get('options') == self.options:
+                    self._old_files = contents['files']
+                    self.references = dict(contents['references'])
+                elif contents.get('format') == SNAPSHOT_FORMAT:
+                    print('WARNING: Ignoring snapshot {} written with other options: {}'.format(
+                        filename, contents.get('options')))
+            except Exception as e:
+                print('WARNING: Ignoring unreadable snapshot {}: {}'.format(filename, e))
+
+    def get_document(self, filename):
+        """
+        Get the converted document for a file if the file is unchanged since the snapshot.
+        Returns None if the file has to be parsed again.
+        """
+
+        path = os.path.abspath(filename)
+        entry = self._old_files.get(path)
+        if entry is None or entry[0] != _fingerprint(path):
+            return None
+        self.files[path] = entry
+        return entry[1]
+
+    def set_document(self, filename, doc):
+        path = os.path.abspath(filename)
+        self.files[path] = (_fingerprint(path), doc)
+        self.changed = True
+
+    def get_references(self, filename):
+        # Cached references list if the references file is unchanged, otherwise None
+        path = os.path.abspath(filename)
+        entry = self.references.get(path)
+        if entry is None or entry[0] != _fingerprint(path):
+            return None
+        return entry[1]
+
+    def set_references(self, filename, references):
+        path = os.path.abspath(filename)
+        self.references[path] = (_fingerprint(path), references)
+        self.changed = True
+
+    def save(self):
+        """
+        Write the snapshot if anything was added, changed or removed since it was read.
+        The file is written to a temporary file first and then renamed into place.
+        """
+
+        if not self.changed and self.files.keys() == self._old_files.keys():
+            return
+
+        contents = {'format': SNAPSHOT_FORMAT, 'options': self.options, 'files': self.files,
+                    'references': self.references}
+        out_dir = os.path.dirname(os.path.abspath(self.filename))
+        fd, temp_name = tempfile.mkstemp(dir=out_dir, prefix='.tmp_snapshot_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(contents, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_name, self.filename)
+        except Exception:
+            os.remove(temp_name)
+            raise
+
+        self._old_files = dict(self.files)
+        self.changed = False
@@ -0,0 +1,190 @@
+# Spatial index over the best coordinates of each document
+import functools
+import numbers
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord, Angle
+from astropy.table import Table
+
+__all__ = ['SpatialIndex']
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+CHUNK_SIZE = 4000000  # maximum number of pairwise distances held in memory by the brute-force search
+
+
+@functools.lru_cache(maxsize=None)
+def _degrees_per_unit(unit):
+    # Conversion factor to degrees; measurements without a unit are taken to be in degrees
+    if not unit:
+        return 1.
+    try:
+        return u.Unit(unit).to(u.deg)
+    except (ValueError, TypeError, u.UnitConversionError):
+        return None
+
+
+def _best_angle(values):
+    # Best measurement of a coordinate in degrees: the only measurement or the first with best == 1
+    if not isinstance(values, (list, np.ndarray)):
+        return None
+    measurements = [m for m in values if isinstance(m, dict)]
+    if len(measurements) != 1:
+        measurements = [m for m in measurements if m.get('best') == 1][:1]
+    if not measurements:
+        return None
+    value = measurements[0].get('value')
+    if not isinstance(value, numbers.Real) or isinstance(value, bool):
+        return None
+    factor = _degrees_per_unit(measurements[0].get('unit'))
+    return None if factor is None else float(value) * factor
+
+
+def _unit_vectors(ra, dec):
+    # Cartesian unit vectors of ra/dec in degrees
+    ra, dec = np.radians(ra), np.radians(dec)
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
+
+
+def _chord(angle):
+    # Chord length between unit vectors separated by the angle
+    return 2 * np.sin(np.minimum(Angle(angle).to_value(u.rad), np.pi) / 2)
+
+
+def _separation(chord):
+    # Angle in degrees subtended by a chord between unit vectors
+    return np.degrees(2 * np.arcsin(np.clip(chord / 2, 0, 1)))
+
+
+def _as_icrs(coord):
+    # ICRS unit vectors of a SkyCoord (or anything SkyCoord accepts)
+    if not isinstance(coord, SkyCoord):
+        coord = SkyCoord(coord)
+    coord = coord.icrs
+    return _unit_vectors(np.atleast_1d(coord.ra.deg), np.atleast_1d(coord.dec.deg))
+
+
+class SpatialIndex(object):
+    def __init__(self, ra_field='ra', dec_field='dec'):
+        """
+        Index of document positions as unit vectors, built from the best ra/dec measurement of each document
+        (taken to be ICRS). Like the other indexes it is kept up to date through add/remove as documents are
+        loaded or updated. Searches use a KD-tree when scipy is installed and a chunked brute-force search
+        otherwise.
+
+        Parameters
+        ----------
+        ra_field : str
+            Field with right ascension measurements (Default: 'ra')
+        dec_field : str
+            Field with declination measurements (Default: 'dec')
+        """
+
+        self.ra_field = ra_field
+        self.dec_field = dec_field
+        self._positions = {}  # name -> (ra, dec) in degrees
+        self._names = None
+        self._xyz = None
+        self._tree = None
+
+    def __len__(self):
+        return len(self._positions)
+
+    def add(self, name, doc):
+        ra = _best_angle(doc.get(self.ra_field))
+        dec = _best_angle(doc.get(self.dec_field))
+        if ra is not None and dec is not None:
+            self._positions[name] = (ra, dec)
+            self._names = None
+
+    def remove(self, name):
+        if self._positions.pop(name, None) is not None:
+            self._names = None
+
+    def _build(self):
+        # Arrays (and KD-tree) are rebuilt lazily on the first search after a change
+        if self._names is None:
+            self._names = np.array(list(self._positions.keys()), dtype=object)
+            positions = np.array(list(self._positions.values()), dtype=float).reshape(-1, 2)
+            self._xyz = _unit_vectors(positions[:, 0], positions[:, 1])
+            self._tree = cKDTree(self._xyz) if cKDTree is not None and len(self._xyz) > 0 else None
+
+    def cone_search(self, coord, radius):
+        """
+        Find the documents within a radius of a position.
+
+        Parameters
+        ----------
+        coord : astropy.coordinates.SkyCoord
+            Center of the cone
+        radius : astropy.units.Quantity or astropy.coordinates.Angle
+            Radius of the cone
+
+        Returns
+        -------
+        names : np.array
+            Names of the documents in the cone, nearest first
+        separations : astropy.coordinates.Angle
+            Separation of each document from the center
+        """
+
+        self._build()
+        center = _as_icrs(coord)[0]
+        chord = _chord(radius)
+        if self._tree is not None:
+            ind = np.array(self._tree.query_ball_point(center, chord), dtype=int)
+        else:
+            ind = np.where(np.linalg.norm(self._xyz - center, axis=1) <= chord)[0]
+
+        distances = np.linalg.norm(self._xyz[ind] - center, axis=1)
+        order = np.argsort(distances, kind='stable')
+        return self._names[ind[order]], Angle(_separation(distances[order]), u.deg)
+
+    def crossmatch(self, catalog, max_sep):
+        """
+        Match each source of a catalog to the nearest indexed document within max_sep.
+
+        Parameters
+        ----------
+        catalog : astropy.coordinates.SkyCoord
+            Array of source positions
+        max_sep : astropy.units.Quantity or astropy.coordinates.Angle
+            Maximum separation of a match
+
+        Returns
+        -------
+        matches : astropy.table.Table
+            One row per matched source with the columns catalog_index, name and separation (deg),
+            in catalog order
+        """
+
+        self._build()
+        xyz = _as_icrs(catalog)
+        chord = _chord(max_sep)
+        n_sources = len(xyz)
+        nearest = np.full(n_sources, -1)
+        distances = np.full(n_sources, np.inf)
+
+        if self._tree is not None:
+            distances, nearest = self._tree.query(xyz, distance_upper_bound=chord)
+            nearest[~np.isfinite(distances)] = -1
+        elif len(self._xyz) > 0:
+            # Compare sources in chunks against all documents; the dot product is largest for the nearest one
+            chunk_size = max(1, CHUNK_SIZE // len(self._xyz))
+            for start in range(0, n_sources, chunk_size):
+                chunk = xyz[start:start + chunk_size]
+                dots = chunk @ self._xyz.T
+                best = np.argmax(dots, axis=1)
+                chunk_distances = np.sqrt(np.maximum(2 - 2 * dots[np.arange(len(chunk)), best], 0))
+                within = chunk_distances <= chord
+                nearest[start:start + chunk_size] = np.where(within, best, -1)
+                distances[start:start + chunk_size] = chunk_distances
+
+        matched = np.where(nearest >= 0)[0]
+        return Table({'catalog_index': matched,
+                      'name': self._names[nearest[matched]].astype(str) if len(matched) else np.array([], dtype=str),
+                      'separation': _separation(distances[matched]) * u.deg})
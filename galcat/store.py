@@ -0,0 +1,718 @@
+# In-memory document store for the JSON backend
+import os
+import re
+import math
+import numbers
+import threading
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+__all__ = ['DocumentStore', 'LazyDocumentStore', 'SortedFieldIndex', 'HashIndex', 'ReferenceIndex']
+
+RANGE_OPERATORS = ('$gt', '$gte', '$lt', '$lte')
+
+
+def _index_class(value):
+    # Values are only comparable within the same class, so each class is indexed separately
+    if isinstance(value, numbers.Real) and not isinstance(value, np.ndarray):
+        if isinstance(value, float) and math.isnan(value):
+            return None
+        return 'number'
+    elif isinstance(value, str):
+        return 'string'
+    return None
+
+
+class SortedFieldIndex(object):
+    def __init__(self, path):
+        """
+        Sorted index over an embedded field path such as 'surface_brightness.value'.
+        Each measurement of the field contributes one entry, so a document matches if any of its measurements does.
+        Equality and range lookups are resolved by bisection.
+
+        Parameters
+        ----------
+        path : str
+            Dotted path of the form field.subfield
+        """
+
+        key_list = path.split('.')
+        if len(key_list) != 2:
+            raise ValueError('Indexes are supported on field.subfield paths only: {}'.format(path))
+
+        self.path = path
+        self.field, self.subfield = key_list
+        self._keys = {'number': [], 'string': []}
+        self._names = {'number': [], 'string': []}
+        self._entries = {}  # name -> list of (class, value) that were indexed for that document
+
+    def __len__(self):
+        return sum(len(v) for v in self._keys.values())
+
+    def add(self, name, doc):
+        # Index all measurements of the document
+        entries = []
+        values = doc.get(self.field)
+        if isinstance(values, (list, np.ndarray)):
+            for elem in values:
+                if not isinstance(elem, dict):
+                    continue
+                value = elem.get(self.subfield)
+                value_class = _index_class(value)
+                if value_class is None:
+                    continue
+                # Keep the names of equal values sorted too so entries can be removed by bisection
+                keys, names = self._keys[value_class], self._names[value_class]
+                lo, hi = bisect_left(keys, value), bisect_right(keys, value)
+                ind = bisect_left(names, name, lo, hi)
+                keys.insert(ind, value)
+                names.insert(ind, name)
+                entries.append((value_class, value))
+        if entries:
+            self._entries[name] = entries
+
+    def remove(self, name):
+        # Remove the entries recorded for the document (the document itself may have been modified in place)
+        for value_class, value in self._entries.pop(name, []):
+            keys, names = self._keys[value_class], self._names[value_class]
+            lo, hi = bisect_left(keys, value), bisect_right(keys, value)
+            ind = bisect_left(names, name, lo, hi)
+            del keys[ind]
+            del names[ind]
+
+    def can_lookup(self, value):
+        # Check whether a query value (plain value or single range operator) can be resolved with this index
+        if isinstance(value, dict):
+            if len(value) != 1:
+                return False
+            operator, value = list(value.items())[0]
+            if operator not in RANGE_OPERATORS:
+                return False
+        return _index_class(value) is not None
+
+    def lookup(self, value):
+        """
+        Find the names of documents with a measurement matching the query value.
+
+        Parameters
+        ----------
+        value : object or dict
+            Value for equality or a dict with a single $gt/$gte/$lt/$lte operator
+
+        Returns
+        -------
+        names : set
+            Set of matching document names
+        """
+
+        names, lo, hi = self._bounds(value)
+        return set(names[lo:hi])
+
+    def count(self, value):
+        # Number of index entries (measurements) matching the query value
+        names, lo, hi = self._bounds(value)
+        return hi - lo
+
+    def _bounds(self, value):
+        # Sorted names of the value's class and the slice of them matching the query value
+        operator = '$eq'
+        if isinstance(value, dict):
+            operator, value = list(value.items())[0]
+
+        value_class = _index_class(value)
+        keys, names = self._keys[value_class], self._names[value_class]
+        if operator == '$eq':
+            lo, hi = bisect_left(keys, value), bisect_right(keys, value)
+        elif operator == '$gt':
+            lo, hi = bisect_right(keys, value), len(keys)
+        elif operator == '$gte':
+            lo, hi = bisect_left(keys, value), len(keys)
+        elif operator == '$lt':
+            lo, hi = 0, bisect_left(keys, value)
+        elif operator == '$lte':
+            lo, hi = 0, bisect_right(keys, value)
+        else:
+            raise RuntimeError('ERROR: {} not supported by indexes'.format(operator))
+
+        return names, lo, hi
+
+
+class HashIndex(object):
+    def __init__(self, field, docs=()):
+        """
+        Hash index over a top-level field (eg, the 'key' or 'id' of a reference) for O(1) equality lookups.
+
+        Parameters
+        ----------
+        field : str
+            Field to index
+        docs : iterable
+            Documents to index initially
+        """
+
+        self.field = field
+        self._map = {}
+        for doc in docs:
+            self.add(doc)
+
+    def __len__(self):
+        return sum(len(v) for v in self._map.values())
+
+    @staticmethod
+    def can_lookup(value):
+        # Only hashable scalar values can be looked up; compiled regular expressions need a scan
+        return not isinstance(value, (dict, list, np.ndarray, re.Pattern))
+
+    def add(self, doc):
+        value = doc.get(self.field)
+        if value is not None and self.can_lookup(value):
+            self._map.setdefault(value, []).append(doc)
+
+    def remove(self, doc):
+        value = doc.get(self.field)
+        if value is not None and self.can_lookup(value):
+            docs = self._map.get(value, [])
+            for i, elem in enumerate(docs):
+                if elem is doc:
+                    del docs[i]
+                    break
+            if not docs:
+                self._map.pop(value, None)
+
+    def get(self, value):
+        # List of documents whose field equals the value
+        return self._map.get(value, [])
+
+
+class ReferenceIndex(object):
+    def __init__(self):
+        """
+        Inverted index of reference -> field -> names of the documents with a measurement of that field
+        from that reference. Used to build curations without scanning every document.
+        """
+
+        self._fields = {}
+        self._entries = {}  # name -> list of (reference, field) that were indexed for that document
+
+    def add(self, name, doc):
+        entries = []
+        for field, values in doc.items():
+            if not isinstance(values, (list, np.ndarray)):
+                continue
+            for elem in values:
+                if not isinstance(elem, dict):
+                    continue
+                reference = elem.get('reference')
+                if reference is None or not HashIndex.can_lookup(reference):
+                    continue
+                names = self._fields.setdefault(reference, {}).setdefault(field, set())
+                if name not in names:
+                    names.add(name)
+                    entries.append((reference, field))
+        if entries:
+            self._entries[name] = entries
+
+    def remove(self, name):
+        for reference, field in self._entries.pop(name, []):
+            fields = self._fields[reference]
+            fields[field].discard(name)
+            if not fields[field]:
+                del fields[field]
+            if not fields:
+                del self._fields[reference]
+
+    def references(self):
+        return list(self._fields.keys())
+
+    def fields(self, reference):
+        """
+        Fields with measurements from a reference.
+
+        Returns
+        -------
+        fields : dict
+            Dictionary of field -> set of document names
+        """
+
+        return self._fields.get(reference, {})
+
+
+class DocumentStore(object):
+    def __init__(self, id_column='name'):
+        """
+        In-memory document store used when no MongoDB connection is provided.
+        Documents are held in insertion order behind a hash index on the primary key,
+        so inserts, updates and lookups by name are amortised O(1).
+
+        Parameters
+        ----------
+        id_column : str
+            Field used as the primary key (Default: 'name')
+        """
+
+        self.id_column = id_column
+        self.version = 0  # incremented on every change to the contents
+        self._docs = {}
+        self._order = {}  # name -> insertion sequence, used to return results in insertion order
+        self._sequence = 0
+        self._array = None
+        self.indexes = {}
+        self.reference_index = ReferenceIndex()
+        self.spatial_index = None
+        self._persisted = {}  # name -> {path: digest or None}, cleared whenever the document changes
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __iter__(self):
+        return iter(self._docs.values())
+
+    def __contains__(self, name):
+        return name in self._docs
+
+    def __getitem__(self, name):
+        return self._docs[name]
+
+    def __repr__(self):
+        return '<DocumentStore: {} documents>'.format(len(self))
+
+    def _changed(self):
+        # Drop the cached array view and record the new version
+        self._array = None
+        self.version += 1
+
+    def _all_indexes(self):
+        indexes = list(self.indexes.values()) + [self.reference_index]
+        if self.spatial_index is not None:
+            indexes.append(self.spatial_index)
+        return indexes
+
+    def names(self):
+        return list(self._docs.keys())
+
+    def _items(self):
+        # (name, document) pairs of every document, used to populate new indexes
+        return list(self._docs.items())
+
+    def get(self, name, default=None):
+        return self._docs.get(name, default)
+
+    def upsert(self, doc):
+        """
+        Insert a document, replacing in place any existing document with the same primary key.
+
+        Parameters
+        ----------
+        doc : dict
+            Document to store
+        """
+
+        name = doc.get(self.id_column, '')
+        if name not in self._order:
+            self._order[name] = self._sequence
+            self._sequence += 1
+        self._docs[name] = doc
+        self._persisted.pop(name, None)
+        for index in self._all_indexes():
+            index.remove(name)
+            index.add(name, doc)
+        self._changed()
+
+    def remove(self, name):
+        """
+        Remove the document matching the primary key. Returns the removed document or None if it was not present.
+        """
+
+        doc = self._docs.pop(name, None)
+        if doc is not None:
+            del self._order[name]
+            self._persisted.pop(name, None)
+            for index in self._all_indexes():
+                index.remove(name)
+            self._changed()
+        return doc
+
+    def mark_persisted(self, name, path, digest=None):
+        """
+        Record that the current version of a document is stored on disk. The record is dropped
+        the next time the document is upserted.
+
+        Parameters
+        ----------
+        name : str
+            Primary key of the document
+        path : str
+            File holding the document
+        digest : str or None
+            Content digest of the file, if known (Default: None)
+        """
+
+        if name in self._docs:
+            self._persisted.setdefault(name, {})[os.path.abspath(path)] = digest
+
+    def is_persisted(self, name, path):
+        # True if the document is unchanged since it was last read from or written to the path
+        return os.path.abspath(path) in self._persisted.get(name, {})
+
+    def persisted_digest(self, name, path):
+        # Content digest recorded for the path or None if unknown
+        return self._persisted.get(name, {}).get(os.path.abspath(path))
+
+    def modified(self):
+        # Names of the documents changed since they were last read from or written to disk
+        return [name for name in self._docs if not self._persisted.get(name)]
+
+    def create_index(self, path):
+        """
+        Create a sorted index on a field.subfield path and populate it with the current documents.
+
+        Parameters
+        ----------
+        path : str
+            Dotted path to index, eg: 'surface_brightness.value'
+
+        Returns
+        -------
+        index : SortedFieldIndex
+        """
+
+        if path not in self.indexes:
+            index = SortedFieldIndex(path)
+            for name, doc in self._items():
+                index.add(name, doc)
+            self.indexes[path] = index
+        return self.indexes[path]
+
+    def create_spatial_index(self, ra_field='ra', dec_field='dec'):
+        """
+        Create the spatial index over the best ra/dec of each document and populate it with the current documents.
+
+        Returns
+        -------
+        index : galcat.spatial.SpatialIndex
+        """
+
+        from .spatial import SpatialIndex
+
+        index = self.spatial_index
+        if index is None or (index.ra_field, index.dec_field) != (ra_field, dec_field):
+            index = SpatialIndex(ra_field, dec_field)
+            for name, doc in self._items():
+                index.add(name, doc)
+            self.spatial_index = index
+        return index
+
+    def drop_index(self, path):
+        self.indexes.pop(path, None)
+
+    def index_lookup(self, key, value):
+        """
+        Resolve a single query clause through the primary key or a secondary index.
+
+        Parameters
+        ----------
+        key : str
+            Query key, eg: 'name' or 'surface_brightness.value'
+        value : object or dict
+            Query value
+
+        Returns
+        -------
+        names : set or None
+            Names of the matching documents or None if no index can answer the clause
+        """
+
+        access = self.index_access(key, value)
+        if access is None:
+            return None
+        elif access == 'primary_key':
+            return {value} if value in self else set()
+        return self.indexes[key].lookup(value)
+
+    def index_access(self, key, value):
+        """
+        Check how a single query clause can be resolved without scanning.
+
+        Returns
+        -------
+        access : str or None
+            'primary_key', 'index' or None if the clause requires a scan
+        """
+
+        if key == self.id_column:
+            if not HashIndex.can_lookup(value):
+                return None
+            return 'primary_key'
+
+        index = self.indexes.get(key)
+        if index is None or not index.can_lookup(value):
+            return None
+        return 'index'
+
+    def select(self, names):
+        # Numpy array of the documents matching the names, in insertion order
+        names = sorted((n for n in names if n in self._order), key=self._order.get)
+        out_result = np.empty(len(names), dtype=object)
+        for i, name in enumerate(names):
+            out_result[i] = self[name]
+        return out_result
+
+    def find(self, name):
+        # Primary key lookup returning the same array format as a query
+        doc = self.get(name)
+        if doc is None:
+            return np.array([])
+        out_result = np.empty(1, dtype=object)
+        out_result[0] = doc
+        return out_result
+
+    def as_array(self):
+        """
+        Numpy object array of all documents in insertion order.
+        The array is cached until the store is next modified.
+        """
+
+        if self._array is None:
+            array = np.empty(len(self), dtype=object)
+            for i, doc in enumerate(self):
+                array[i] = doc
+            self._array = array
+        return self._array
+
+    def scan(self):
+        # Documents for a full scan, in insertion order
+        return self.as_array()
+
+    def is_full_array(self, array):
+        # True if the array is the cached as_array() result, without building it
+        return array is not None and array is self._array
+
+
+class LazyDocumentStore(DocumentStore):
+    def __init__(self, loader, id_column='name', memory_budget=None):
+        """
+        Document store that knows every document by name but only reads a document from its file on
+        first access. Under a memory budget, the least recently used documents that are unchanged since
+        they were read are dropped again and re-read when next needed. File size is used as the measure
+        of a document's memory use. Index entries are kept for documents that are not in memory, so
+        indexed queries only read the documents they return; scans and new indexes read every document.
+        Documents must be changed through upsert (as the Database methods do), not by editing a returned
+        document in place.
+
+        Parameters
+        ----------
+        loader : function
+            Function taking a file name and returning the converted document
+        id_column : str
+            Field used as the primary key (Default: 'name')
+        memory_budget : int or None
+            Approximate number of bytes of documents to keep in memory; None to keep every document
+            once read (Default: None)
+        """
+
+        self._reference_index = None
+        self._reference_index_ready = False
+        super(LazyDocumentStore, self).__init__(id_column)
+        self.loader = loader
+        self.memory_budget = memory_budget
+        self.n_reads = 0  # number of documents read from files
+        self.resident_bytes = 0
+        self._files = {}  # name -> (filename, size)
+        self._resident = OrderedDict()  # name -> size of file-backed documents in memory, least recently used first
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._order)
+
+    def __iter__(self):
+        for _, doc in self._iter_items():
+            yield doc
+
+    def __contains__(self, name):
+        return name in self._order
+
+    def __getitem__(self, name):
+        doc = self.get(name)
+        if doc is None:
+            raise KeyError(name)
+        return doc
+
+    def __repr__(self):
+        return '<LazyDocumentStore: {} documents, {} in memory>'.format(len(self), len(self._docs))
+
+    @property
+    def reference_index(self):
+        # Built from every document on first use rather than as documents are registered
+        with self._lock:
+            if not self._reference_index_ready:
+                for name, doc in self._iter_items():
+                    self._reference_index.add(name, doc)
+                self._reference_index_ready = True
+        return self._reference_index
+
+    @reference_index.setter
+    def reference_index(self, index):
+        self._reference_index = index
+
+    def _all_indexes(self):
+        indexes = list(self.indexes.values())
+        if self._reference_index_ready:
+            indexes.append(self._reference_index)
+        if self.spatial_index is not None:
+            indexes.append(self.spatial_index)
+        return indexes
+
+    def _iter_items(self):
+        # Documents are read one at a time, so a budget holds while iterating
+        for name in list(self._order):
+            doc = self.get(name)
+            if doc is not None:
+                yield name, doc
+
+    def _items(self):
+        return self._iter_items()
+
+    def names(self):
+        return list(self._order.keys())
+
+    def register(self, name, filename, size=0):
+        """
+        Add a document that is stored in a file, without reading it. The document replaces any document
+        with the same name. If indexes exist, the document is read to add it to them.
+
+        Parameters
+        ----------
+        name : str
+            Primary key of the document
+        filename : str
+            JSON file with the document
+        size : int
+            Size of the file in bytes, used for the memory budget (Default: 0)
+        """
+
+        with self._lock:
+            if name in self._docs:
+                self._unload(name, force=True)
+            self._files[name] = (filename, size)
+            if name not in self._order:
+                self._order[name] = self._sequence
+                self._sequence += 1
+            self._persisted.pop(name, None)
+            indexes = self._all_indexes()
+            if indexes:
+                doc = self.get(name)
+                for index in indexes:
+                    index.remove(name)
+                    index.add(name, doc)
+            self._changed()
+
+    def get(self, name, default=None):
+        with self._lock:
+            doc = self._docs.get(name)
+            if doc is not None:
+                if name in self._resident:
+                    self._resident.move_to_end(name)
+                return doc
+            if name not in self._files or name not in self._order:
+                return default
+            return self._load(name)
+
+    def _load(self, name):
+        # Read a registered document and record it as unchanged since it was read
+        filename, size = self._files[name]
+        try:
+            doc = self.loader(filename)
+        except (OSError, ValueError) as e:
+            raise RuntimeError('ERROR: Failed to load {} from {}: {}'.format(name, filename, e))
+        self.n_reads += 1
+        self._docs[name] = doc
+        self._persisted[name] = {os.path.abspath(filename): None}
+        self._resident[name] = size
+        self.resident_bytes += size
+        self._evict(keep=name)
+        return doc
+
+    def _unload(self, name, force=False):
+        # Drop a document from memory; unless forced, only if it is unchanged since it was read
+        if name not in self._resident:
+            return False
+        if not force and not self.is_persisted(name, self._files[name][0]):
+            return False
+        self._docs.pop(name, None)
+        self._persisted.pop(name, None)
+        self.resident_bytes -= self._resident.pop(name)
+        return True
+
+    def _evict(self, keep=None):
+        # Drop least recently used unchanged documents until within the budget
+        if self.memory_budget is None or self.resident_bytes <= self.memory_budget:
+            return
+        for name in list(self._resident):
+            if self.resident_bytes <= self.memory_budget:
+                break
+            if name != keep:
+                self._unload(name)
+
+    def evict(self):
+        """
+        Drop every document that is unchanged since it was read from memory.
+
+        Returns
+        -------
+        n_evicted : int
+            Number of documents dropped
+        """
+
+        with self._lock:
+            self._array = None
+            return sum(self._unload(name) for name in list(self._resident))
+
+    def is_loaded(self, name):
+        # True if the document is currently held in memory
+        return name in self._docs
+
+    def is_persisted(self, name, path):
+        # Documents not in memory are unchanged since they were last read from their file
+        with self._lock:
+            if name not in self._docs and name in self._files:
+                return os.path.abspath(path) == os.path.abspath(self._files[name][0])
+            return super(LazyDocumentStore, self).is_persisted(name, path)
+
+    def upsert(self, doc):
+        with self._lock:
+            name = doc.get(self.id_column, '')
+            super(LazyDocumentStore, self).upsert(doc)
+            if name in self._files and name not in self._resident:
+                self._resident[name] = self._files[name][1]
+                self.resident_bytes += self._files[name][1]
+            self._evict(keep=name)
+
+    def remove(self, name):
+        with self._lock:
+            if name not in self._order:
+                return None
+            doc = self.get(name)
+            self._docs.setdefault(name, doc)
+            super(LazyDocumentStore, self).remove(name)
+            self._files.pop(name, None)
+            self.resident_bytes -= self._resident.pop(name, 0)
+            return doc
+
+    def scan(self):
+        # Under a budget documents are read one at a time, so a scan never holds more than the budget
+        # (plus whatever the caller keeps)
+        if self.memory_budget is None:
+            return self.as_array()
+        return iter(self)
+
+    def as_array(self):
+        # Without a budget the array is cached as usual; with one it is built for each call so the
+        # documents can be dropped again afterwards
+        with self._lock:
+            if self.memory_budget is None:
+                return super(LazyDocumentStore, self).as_array()
+            array = np.empty(len(self), dtype=object)
+            for i, doc in enumerate(self):
+                array[i] = doc
+            return array
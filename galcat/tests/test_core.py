@@ -1,12 +1,15 @@
 # Unit tests for core.py
 import os
+import re
 import numpy as np
 import pytest
 import astropy.units as u
 from astropy import uncertainty as unc
 from astropy.table import QTable
 from galcat.core import *
-from galcat.core import _get_values_from_distribution, _read_curation
+from galcat.core import _get_values_from_distribution, _read_curation, _list_to_array
+from galcat.cache import LRUCache, canonical_key
+from galcat.columnar import FieldColumns
 
 USE_MONGO = False
 
@@ -46,6 +49,30 @@ def test_query_db():
     assert len(docs) == 0
 
 
+def test_embed_ref():
+    doc = {'name': 'Gal Embed',
+           'ebv': [{'value': 0.1, 'best': 1, 'reference': 'Bellazzini_2006_1'},
+                   {'value': 0.2, 'best': 0, 'reference': 'Martin_2005_1'}],
+           'v_mag': [{'value': 20.1, 'best': 1, 'reference': 'Bellazzini_2006_1'}],
+           'ra': [{'value': 5, 'best': 1, 'reference': '', 'unit': 'deg'}]}
+    db.load_file_to_db(doc)
+
+    docs = db.query({'name': 'Gal Embed'}, embed_ref=True)
+    assert docs[0]['ebv'][0]['reference']['bibcode'] == '2006MNRAS.366..865B'
+    assert docs[0]['ebv'][1]['reference']['key'] == 'Martin_2005_1'
+    assert docs[0]['ra'][0]['reference'] == ''
+
+    if not USE_MONGO:
+        # Reference dicts and untouched measurements are shared rather than copied
+        assert docs[0]['ebv'][0]['reference'] is docs[0]['v_mag'][0]['reference']
+        stored = db.db.get('Gal Embed')
+        assert docs[0]['ra'] is stored['ra']
+        assert stored['ebv'][0]['reference'] == 'Bellazzini_2006_1'
+        db.db.remove('Gal Embed')
+    else:
+        db.db.delete_one({'name': 'Gal Embed'})
+
+
 def test_operator_math():
     query = {'v_mag.value': {'$lt': 21}}
     docs = db.query_db(query)
@@ -77,28 +104,20 @@ def test_operator_math():
 
 
 def test_operator_exists():
-    if USE_MONGO:
-        query = {'radial_velocity.value': {'$exists': True}}
-        docs = db.query_db(query)
-        assert len(docs) == 1
-        assert docs[0]['name'] == 'Gal 1'
+    query = {'radial_velocity.value': {'$exists': True}}
+    docs = db.query_db(query)
+    assert len(docs) == 1
+    assert docs[0]['name'] == 'Gal 1'
 
-        # This fails locally, but not in MongoDB
-        query = {'radial_velocity': {'$exists': True}}
-        docs = db.query_db(query)
-        assert len(docs) == 1
-        assert docs[0]['name'] == 'Gal 1'
+    query = {'radial_velocity': {'$exists': True}}
+    docs = db.query_db(query)
+    assert len(docs) == 1
+    assert docs[0]['name'] == 'Gal 1'
 
-        # This fails locally, but not in MongoDB
-        query = {'radial_velocity.value': {'$exists': False}}
-        docs = db.query_db(query)
-        print(docs)
-        assert len(docs) == 1
-        assert docs[0]['name'] == 'Gal 2'
-    else:
-        with pytest.raises(RuntimeError):
-            query = {'radial_velocity.value': {'$exists': True}}
-            docs = db.query_db(query)
+    query = {'radial_velocity.value': {'$exists': False}}
+    docs = db.query_db(query)
+    assert len(docs) == 1
+    assert docs[0]['name'] == 'Gal 2'
 
 
 def test_operator_or():
@@ -126,6 +145,169 @@ def test_operator_or():
     assert len(docs) == 1
 
 
+def test_create_index():
+    queries = [{'v_mag.value': {'$lt': 21}},
+               {'v_mag.value': {'$gte': 20.2}},
+               {'v_mag.value': 16.2},
+               {'v_mag.value': {'$gt': 10}, 'radial_velocity.value': {'$lte': -100}},
+               {'ra.value': {'$gt': 10}, '$or': [{'v_mag.value': {'$lte': 21}}, {'v_mag.value': {'$gte': 16}}]}]
+    expected = [sorted(d['name'] for d in db.query_db(q)) for q in queries]
+
+    db.create_index('v_mag.value')
+    db.create_index('ra.value')
+    for query, names in zip(queries, expected):
+        assert sorted(d['name'] for d in db.query_db(query)) == names
+
+    # Indexes stay consistent through loads and updates
+    doc = {'name': 'Gal Index', 'v_mag': [{'value': 30.5, 'best': 1, 'reference': ''}]}
+    db.load_file_to_db(doc)
+    assert [d['name'] for d in db.query_db({'v_mag.value': {'$gt': 30}})] == ['Gal Index']
+    db.add_data({'name': 'Gal Index', 'v_mag': [{'value': 1.5, 'reference': 'Ref_1'}]}, validate=False)
+    assert [d['name'] for d in db.query_db({'v_mag.value': {'$lt': 2}})] == ['Gal Index']
+
+    if USE_MONGO:
+        db.db.delete_one({'name': 'Gal Index'})
+    else:
+        db.db.remove('Gal Index')
+        for path in ['v_mag.value', 'ra.value']:
+            db.db.drop_index(path)
+
+
+@pytest.mark.parametrize('query', [
+    {},
+    {'name': 'Gal 2'},
+    {'name': 'I DONT EXIST'},
+    {'fake_column': 5},
+    {'ebv.error_upper': 0.5},
+    {'ebv.reference': 'Bellazzini_2006_1'},
+    {'v_mag.value': {'$lt': 21}},
+    {'v_mag.value': {'$lte': 16.2}},
+    {'v_mag.value': {'$gt': 10}},
+    {'v_mag.value': {'$gte': 999}},
+    {'v_mag.value': {'$gt': 10}, 'radial_velocity.value': {'$lte': -100}},
+    {'$or': [{'v_mag.value': 16.2}, {'dec.value': -32.4}]},
+    {'ra.value': {'$gt': 10}, '$or': [{'v_mag.error_upper': {'$lte': 0.4}},
+                                      {'v_mag.error_upper': {'$gte': 0.2}}]},
+    {'$or': [{'v_mag.value': 16.2}, {'half-light_radius.error_upper': 0.12}]},
+    {'ra.value': {'$gt': 100, '$lt': 500}},  # each operator may match a different measurement
+    {'ra.value': {'$gt': 9, '$lt': 10}},
+    # Values the columnar engine cannot compare fall back to the manual engine
+    {'name': re.compile('^Gal')},
+    {'name': None},
+    {'ra.reference': re.compile('^Fake')},
+    {'radial_velocity.value': None},
+    {'radial_velocity.value': {'$eq': None}},
+    {'ra.reference': {'$eq': re.compile('^Fake')}},
+])
+def test_query_columnar(query):
+    expected = [d['name'] for d in db.query_db(query)]
+    result = db.query_db(query, engine='columnar')
+    assert [d['name'] for d in result] == expected
+
+
+def test_query_columnar_multiple_operators():
+    new_db = Database(directory='galcat/tests/test_data', references_file='galcat/tests/test_references.json')
+    new_db.load_file_to_db({'name': 'Gal X', 'ebv': [{'value': 0.05, 'best': 1, 'reference': ''},
+                                                     {'value': 0.6, 'best': 0, 'reference': ''}]})
+    query = {'ebv.value': {'$gt': 0.1, '$lt': 0.5}}
+    expected = [d['name'] for d in new_db.query_db(query)]
+    assert 'Gal X' in expected
+    assert [d['name'] for d in new_db.query_db(query, engine='columnar')] == expected
+
+
+def test_field_columns():
+    docs = np.array([{'name': 'A', 'v': [{'value': 1, 'unit': 'mag'}, {'value': 'x'}]},
+                     {'name': 'B', 'v': [{'value': [1, 2], 'unit': None}, {'value': 2.5}]},
+                     {'name': 'C', 'ebv': [{'value': 0.1}]}])
+    columns = FieldColumns('v', docs)
+    assert list(columns.counts) == [2, 2, 0]
+    assert np.array_equal(columns.numeric('value'), [1, np.nan, np.nan, 2.5], equal_nan=True)
+    assert list(columns.is_numeric('value')) == [True, False, False, True]
+    assert list(columns.present('value')) == [True, True, True, True]
+    assert list(columns.present('unit')) == [True, False, False, False]
+    assert list(columns.objects('unit')) == ['mag', None, None, None]
+    assert columns.objects('value')[1] == 'x' and columns.objects('value')[2] != [1, 2]
+    assert np.isnan(columns.numeric('unit')).all() and not columns.is_numeric('unit').any()
+
+
+def test_columnar_keys():
+    new_db = Database(directory='galcat/tests/test_data', references_file='galcat/tests/test_references.json')
+    all_keys, scalar_keys = new_db.columns.keys()
+    assert list(all_keys)[0] == 'name' and 'ebv' in all_keys and scalar_keys == {'name'}
+    assert new_db.columns.keys()[0] is all_keys
+    new_db.load_file_to_db({'name': 'Gal X', 'notes': 'plain'})
+    assert 'notes' in new_db.columns.keys()[1]
+
+
+def test_query_columnar_fallback():
+    # Operators the columnar engine cannot compile fall back to the manual engine
+    query = {'name': {'$in': ['Gal 1']}}
+    assert len(db.query_db(query, engine='columnar')) == len(db.query_db(query))
+
+
+def test_explain():
+    new_db = Database(directory='galcat/tests/test_data', references_file='galcat/tests/test_references.json')
+    explanation = new_db.explain({'name': 'Gal 1', 'v_mag.value': {'$gt': 10}})
+    assert explanation['access_path'] == 'primary_key'
+    assert explanation['index_clauses'] == ['name'] and explanation['scan_clauses'] == ['v_mag.value']
+    assert explanation['estimated_candidates'] == 1
+    assert not explanation['cached']
+
+    scan = new_db.explain({'v_mag.value': {'$gt': 10}})
+    assert scan['access_path'] == 'scan' and scan['estimated_candidates'] == 2
+    assert 0 < scan['estimated_rows'] < scan['estimated_candidates']
+
+    # Plans are reused, and replanned once an index makes a better access path available
+    docs = new_db.query_db({'v_mag.value': {'$gt': 10}})
+    assert new_db.explain({'v_mag.value': {'$gt': 10}})['cached']
+    new_db.query_db({'v_mag.value': {'$gt': 10}})
+    assert new_db.plan_cache.hits >= 1
+
+    new_db.create_index('v_mag.value')
+    indexed = new_db.explain({'v_mag.value': {'$gt': 17}})
+    assert indexed['access_path'] == 'index' and indexed['estimated_candidates'] == 1
+    assert [d['name'] for d in new_db.query_db({'v_mag.value': {'$gt': 10}})] == [d['name'] for d in docs]
+
+    # Mutating the query afterwards does not change the cached plan
+    query = {'v_mag.value': {'$gt': 10}}
+    new_db.query_db(query)
+    query['v_mag.value']['$gt'] = 100
+    assert len(new_db.query_db({'v_mag.value': {'$gt': 10}})) == 2
+
+
+def test_query_reference():
+    ref = db.query_reference({'key': 'Bellazzini_2006_1'})
+    assert len(ref) == 1 and ref[0]['id'] == 1
+    ref = db.query_reference({'id': 2})
+    assert len(ref) == 1 and ref[0]['key'] == 'Martin_2005_1'
+    assert len(db.query_reference({'key': 'I DONT EXIST'})) == 0
+
+    # Compiled regular expressions scan the references instead of using the hash index
+    ref = db.query_reference({'key': re.compile('^Bell')})
+    assert len(ref) == 1 and ref[0]['key'] == 'Bellazzini_2006_1'
+    assert ref == db.query_reference({'key': {'$regex': '^Bell'}})
+
+    # Fields without an index still work
+    ref = db.query_reference({'year': 2006})
+    assert len(ref) == 1 and ref[0]['key'] == 'Bellazzini_2006_1'
+    db.create_reference_index('bibcode')
+    ref = db.query_reference({'bibcode': '2005MNRAS.362..906M'})
+    assert len(ref) == 1 and ref[0]['key'] == 'Martin_2005_1'
+
+    if not USE_MONGO:
+        db.add_reference({'key': 'Penguin_2020_1', 'id': 3, 'year': 2020, 'bibcode': 'fake'})
+        assert db.query_reference({'id': 3})[0]['key'] == 'Penguin_2020_1'
+        db.add_reference({'key': 'Penguin_2020_1', 'id': 4, 'year': 2020, 'bibcode': 'fake'})
+        assert len(db.query_reference({'id': 3})) == 0
+        assert db.query_reference({'bibcode': 'fake'})[0]['id'] == 4
+        assert len(db.references) == 3
+
+        # Reload references from disk
+        db.load_references('galcat/tests/test_references.json')
+        assert len(db.query_reference({'key': 'Penguin_2020_1'})) == 0
+        assert len(db.references) == 2
+
+
 def test_query_table():
     df = db.query_table({'name': 'I DONT EXIST'})
     assert len(df) == 0
@@ -143,6 +325,165 @@ def test_query_table():
     assert len(df) == 1
 
 
+@pytest.mark.parametrize('workers, use_processes', [(1, False), (2, False), (2, True)])
+def test_load_all(tmpdir, workers, use_processes):
+    for name in ['Gal A', 'Gal B', 'Gal C']:
+        with open(os.path.join(tmpdir, name.replace(' ', '_') + '.json'), 'w') as f:
+            f.write('{"name": "%s", "ra": [{"value": 1, "best": 1, "reference": ""}]}' % name)
+    with open(os.path.join(tmpdir, 'Broken.json'), 'w') as f:
+        f.write('{"name": "Broken", "ra": [')
+    with open(os.path.join(tmpdir, '.hidden.json'), 'w') as f:
+        f.write('not json')
+
+    new_db = Database(directory=str(tmpdir), references_file='galcat/tests/test_references.json')
+    report = new_db.load_all(str(tmpdir), workers=workers, batch_size=2, use_processes=use_processes)
+    assert report.n_files == 4
+    assert report.n_loaded == 3
+    assert len(report.failures) == 1 and report.failures[0][0].endswith('Broken.json')
+    assert not report.ok
+    assert 'Broken.json' in report.summary()
+    assert len(new_db.query_db({})) == 3
+
+    with pytest.raises(RuntimeError):
+        new_db.load_all(str(tmpdir), workers=workers, raise_errors=True)
+
+
+def test_snapshot(tmpdir):
+    data_dir = os.path.join(tmpdir, 'data')
+    os.mkdir(data_dir)
+    for name in ['Gal A', 'Gal B', 'Gal C']:
+        with open(os.path.join(data_dir, name.replace(' ', '_') + '.json'), 'w') as f:
+            f.write('{"name": "%s", "ra": [{"value": 1, "best": 1, "reference": ""}]}' % name)
+    snapshot_file = os.path.join(tmpdir, 'snapshot.pkl')
+
+    new_db = Database(directory=data_dir, references_file='galcat/tests/test_references.json',
+                      snapshot_file=snapshot_file)
+    assert os.path.exists(snapshot_file)
+    assert new_db.load_report.n_loaded == 3 and new_db.load_report.n_cached == 0
+
+    new_db = Database(directory=data_dir, references_file='galcat/tests/test_references.json',
+                      snapshot_file=snapshot_file)
+    assert new_db.load_report.n_loaded == 3 and new_db.load_report.n_cached == 3
+    assert isinstance(new_db.query_db({'name': 'Gal A'})[0]['ra'], np.ndarray)
+    assert len(new_db.query_reference({'key': 'Bellazzini_2006_1'})) == 1
+
+    # Only the changed file is parsed again and removed files are dropped
+    with open(os.path.join(data_dir, 'Gal_A.json'), 'w') as f:
+        f.write('{"name": "Gal A", "ra": [{"value": 12.5, "best": 1, "reference": ""}]}')
+    os.remove(os.path.join(data_dir, 'Gal_C.json'))
+    new_db = Database(directory=data_dir, references_file='galcat/tests/test_references.json',
+                      snapshot_file=snapshot_file)
+    assert new_db.load_report.n_loaded == 2 and new_db.load_report.n_cached == 1
+    assert new_db.query_db({'name': 'Gal A'})[0]['ra'][0]['value'] == 12.5
+    assert len(new_db.query_db({'name': 'Gal C'})) == 0
+
+    # A snapshot written with another distribution_dtype is discarded and rewritten
+    with open(os.path.join(data_dir, 'Gal_D.json'), 'w') as f:
+        f.write('{"name": "Gal D", "v_mag": [{"distribution": [1, 2, 3], "best": 1, "reference": ""}]}')
+    new_db = Database(directory=data_dir, references_file='galcat/tests/test_references.json',
+                      snapshot_file=snapshot_file, distribution_dtype=np.float32)
+    assert new_db.load_report.n_cached == 0
+    assert new_db.query_db({'name': 'Gal D'})[0]['v_mag'][0]['distribution'].dtype == np.float32
+    new_db = Database(directory=data_dir, references_file='galcat/tests/test_references.json',
+                      snapshot_file=snapshot_file, distribution_dtype=np.float32)
+    assert new_db.load_report.n_cached == 3
+    new_db = Database(directory=data_dir, references_file='galcat/tests/test_references.json',
+                      snapshot_file=snapshot_file)
+    assert new_db.load_report.n_cached == 0
+    assert not isinstance(new_db.query_db({'name': 'Gal D'})[0]['v_mag'][0]['distribution'][0], np.float32)
+
+
+def test_query_table_columns():
+    df = db.query_table({}, add_coordinates=False)
+    assert len(df) == len(db.query_db({}))
+    assert df.colnames[0] == 'name'
+    assert df['ra'].unit == u.deg
+
+    # Gal 2 has no radial velocity, so the column is masked there
+    df = db.query_table({'$or': [{'name': 'Gal 1'}, {'name': 'Gal 2'}]}, add_coordinates=False)
+    assert list(df['name']) == ['Gal 1', 'Gal 2']
+    assert df['radial_velocity'][0] == -139.8
+    assert df['radial_velocity'].mask.tolist() == [False, True]
+
+    df = db.query_table({'name': 'Gal 1'}, add_coordinates=False, use_qtable=False)
+    assert not isinstance(df, QTable)
+    assert df['ra'].unit == u.deg and df['ra'][0] == 9.14542
+
+
+def test_projection():
+    doc = db.query_db({'name': 'Gal 1'}, projection=['ebv'])[0]
+    assert set(doc.keys()) == {'name', 'ebv'}
+    assert doc['ebv'][0]['value'] == 0.166
+
+    doc = db.query_db({'name': 'Gal 1'}, projection={'ra.value': 1, 'ra.unit': 1})[0]
+    assert set(doc.keys()) == {'name', 'ra'}
+    assert [sorted(m.keys()) for m in doc['ra']] == [['unit', 'value'], ['unit', 'value']]
+    assert 'best' in db.query_db({'name': 'Gal 1'})[0]['ra'][0]  # stored documents are untouched
+
+    with pytest.raises(RuntimeError):
+        db.query_db({}, projection={'ra': 0})
+
+
+def test_iter_query():
+    names = [doc['name'] for doc in db.iter_query({}, batch_size=1)]
+    assert names == [doc['name'] for doc in db.query_db({})]
+    doc = next(db.iter_query({'name': 'Gal 1'}, projection=['ebv'], embed_ref=True))
+    assert set(doc.keys()) == {'name', 'ebv'}
+    assert doc['ebv'][0]['reference']['key'] == 'Bellazzini_2006_1'
+
+    df = db.query_table({}, columns=['ebv'])
+    assert df.colnames == ['name', 'ra', 'dec', 'ebv', 'coord']
+    df = db.query_table({}, columns=['ebv'], add_coordinates=False, reorder_columns_rowidx=None)
+    assert sorted(df.colnames) == ['ebv', 'name']
+
+
+def test_query_table_cache():
+    t1 = db.query_table({'name': 'Gal 1'}, copy=False)
+    t2 = db.query_table({'name': 'Gal 1'}, copy=False)
+    assert t1 is t2
+    t3 = db.query_table({'name': 'Gal 1'})
+    assert t3 is not t1 and t3['ra'][0] == t1['ra'][0]
+
+    # By default callers get a copy, so changing it does not change later results
+    t3['distance'] = 1.
+    t3['ra'][0] = 0
+    t6 = db.query_table({'name': 'Gal 1'})
+    assert 'distance' not in t6.colnames and t6['ra'][0] == t1['ra'][0] and t6['ra'][0].value != 0
+
+    # Different arguments are cached separately
+    t4 = db.query_table({'name': 'Gal 1'}, selection={'ra': 'FakeRef2019'})
+    assert t4 is not t1 and t4['ra'][0].value == 999.14542
+
+    # A compiled regular expression is not confused with the string of its repr
+    pattern = re.compile('^Gal 1$')
+    assert len(db.query_table({'name': pattern})) == 1
+    assert len(db.query_table({'name': repr(pattern)}, add_coordinates=False)) == 0
+
+    # Writes invalidate the cache
+    db.add_data({'name': 'Gal 1', 'fake_quantity': [{'value': 1, 'reference': 'Ref_1'}]}, validate=False)
+    t5 = db.query_table({'name': 'Gal 1'})
+    assert t5 is not t1 and 'fake_quantity' in t5.colnames
+    db.load_file_to_db('galcat/tests/test_data/Gal_1.json')
+    assert 'fake_quantity' not in db.query_table({'name': 'Gal 1'}).colnames
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)  # evicts b, the least recently used
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    assert cache.get('b') is None
+    assert cache.hits == 1 and cache.misses == 1
+
+    assert canonical_key({'a': 1, 'b': 2}) == canonical_key({'b': 2, 'a': 1})
+    assert canonical_key({'a': 1}) != canonical_key({'a': 2})
+    pattern = re.compile('^Bell')
+    assert canonical_key({'key': pattern}) == canonical_key({'key': re.compile('^Bell')})
+    assert canonical_key({'key': pattern}) != canonical_key({'key': repr(pattern)})
+
+
 def test_load_file_to_db():
     doc = {"name": "Gal 3",
            "ra": [{"value": 5, "best": 1, "reference": "", "unit": "deg"}],
@@ -241,6 +582,15 @@ def test_generate_curation():
     curation = db.generate_curation('Ref_25')
     assert not curation and len(curation) == 0
 
+    curation = db.generate_curation(['Ref_25', 'Ref_3'], existing_curation={'ra': 'Ref_9'})
+    assert curation == {'ra': 'Ref_9', 'ebv': 'Ref_3', 'redshift': 'Ref_3'}
+
+    # The reference index follows updates to the data
+    db.add_data({'name': 'Gal 1', 'fake_quantity': [{'value': 1, 'reference': 'Ref_25'}]}, validate=False)
+    assert db.generate_curation('Ref_25') == {'fake_quantity': 'Ref_25'}
+    db.load_file_to_db('galcat/tests/test_data/Gal_1.json')
+    assert db.generate_curation('Ref_25') == {}
+
 
 def test_write_curation():
     test_file = 'galcat/tests/test_write_curation.json'
@@ -264,6 +614,100 @@ def test_save_from_db(tmpdir):
     assert os.path.isfile(os.path.join(tmpdir, 'Gal_1.json'))
 
 
+@pytest.mark.parametrize('workers', [1, 2])
+def test_save_all(tmpdir, workers):
+    data_dir = str(tmpdir)
+    for name in ['Gal A', 'Gal B', 'Gal C']:
+        with open(os.path.join(data_dir, name.replace(' ', '_') + '.json'), 'w') as f:
+            f.write('{"name": "%s", "ra": [{"value": 1, "best": 1, "reference": ""}]}' % name)
+    new_db = Database(directory=data_dir, references_file='galcat/tests/test_references.json')
+    assert new_db.db.modified() == []
+
+    # Nothing changed since loading
+    assert new_db.save_all(out_dir=data_dir, modified_only=True, workers=workers) == []
+
+    # Only the modified document is written
+    new_db.add_data({'name': 'Gal B', 'dec': [{'value': 2, 'best': 1, 'reference': ''}]}, validate=False)
+    assert new_db.db.modified() == ['Gal B']
+    written = new_db.save_all(out_dir=data_dir, modified_only=True, workers=workers)
+    assert written == [os.path.join(data_dir, 'Gal_B.json')]
+    assert new_db.db.modified() == []
+    assert new_db.save_all(out_dir=data_dir, modified_only=True, workers=workers) == []
+    assert not [f for f in os.listdir(data_dir) if f.startswith('.tmp_')]
+
+    # By default every document is converted, but only files whose contents change are written
+    # (here the hand-written files of the other documents, which are reformatted)
+    written = new_db.save_all(out_dir=data_dir, workers=workers)
+    assert written == [os.path.join(data_dir, 'Gal_A.json'), os.path.join(data_dir, 'Gal_C.json')]
+    assert new_db.save_all(out_dir=data_dir, workers=workers) == []
+
+    # Documents edited in place are only saved by default
+    new_db.query_db({'name': 'Gal C'})[0]['ra'][0]['value'] = 3
+    assert new_db.save_all(out_dir=data_dir, modified_only=True, workers=workers) == []
+    assert new_db.save_all(out_dir=data_dir, workers=workers) == [os.path.join(data_dir, 'Gal_C.json')]
+
+    reloaded = Database(directory=data_dir, references_file='galcat/tests/test_references.json')
+    assert reloaded.query_db({'name': 'Gal B'})[0]['dec'][0]['value'] == 2
+
+    # Exporting to a new directory writes everything once; byte-identical files are not rewritten
+    out_dir = os.path.join(data_dir, 'export')
+    os.mkdir(out_dir)
+    assert len(new_db.save_all(out_dir=out_dir, workers=workers)) == 3
+    assert reloaded.save_all(out_dir=out_dir, workers=workers) == []
+
+
+def test_lazy_loading(tmpdir):
+    data_dir = str(tmpdir)
+    for i in range(20):
+        with open(os.path.join(data_dir, 'Gal_{}.json'.format(i)), 'w') as f:
+            f.write('{"name": "Gal %d", "ra": [{"value": %d, "best": 1, "reference": ""}]}' % (i, i))
+
+    lazy_db = Database(directory=data_dir, references_file='galcat/tests/test_references.json', lazy=True,
+                       memory_budget=500)
+    with pytest.raises(RuntimeError):
+        Database(directory=data_dir, references_file='galcat/tests/test_references.json', lazy=True,
+                 snapshot_file=os.path.join(data_dir, 'snapshot.pkl'))
+    assert lazy_db.load_report.n_deferred == 20
+    assert lazy_db.db.n_reads == 0
+    assert os.path.exists(os.path.join(data_dir, '.galcat_manifest.json'))
+
+    # Looking up by name only reads that document
+    doc = lazy_db.query_db({'name': 'Gal 3'})[0]
+    assert doc['ra'][0]['value'] == 3 and isinstance(doc['ra'], np.ndarray)
+    assert lazy_db.db.n_reads == 1
+
+    # Scans read everything but keep within the budget, without an array of all documents
+    def no_array():
+        raise AssertionError('as_array used for a scan')
+    lazy_db.db.as_array = no_array
+    assert len(lazy_db.query_db({'ra.value': {'$gte': 10}})) == 10
+    del lazy_db.db.as_array
+    assert lazy_db.db.resident_bytes <= 500
+    assert len(lazy_db.query_table({})) == 20
+
+    # The columnar engine would keep every document, so the manual engine is used under a budget
+    query = {'ra.value': {'$lt': 5}}
+    assert [d['name'] for d in lazy_db.query_db(query, engine='columnar')] == \
+        [d['name'] for d in lazy_db.query_db(query)]
+    assert lazy_db.columns._docs is None
+    assert lazy_db.db.resident_bytes <= 500
+
+    # Changes are kept and saved
+    lazy_db.add_data({'name': 'Gal 5', 'dec': [{'value': 2, 'best': 1, 'reference': ''}]}, validate=False)
+    lazy_db.query_db({'ra.value': {'$gte': 0}})
+    assert lazy_db.query_db({'name': 'Gal 5'})[0]['dec'][0]['value'] == 2
+    assert lazy_db.save_all(out_dir=data_dir, modified_only=True) == [os.path.join(data_dir, 'Gal_5.json')]
+
+    # The manifest is reused; only the changed file is opened to refresh it
+    reloaded = Database(directory=data_dir, references_file='galcat/tests/test_references.json', lazy=True)
+    assert reloaded.db.n_reads == 0
+    assert reloaded.query_db({'name': 'Gal 5'})[0]['dec'][0]['value'] == 2
+    assert reloaded.db.names() == lazy_db.db.names()
+
+    with pytest.raises(RuntimeError):
+        db.load_manifest(data_dir)
+
+
 def test_recursive_json_fix():
     doc = {"name": "Gal 3",
            "ebv": [{"value": 0.2, "best": 1, "reference": "Bellazzini_2006_1"},
@@ -277,6 +721,19 @@ def test_recursive_json_fix():
     assert len(newdoc['ebv']) == 3
 
 
+def test_list_to_array():
+    result = _list_to_array([{'a': 1}, {'a': 2}])
+    assert result.dtype == object and len(result) == 2
+
+    result = _list_to_array([1, 2, 3])
+    assert result.dtype == float
+    assert _list_to_array([]).dtype == float
+
+    # Nested arrays are flattened, as with np.append
+    result = _list_to_array([{'a': 1}, np.array([2., 3.])])
+    assert len(result) == 3 and result[0] == {'a': 1} and result[2] == 3
+
+
 def test_recursive_json_reverse_fix():
     doc = {"name": "Gal 3",
            "ebv": np.array([{"value": 0.2, "best": 1, "reference": "Bellazzini_2006_1"},
@@ -333,6 +790,19 @@ def test_distribution():
     df = db.query_table({'name': 'Gal 9'})
     assert df[['ebv']][0][0] == pytest.approx(1, abs=5e-2)
 
+    median = np.median(doc['ebv'][0]['distribution'])
+    df = db.query_table({'name': 'Gal 9'}, distribution_summary='median')
+    assert df['ebv'][0] == pytest.approx(median)
+    with pytest.raises(RuntimeError):
+        db.query_table({'name': 'Gal 9'}, distribution_summary='mode')
+
+    db32 = Database(directory='galcat/tests/test_data', references_file='galcat/tests/test_references.json',
+                    distribution_dtype=np.float32)
+    db32.load_file_to_db(doc)
+    assert db32.query_db({'name': 'Gal 9'})[0]['ebv'][0]['distribution'].dtype == np.float32
+    df32 = db32.query_table({'name': 'Gal 9'}, distribution_summary='median')
+    assert df32['ebv'][0] == pytest.approx(median, rel=1e-6)
+
     # Queries against distribution only work with MongoDB implementation
     if USE_MONGO:
         docs = db.query({'ebv.distribution': {'$lte': 1}})
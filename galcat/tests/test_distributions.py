@@ -0,0 +1,57 @@
+# Unit tests for distributions.py
+import gc
+import numpy as np
+import pytest
+from astropy import uncertainty as unc
+from galcat.distributions import summarize_distributions, DistributionCache
+
+
+def make_distributions():
+    rng = np.random.default_rng(12345)
+    return [rng.normal(1, 0.2, size=n) for n in [1, 2, 7, 100]] + [[1., 2., 4.], []]
+
+
+def test_summarize_mean():
+    distributions = make_distributions()
+    summary = summarize_distributions(distributions)
+    for distribution, value, error in zip(distributions[:-1], summary['value'], summary['error']):
+        samples = unc.Distribution(np.asarray(distribution))
+        assert value == pytest.approx(samples.pdf_mean())
+        assert error == pytest.approx(samples.pdf_std())
+    assert np.isnan(summary['value'][-1]) and np.isnan(summary['error'][-1])
+
+
+def test_summarize_median():
+    distributions = make_distributions() + [[1., np.nan, 3.], ['a', 'b']]
+    summary = summarize_distributions(distributions, statistic='median')
+    for distribution, value, lower, upper in zip(distributions[:-3], summary['value'], summary['error_lower'],
+                                                 summary['error_upper']):
+        median = np.median(distribution)
+        assert value == pytest.approx(median)
+        assert lower == pytest.approx(median - np.percentile(distribution, 16))
+        assert upper == pytest.approx(np.percentile(distribution, 84) - median)
+    assert np.isnan(summary['value'][-3:]).all()
+
+    summary32 = summarize_distributions(distributions[:-3], statistic='median', dtype=np.float32)
+    assert summary32['value'] == pytest.approx(summary['value'][:-3], rel=1e-6)
+
+    with pytest.raises(RuntimeError):
+        summarize_distributions(distributions, statistic='mode')
+
+
+def test_distribution_cache():
+    cache = DistributionCache()
+    distributions = [np.array([1., 2., 3.]), np.array([2., 4.]), [5., 7.]]
+    summary = cache.summarize(distributions)
+    assert list(summary['value']) == [2., 3., 6.]
+    assert len(cache) == 2  # lists are not cached
+
+    # Cached values are reused, new statistics are computed separately
+    cache._entries[(id(distributions[0]), 'mean')] = (cache._entries[(id(distributions[0]), 'mean')][0], (99., 0.))
+    assert cache.summarize(distributions[:1])['value'][0] == 99.
+    assert list(cache.summarize(distributions, 'median')['value']) == [2., 3., 6.]
+    assert len(cache) == 4
+
+    del distributions[0]
+    gc.collect()
+    assert len(cache) == 2
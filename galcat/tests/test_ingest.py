@@ -0,0 +1,125 @@
+# Unit tests for ingest.py
+import os
+import json
+import numpy as np
+from galcat.core import Database
+from galcat.ingest import read_nearby_galaxies, build_documents, ingest_nearby_galaxies, sync_nearby_galaxies
+
+DAT_FILE = os.path.join(os.path.dirname(__file__), '..', '..', 'input', 'NearbyGalaxies.dat')
+
+
+def _sample(tmp_path, n_lines=37 + 10):
+    # First galaxies of NearbyGalaxies.dat, header included
+    with open(DAT_FILE, 'r') as f:
+        lines = [line for _, line in zip(range(n_lines), f)]
+    filename = str(tmp_path / 'NearbyGalaxies.dat')
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+    return filename, lines[37:]
+
+
+def test_build_documents(tmp_path):
+    filename, lines = _sample(tmp_path)
+    docs = build_documents(read_nearby_galaxies(filename))
+    assert len(docs) == len(lines)
+
+    for doc, line in zip(docs, lines):
+        name = line[:19].strip()
+        assert doc['name'] == (name[1:] if name.startswith('*') else name)
+        assert doc['ra'][0] == {'value': round(15 * (float(line[19:21]) + float(line[22:24]) / 60. +
+                                                     float(line[25:29]) / 3600.), 5),
+                                'best': 1, 'reference': '', 'unit': 'deg'}
+        assert list(doc.keys())[:4] == ['name', 'ra', 'dec', 'ebv']
+        # Sentinel values are dropped, others are kept with their errors
+        value, err_upp = float(line[46:51]), float(line[53:56])
+        if (value, err_upp) in [(99.99, 9.99), (99.9, 9.9), (9.9, 9.9), (99.0, 9.0), (9.99, 9.99)]:
+            assert 'distance_modulus' not in doc
+        else:
+            assert doc['distance_modulus'][0]['value'] == value
+            assert doc['distance_modulus'][0]['error_upper'] == err_upp
+            assert doc['distance_modulus'][0]['error_lower'] == float(line[58:61])
+
+
+def test_ingest_to_database(tmp_path):
+    filename, lines = _sample(tmp_path)
+    out_dir = tmp_path / 'data'
+    out_dir.mkdir()
+    db = Database(directory=str(out_dir))
+    docs = ingest_nearby_galaxies(filename, db=db, out_dir=str(out_dir))
+
+    assert len(db.db) == len(docs)
+    assert db.query_db({'name': docs[0]['name']})[0]['ra'][0]['value'] == docs[0]['ra'][0]['value']
+    assert isinstance(db.db.get(docs[0]['name'])['ra'], np.ndarray)
+    assert db.db.modified() == []  # JSON files written alongside
+
+    out_file = out_dir / (docs[0]['name'].replace(' ', '_') + '.json')
+    with open(str(out_file), 'r') as f:
+        assert json.load(f) == docs[0]
+
+    # Rerunning does not rewrite unchanged files
+    mtime = os.path.getmtime(str(out_file))
+    os.utime(str(out_file), (mtime - 100, mtime - 100))
+    ingest_nearby_galaxies(filename, out_dir=str(out_dir))
+    assert os.path.getmtime(str(out_file)) == mtime - 100
+
+    # Documents only, without the per-file JSON
+    db = Database(directory=str(out_dir))
+    empty_dir = tmp_path / 'empty'
+    empty_dir.mkdir()
+    ingest_nearby_galaxies(filename, db=db, out_dir=str(empty_dir), write_json=False)
+    assert os.listdir(str(empty_dir)) == []
+    assert len(db.db) == len(docs)
+
+
+def test_sync(tmp_path):
+    filename, lines = _sample(tmp_path)
+    out_dir = tmp_path / 'data'
+    out_dir.mkdir()
+    docs = ingest_nearby_galaxies(filename, out_dir=str(out_dir))
+    name = docs[1]['name']
+    state_file = str(tmp_path / 'state.json')
+
+    # Curated measurement from another reference
+    db = Database(directory=str(out_dir))
+    db.add_data({'name': name, 'ebv': [{'value': 0.5, 'best': 0, 'reference': 'Curated_2020'}]}, validate=False)
+    db.save_all(out_dir=str(out_dir))
+
+    # Nothing to do for an unchanged table
+    changes = sync_nearby_galaxies(db, filename, state_file=state_file, save_dir=str(out_dir))
+    assert len(changes) == 0
+    assert changes.written == []
+
+    # Change the distance modulus of one galaxy upstream
+    header = open(filename).readlines()[:37]
+    row = lines[1]
+    new_value = '{:5.2f}'.format(float(row[46:51]) + 0.5)
+    lines[1] = row[:46] + new_value + row[51:]
+    with open(filename, 'w') as f:
+        f.writelines(header + lines)
+
+    changes = sync_nearby_galaxies(db, filename, state_file=state_file, save_dir=str(out_dir))
+    assert changes.n_unchanged == len(lines) - 1
+    assert changes.names() == [name]
+    assert [entry[:3] for entry in changes.entries] == [(name, 'distance_modulus', 'updated')]
+    assert len(changes.written) == 1
+
+    doc = db.query_db({'name': name})[0]
+    assert doc['distance_modulus'][0]['value'] == float(new_value)
+    assert [m['reference'] for m in doc['ebv']] == ['', 'Curated_2020']
+    with open(changes.written[0], 'r') as f:
+        assert json.load(f)['distance_modulus'][0]['value'] == float(new_value)
+
+    # Galaxies that disappear upstream are reported but kept
+    with open(filename, 'w') as f:
+        f.writelines(header + lines[:-1])
+    changes = sync_nearby_galaxies(db, filename, state_file=state_file, save_dir=str(out_dir))
+    assert [entry[:3] for entry in changes.entries] == [(docs[-1]['name'], None, 'dropped')]
+    assert changes.written == []
+    assert '0 galaxies new, 0 changed, 1 dropped upstream' in changes.summary()
+    assert len(db.query_db({'name': docs[-1]['name']})) == 1
+
+    # A new galaxy is loaded as a new document
+    db.db.remove(docs[0]['name'])
+    changes = sync_nearby_galaxies(db, filename)
+    assert (docs[0]['name'], None, 'new') in [entry[:3] for entry in changes.entries]
+    assert len(db.query_db({'name': docs[0]['name']})) == 1
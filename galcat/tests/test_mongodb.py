@@ -0,0 +1,141 @@
+# Tests of the MongoDB backend against mongomock
+import os
+import pytest
+import numpy as np
+from galcat.core import Database
+
+mongomock = pytest.importorskip('mongomock')
+pytest.importorskip('pymongo')
+
+
+def make_db():
+    return Database(mongo_client=mongomock.MongoClient(), mongo_db_name='GalaxyCat',
+                    collection_name='galaxies_test')
+
+
+def test_load_all_bulk(tmpdir):
+    for name in ['Gal A', 'Gal B', 'Gal C']:
+        with open(os.path.join(tmpdir, name.replace(' ', '_') + '.json'), 'w') as f:
+            f.write('{"name": "%s", "ra": [{"value": 1, "best": 1, "reference": ""}]}' % name)
+    with open(os.path.join(tmpdir, 'No_name.json'), 'w') as f:
+        f.write('{"ra": [{"value": 1, "best": 1, "reference": ""}]}')
+
+    db = make_db()
+    assert db.use_mongodb
+    report = db.load_all(str(tmpdir), batch_size=2)
+    assert report.n_files == 4
+    assert report.n_loaded == 3
+    assert len(report.failures) == 1 and report.failures[0][0].endswith('No_name.json')
+    assert db.db.count_documents({}) == 3
+
+    index_info = db.db.index_information()
+    assert any(info['key'] == [('name', 1)] and info.get('unique') for info in index_info.values())
+
+    # Loading again replaces rather than duplicates
+    with open(os.path.join(tmpdir, 'Gal_A.json'), 'w') as f:
+        f.write('{"name": "Gal A", "ra": [{"value": 12.5, "best": 1, "reference": ""}]}')
+    db.load_all(str(tmpdir), batch_size=10)
+    assert db.db.count_documents({}) == 3
+    assert db.db.find_one({'name': 'Gal A'})['ra'][0]['value'] == 12.5
+
+
+def test_load_documents():
+    db = make_db()
+    docs = [{'name': 'Gal A', 'ra': [{'value': 1, 'best': 1, 'reference': ''}]},
+            {'name': 'Gal B', 'ra': [{'value': 2, 'best': 1, 'reference': ''}]},
+            {'ra': [{'value': 3, 'best': 1, 'reference': ''}]}]
+    report = db.load_documents(docs, batch_size=2)
+    assert report.n_files == 3
+    assert report.n_loaded == 2
+    assert len(report.failures) == 1
+    assert db.db.find_one({'name': 'Gal B'})['ra'][0]['value'] == 2
+
+
+def test_bulk_replace_keeps_last_duplicate():
+    db = make_db()
+    docs = [{'name': 'Gal A', 'x': 1}, {'name': 'Gal B', 'x': 2}, {'name': 'Gal A', 'x': 3}]
+    assert db._bulk_replace(db.db, docs, 'name', batch_size=10) == []
+    assert db.db.count_documents({}) == 2
+    assert db.db.find_one({'name': 'Gal A'})['x'] == 3
+
+
+def test_update_references_mongodb():
+    db = make_db()
+    db.update_references_mongodb('galcat/tests/test_references.json', batch_size=1)
+    db.update_references_mongodb('galcat/tests/test_references.json')
+    assert db.references.count_documents({}) == 2
+    assert len(db.query_reference({'key': 'Bellazzini_2006_1'})) == 1
+    index_info = db.references.index_information()
+    assert any(info['key'] == [('key', 1)] and info.get('unique') for info in index_info.values())
+
+
+def test_projection_and_iter_query():
+    db = make_db()
+    db.update_references_mongodb('galcat/tests/test_references.json')
+    db.load_all('galcat/tests/test_data')
+    local_db = Database(directory='galcat/tests/test_data', references_file='galcat/tests/test_references.json')
+
+    doc = db.query_db({'name': 'Gal 1'}, projection=['ebv'])[0]
+    assert set(doc.keys()) == {'_id', 'name', 'ebv'}
+    assert isinstance(doc['ebv'], np.ndarray)
+
+    docs = list(db.iter_query({}, projection={'ra.value': 1}, batch_size=1))
+    assert sorted(d['name'] for d in docs) == ['Gal 1', 'Gal 2']
+    assert all(list(m.keys()) == ['value'] for d in docs for m in d['ra'])
+
+    df = db.query_table({'name': 'Gal 1'}, columns=['ebv', 'ra'], add_coordinates=False)
+    local_df = local_db.query_table({'name': 'Gal 1'}, columns=['ebv', 'ra'], add_coordinates=False)
+    assert df.colnames == local_df.colnames == ['name', 'ra', 'ebv']
+    assert df['ra'][0] == local_df['ra'][0]
+
+
+@pytest.mark.parametrize('query, curation, columns', [
+    ({}, {}, None),
+    ({}, {'ra': 'FakeRef2019'}, None),
+    ({'name': 'Gal 1'}, {'ra': 'FakeRef2019', 'dec': 'NoSuchRef'}, ['ra', 'dec', 'ebv']),
+    ({'name': 'I DONT EXIST'}, {}, None),
+])
+def test_query_table_server_side(query, curation, columns):
+    db = make_db()
+    db.load_all('galcat/tests/test_data')
+    db.load_file_to_db({'name': 'Gal Dist', 'ra': [{'value': 5, 'best': 1, 'reference': '', 'unit': 'deg'}],
+                        'dec': [{'value': 2, 'best': 1, 'reference': '', 'unit': 'deg'}],
+                        'v_mag': [{'distribution': [1, 2, 3, 6], 'best': 1, 'reference': 'Ref_1', 'unit': 'mag'},
+                                  {'value': 4, 'best': 0, 'reference': 'Ref_2', 'unit': 'mag'}]})
+
+    kwargs = dict(curation=curation, columns=columns, add_coordinates=False)
+    tab = db.query_table(query, **kwargs)
+    server_tab = db.query_table(query, server_side=True, **kwargs)
+    assert server_tab is not tab
+    assert server_tab.colnames == tab.colnames
+    for name in tab.colnames:
+        if name == '_id':
+            continue
+        assert getattr(server_tab[name], 'unit', None) == getattr(tab[name], 'unit', None)
+        assert np.all(server_tab[name] == tab[name])
+
+
+def test_query_table_cache_disabled():
+    # Other clients may write to the collection, so tables are not cached unless asked for
+    client = mongomock.MongoClient()
+    db = Database(mongo_client=client, mongo_db_name='GalaxyCat', collection_name='galaxies_test')
+    db.load_all('galcat/tests/test_data')
+    t1 = db.query_table({'name': 'Gal 1'}, add_coordinates=False)
+    client['GalaxyCat']['galaxies_test'].update_one({'name': 'Gal 1'}, {'$set': {'ebv.0.value': 0.5}})
+    t2 = db.query_table({'name': 'Gal 1'}, add_coordinates=False)
+    assert t2 is not t1 and t2['ebv'][0] == 0.5
+
+    db = Database(mongo_client=client, mongo_db_name='GalaxyCat', collection_name='galaxies_test',
+                  table_cache_size=4)
+    assert db.query_table({'name': 'Gal 1'}, copy=False) is db.query_table({'name': 'Gal 1'}, copy=False)
+
+
+def test_cone_search():
+    import astropy.units as u
+    from astropy.coordinates import SkyCoord
+    db = make_db()
+    db.load_all('galcat/tests/test_data')
+    docs = db.cone_search(SkyCoord(9.14542 * u.deg, 49.64667 * u.deg), 1 * u.deg)
+    assert [d['name'] for d in docs] == ['Gal 1']
+    matches = db.crossmatch(SkyCoord([10.4] * u.deg, [-32.4] * u.deg), 1 * u.arcmin)
+    assert list(matches['name']) == ['Gal 2']
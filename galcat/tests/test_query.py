@@ -0,0 +1,65 @@
+# Unit tests for query.py
+import re
+import numpy as np
+import pytest
+from galcat.query import compile_query, And
+
+DOCS = [
+    {'name': 'Gal A', 'tags': ['dwarf', 'satellite'],
+     'v_mag': np.array([{'value': 16.2, 'best': 1, 'reference': 'Ref_1'},
+                        {'value': 'unknown', 'best': 0, 'reference': 'Ref_2'}])},
+    {'name': 'Gal B', 'tags': ['spiral'],
+     'v_mag': np.array([{'value': 20.2, 'best': 1, 'reference': 'Ref_2', 'note': None}]),
+     'ebv': np.array([{'value': 0.1, 'best': 1, 'reference': 'Ref_1'}])},
+    {'name': 'Gal C', 'ebv': np.array([{'value': 0.3, 'best': 1, 'reference': 'Ref_3'}])},
+]
+
+QUERIES = [
+    ({'v_mag.value': {'$gt': 16}}, ['Gal A', 'Gal B']),
+    ({'v_mag.value': {'$gt': 16, '$lt': 20}}, ['Gal A']),
+    ({'v_mag.value': 'unknown'}, ['Gal A']),
+    ({'v_mag.value': {'$ne': 16.2}}, ['Gal B', 'Gal C']),
+    ({'v_mag.reference': {'$in': ['Ref_2', 'Ref_9']}}, ['Gal A', 'Gal B']),
+    ({'v_mag.reference': {'$nin': ['Ref_2']}}, ['Gal C']),
+    ({'name': {'$regex': '^gal [ab]$', '$options': 'i'}}, ['Gal A', 'Gal B']),
+    ({'name': re.compile('C$')}, ['Gal C']),
+    ({'ebv': {'$exists': False}}, ['Gal A']),
+    ({'v_mag.note': None}, ['Gal A', 'Gal B', 'Gal C']),
+    ({'v_mag.note': {'$exists': True}}, ['Gal B']),
+    ({'tags': 'dwarf'}, ['Gal A']),
+    ({'tags': ['spiral']}, ['Gal B']),
+    ({'$and': [{'v_mag.value': {'$exists': True}}, {'ebv.value': {'$lt': 0.2}}]}, ['Gal B']),
+    ({'$or': [{'name': 'Gal A'}, {'ebv.value': {'$gte': 0.3}}]}, ['Gal A', 'Gal C']),
+    ({'$nor': [{'name': 'Gal A'}, {'ebv.value': {'$gte': 0.3}}]}, ['Gal B']),
+    ({'v_mag': {'$elemMatch': {'reference': 'Ref_2', 'best': 1}}}, ['Gal B']),
+    ({'v_mag': {'$elemMatch': {'value': {'$gt': 16}, 'reference': 'Ref_1'}}}, ['Gal A']),
+    ({'tags': {'$elemMatch': {'$regex': '^sat'}}}, ['Gal A']),
+    ({'v_mag.value': {'$not': {'$gt': 17}}}, ['Gal A', 'Gal C']),
+    ({}, ['Gal A', 'Gal B', 'Gal C']),
+]
+
+
+@pytest.mark.parametrize('query, names', QUERIES)
+def test_compile_query(query, names):
+    assert [doc['name'] for doc in compile_query(query).filter(DOCS)] == names
+
+
+def test_compile_query_errors():
+    for query in [{'$where': 'x'}, {'v_mag.value': {'$near': 1}}, {'$or': []}, {'name': {'$in': 'Gal A'}}]:
+        with pytest.raises(RuntimeError):
+            compile_query(query)
+
+
+def test_selective_predicates_first():
+    predicate = compile_query({'v_mag.value': {'$ne': 1}, 'ebv.value': {'$gt': 0}, 'name': 'Gal A'})
+    assert isinstance(predicate, And)
+    assert [p.db_operator for p in predicate.children] == ['$eq', '$gt', '$ne']
+
+
+@pytest.mark.parametrize('query, names', QUERIES)
+def test_matches_mongodb(query, names):
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient().db.galaxies
+    collection.insert_many([{k: (v.tolist() if isinstance(v, np.ndarray) else v) for k, v in doc.items()}
+                            for doc in DOCS])
+    assert sorted(doc['name'] for doc in collection.find(query)) == names
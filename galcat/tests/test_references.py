@@ -0,0 +1,181 @@
+# Unit tests for references.py
+import os
+import time
+import json
+from galcat.core import Database
+from galcat.references import ReferenceResolver, FakeBackend, RateLimiter, reference_key
+from galcat.references import parse_reference, iter_references, write_references_json
+
+PAPERS = [
+    {'bibcode': '2006MNRAS.366..865B', 'doi': '10.1111/j.1365-2966.2005.09973.x', 'year': '2006',
+     'title': 'The core of the Canis Major galaxy as traced by red clump stars',
+     'author': ['Bellazzini, M.', 'Ibata, R.']},
+    {'bibcode': '1994Natur.370..194I', 'doi': '10.1038/370194a0', 'year': '1994',
+     'title': 'A Dwarf Satellite Galaxy in Sagittarius', 'author': ['Ibata, R. A.']},
+    {'bibcode': '2005A', 'doi': '', 'year': '2005', 'title': 'Twin', 'author': ['Martin, N. F.']},
+    {'bibcode': '2005B', 'doi': '', 'year': '2005', 'title': 'Twin', 'author': ['Martin, N.']},
+]
+
+
+def make_refs():
+    return [{'key': 'Bellazzini_2006_1', 'year': 2006, 'doi': '', 'bibcode': '', 'authors': ['Bellazzini, M.'],
+             'title': 'The core of the  Canis Major galaxy as traced by red clump stars'},
+            {'key': 'Ibata_1994_4', 'year': 1994, 'doi': '', 'bibcode': '', 'authors': ['Ibata, R. A.'],
+             'title': 'A Dwarf Satellite Galaxy in Sagittarius'},
+            {'key': 'Martin_2005_2', 'year': 2005, 'doi': '', 'bibcode': '', 'authors': ['Martin, N. F.'],
+             'title': 'Twin'},
+            {'key': 'Nobody_2010_3', 'year': 2010, 'doi': '', 'bibcode': '', 'authors': ['Nobody, A.'],
+             'title': 'Unknown'},
+            {'key': 'Done_2000_5', 'year': 2000, 'doi': 'x', 'bibcode': 'y', 'authors': ['Done, A.'], 'title': 'Done'}]
+
+
+def test_reference_key():
+    ref = make_refs()[0]
+    assert reference_key(ref) == 'bellazzini|2006|the core of the canis major galaxy as traced by red clump stars'
+
+
+def test_resolve_and_cache(tmpdir):
+    cache_file = os.path.join(str(tmpdir), 'cache.json')
+    backend = FakeBackend(PAPERS)
+    refs = make_refs()
+    summary = ReferenceResolver(backend, cache_file=cache_file, workers=3, rate_limit=None).resolve(refs)
+    assert summary == {'updated': 2, 'ambiguous': 1, 'not_found': 1, 'failed': 0, 'searches': 4}
+    assert refs[0]['bibcode'] == '2006MNRAS.366..865B'
+    assert refs[1]['doi'] == '10.1038/370194a0'
+    assert refs[2]['bibcode'] == ''
+    assert len(backend.calls) == 4  # complete references are not searched
+
+    with open(cache_file, 'r') as f:
+        assert len(json.load(f)) == 4
+
+    # A new run with the same cache does no searches
+    backend = FakeBackend(PAPERS)
+    refs = make_refs()
+    summary = ReferenceResolver(backend, cache_file=cache_file).resolve(refs)
+    assert backend.calls == []
+    assert summary['updated'] == 2 and summary['searches'] == 0
+    assert refs[0]['bibcode'] == '2006MNRAS.366..865B'
+
+
+def test_resolve_without_title():
+    # Short citations have no title; a unique match by author and year also fills it in
+    refs = [{'key': 'Ibata_1994_1', 'year': 1994, 'doi': '', 'bibcode': '', 'authors': ['Ibata, R. A.'], 'title': ''}]
+    summary = ReferenceResolver(FakeBackend(PAPERS), rate_limit=None).resolve(refs)
+    assert summary['updated'] == 1
+    assert refs[0]['bibcode'] == '1994Natur.370..194I'
+    assert refs[0]['title'] == 'A Dwarf Satellite Galaxy in Sagittarius'
+
+
+def test_failed_searches_are_retried():
+    class FlakyBackend(FakeBackend):
+        def search(self, first_author, year, title):
+            result = FakeBackend.search(self, first_author, year, title)
+            if first_author.startswith('Ibata') and len(self.calls) < 5:
+                raise IOError('timeout')
+            return result
+
+    backend = FlakyBackend(PAPERS)
+    resolver = ReferenceResolver(backend, rate_limit=None, batch_size=2)
+    summary = resolver.resolve(make_refs())
+    assert summary['failed'] == 1 and summary['updated'] == 1
+
+    summary = resolver.resolve(make_refs())
+    assert summary['failed'] == 0 and summary['updated'] == 2 and summary['searches'] == 1
+
+
+def test_concurrency_and_rate_limit():
+    backend = FakeBackend(PAPERS, delay=0.05)
+    refs = [dict(make_refs()[3], title='Unknown {}'.format(i)) for i in range(8)]
+    start = time.perf_counter()
+    ReferenceResolver(backend, workers=8, rate_limit=None).resolve(refs)
+    assert time.perf_counter() - start < 0.05 * 8 / 2
+    assert len(backend.calls) == 8
+
+    limiter = RateLimiter(rate=100.)
+    start = time.perf_counter()
+    for _ in range(6):
+        limiter.wait()
+    assert time.perf_counter() - start >= 0.045
+
+
+REFERENCES_DAT = """[1]Bellazzini, M., Ibata, R., Martin, N., Lewis, G. F., Conn, B., and Irwin, M. J. The core
+of the Canis Major galaxy as traced by red clump stars. MNRAS 366, 865–883
+March (2006).
+[2]Simon, J. D. and Geha, M. The Kinematics of the Ultra-faint Milky Way Satellites:
+Solving the Missing Satellite Problem. ApJ 670, 313–331 November (2007).
+[3]Pe˜narrubia, J., Zucker, D. B., and Corwin, Jr., H. G. No Evidence for Internal Rotation.
+ApJ 727, L2 January (2011).
+[4] Kirby, E.~N., Cohen, J.~G., \\& Bellazzini, M.\\ 2012, \\apj, 751, 46
+[5] Bellazzini, M., Sand, D.~J., Crnojevi{\\'c}, D., et al.\\ 2006, arXiv:1508.01800
+"""
+
+
+def write_dat(tmpdir, text=REFERENCES_DAT):
+    filename = os.path.join(str(tmpdir), 'References.dat')
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return filename
+
+
+def test_parse_reference(tmpdir):
+    refs = list(iter_references(write_dat(tmpdir)))
+    assert [ref['key'] for ref in refs] == ['Bellazzini_2006_1', 'Simon_2007_1', 'Penarrubia_2011_1',
+                                            'Kirby_2012_1', 'Bellazzini_2006_2']
+
+    assert refs[0]['authors'][-1] == 'Irwin, M. J.' and len(refs[0]['authors']) == 6
+    assert refs[0]['title'] == 'The core of the Canis Major galaxy as traced by red clump stars'
+    assert (refs[0]['journal'], refs[0]['volume'], refs[0]['pages'], refs[0]['year']) == \
+        ('MNRAS', '366', '865–883', 2006)
+    assert refs[1]['authors'] == ['Simon, J. D.', 'Geha, M.']
+    assert refs[1]['title'].endswith('Solving the Missing Satellite Problem')
+    assert refs[2]['authors'] == ['Peñarrubia, J.', 'Zucker, D. B.', 'Corwin, Jr., H. G.']
+
+    assert refs[3]['authors'] == ['Kirby, E. N.', 'Cohen, J. G.', 'Bellazzini, M.']
+    assert (refs[3]['journal'], refs[3]['volume'], refs[3]['pages'], refs[3]['year']) == ('ApJ', '751', '46', 2012)
+    assert refs[4]['authors'] == ['Bellazzini, M.', 'Sand, D. J.', 'Crnojević, D.']
+    assert refs[4]['journal'] == 'arXiv:1508.01800'
+
+    assert parse_reference(7, 'Irwin, M.J., et al. in preparation')['year'] is None
+
+
+def test_parse_reference_grave_accent(tmpdir):
+    text = ("[1]de Jong, J. T. A., Martin, N. F., and Macci`o, A. V. Grave Accents. ApJ 1, 1 May (2008).\n"
+            "[2] Kirby, E.~N., and Macci\\`o, A.~V.\\ 2009, \\apj, 1, 2\n")
+    refs = list(iter_references(write_dat(tmpdir, text)))
+    assert refs[0]['authors'][-1] == 'Macciò, A. V.'
+    assert refs[1]['authors'] == ['Kirby, E. N.', 'Macciò, A. V.']
+
+
+def test_write_references_json(tmpdir):
+    dat_file = write_dat(tmpdir)
+    out_file = os.path.join(str(tmpdir), 'references.json')
+    with open(out_file, 'w') as f:
+        json.dump([{'key': 'Simon_2007_1', 'doi': '10.1086/521816', 'bibcode': '2007ApJ...670..313S'},
+                   {'key': 'Kirby_2012_1', 'title': 'Hand-added title', 'doi': ''},
+                   {'key': 'Added_2020_1', 'id': 99, 'year': 2020, 'title': 'Not in References.dat'}], f)
+
+    db = Database(directory='galcat/tests/test_data', references_file='galcat/tests/test_references.json')
+    version = db.version
+    assert write_references_json(dat_file, out_file, db=db) == 6
+
+    with open(out_file, 'r', encoding='utf-8') as f:
+        refs = json.load(f)
+    assert [ref['id'] for ref in refs] == [1, 2, 3, 4, 5, 99]
+    assert list(refs[0].keys())[:8] == ['key', 'id', 'year', 'doi', 'bibcode', 'authors', 'journal', 'title']
+    assert refs[1]['bibcode'] == '2007ApJ...670..313S'  # identifiers carried over by key
+
+    # Fields set by hand win over the parsed ones and references not in References.dat are kept
+    assert refs[3]['title'] == 'Hand-added title' and refs[3]['journal'] == 'ApJ'
+    assert refs[5]['key'] == 'Added_2020_1'
+    assert write_references_json(dat_file, out_file, merge=False) == 5
+
+    assert db.version > version
+    assert len(db.references) == 6
+    assert db.query_reference({'key': 'Kirby_2012_1'})[0]['id'] == 4
+    assert len(db.query_db({})) > 0  # data documents are kept
+
+    # An empty file gives an empty list
+    write_dat(tmpdir, '')
+    assert write_references_json(dat_file, out_file, merge=False) == 0
+    with open(out_file, 'r') as f:
+        assert json.load(f) == []
@@ -0,0 +1,76 @@
+# Unit tests for spatial.py
+import numpy as np
+import pytest
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+from galcat import spatial
+from galcat.spatial import SpatialIndex
+from galcat.core import Database
+
+
+def make_doc(name, ra, dec, ra_unit='deg'):
+    return {'name': name,
+            'ra': np.array([{'value': ra, 'best': 1, 'reference': '', 'unit': ra_unit},
+                            {'value': ra + 50, 'best': 0, 'reference': 'Other'}]),
+            'dec': np.array([{'value': dec, 'best': 1, 'reference': '', 'unit': 'deg'}])}
+
+
+@pytest.fixture(params=['tree', 'brute_force'])
+def index(request, monkeypatch):
+    if request.param == 'brute_force':
+        monkeypatch.setattr(spatial, 'cKDTree', None)
+        monkeypatch.setattr(spatial, 'CHUNK_SIZE', 5)
+    elif spatial.cKDTree is None:
+        pytest.skip('scipy is not installed')
+
+    index = SpatialIndex()
+    index.add('M31', make_doc('M31', 10.68458, 41.26917))
+    index.add('M33', make_doc('M33', 1.5641, 30.66, ra_unit='hourangle'))
+    index.add('LMC', make_doc('LMC', 80.89375, -69.75611))
+    index.add('No coords', {'name': 'No coords', 'ra': np.array([{'value': 'unknown', 'best': 1}])})
+    return index
+
+
+def test_cone_search(index):
+    assert len(index) == 3
+    m31 = SkyCoord(10.68458 * u.deg, 41.26917 * u.deg)
+    names, separations = index.cone_search(m31, 20 * u.deg)
+    assert list(names) == ['M31', 'M33']
+    assert separations[0].deg < 1e-6
+    assert abs(separations[1].deg - m31.separation(SkyCoord(1.5641 * u.hourangle, 30.66 * u.deg)).deg) < 1e-6
+
+    # Galactic input is converted to ICRS
+    names, _ = index.cone_search(m31.galactic, 1 * u.deg)
+    assert list(names) == ['M31']
+
+    index.remove('M31')
+    names, _ = index.cone_search(m31, 1 * u.deg)
+    assert len(names) == 0
+
+
+def test_crossmatch(index):
+    m31 = SkyCoord(10.68458 * u.deg, 41.26917 * u.deg)
+    catalog = SkyCoord([10.7, 200., 80.9, 10.68458] * u.deg, [41.27, 0., -69.7, 41.26917] * u.deg)
+    matches = index.crossmatch(catalog, 0.5 * u.deg)
+    assert list(matches['catalog_index']) == [0, 2, 3]
+    assert list(matches['name']) == ['M31', 'LMC', 'M31']
+    expected = catalog[0].separation(m31).to(u.deg)
+    assert abs(matches['separation'].quantity[0] - expected) < 1e-6 * u.deg
+
+    assert len(index.crossmatch(catalog, 1 * u.arcsec)) == 1
+
+
+def test_database_cone_search():
+    db = Database(directory='galcat/tests/test_data', references_file='galcat/tests/test_references.json')
+    center = SkyCoord(9.14542 * u.deg, 49.64667 * u.deg)
+    docs = db.cone_search(center, 1 * u.deg)
+    assert [d['name'] for d in docs] == ['Gal 1']
+
+    # The index follows updates
+    db.load_file_to_db(make_doc('Gal New', 9.5, 49.5))
+    assert [d['name'] for d in db.cone_search(center, 1 * u.deg)] == ['Gal 1', 'Gal New']
+    db.db.remove('Gal New')
+    assert len(db.cone_search(center, 1 * u.deg)) == 1
+
+    matches = db.crossmatch(SkyCoord([10.4, 0.] * u.deg, [-32.4, 0.] * u.deg), 1 * u.arcmin)
+    assert list(matches['name']) == ['Gal 2']
@@ -0,0 +1,182 @@
+# Unit tests for store.py
+import time
+import numpy as np
+from galcat.store import DocumentStore, LazyDocumentStore, SortedFieldIndex
+
+
+def test_upsert_and_get():
+    store = DocumentStore()
+    store.upsert({'name': 'Gal A', 'ra': np.array([{'value': 1}])})
+    store.upsert({'name': 'Gal B', 'ra': np.array([{'value': 2}])})
+    assert len(store) == 2
+    assert 'Gal A' in store
+    assert store.get('Gal B')['ra'][0]['value'] == 2
+    assert store.get('I DONT EXIST') is None
+
+    # Updating keeps the original position
+    store.upsert({'name': 'Gal A', 'ra': np.array([{'value': 3}])})
+    assert len(store) == 2
+    assert store.names() == ['Gal A', 'Gal B']
+    assert store['Gal A']['ra'][0]['value'] == 3
+
+
+def test_find_and_as_array():
+    store = DocumentStore()
+    assert len(store.find('Gal A')) == 0
+    assert len(store.as_array()) == 0
+
+    store.upsert({'name': 'Gal A'})
+    store.upsert({'name': 'Gal B'})
+    result = store.find('Gal B')
+    assert isinstance(result, np.ndarray)
+    assert result[0]['name'] == 'Gal B'
+
+    array = store.as_array()
+    assert array.dtype == object
+    assert [d['name'] for d in array] == ['Gal A', 'Gal B']
+    assert store.as_array() is array  # cached until modified
+
+
+def test_version_and_remove():
+    store = DocumentStore()
+    version = store.version
+    store.upsert({'name': 'Gal A'})
+    assert store.version > version
+
+    version = store.version
+    assert store.remove('Gal A')['name'] == 'Gal A'
+    assert store.version > version
+    assert store.remove('Gal A') is None
+    assert len(store) == 0
+
+
+def test_sorted_field_index():
+    store = DocumentStore()
+    store.upsert({'name': 'Gal A', 'v_mag': np.array([{'value': 16.2}, {'value': 20.1}])})
+    store.upsert({'name': 'Gal B', 'v_mag': np.array([{'value': 20.2}, {'value': 'unknown'}])})
+    store.upsert({'name': 'Gal C', 'ebv': np.array([{'value': 0.1}])})
+    index = store.create_index('v_mag.value')
+    assert len(index) == 4
+
+    assert store.index_lookup('v_mag.value', 16.2) == {'Gal A'}
+    assert store.index_lookup('v_mag.value', {'$gt': 20.1}) == {'Gal B'}
+    assert store.index_lookup('v_mag.value', {'$gte': 20.1}) == {'Gal A', 'Gal B'}
+    assert store.index_lookup('v_mag.value', {'$lt': 16.2}) == set()
+    assert store.index_lookup('v_mag.value', {'$lte': 16.2}) == {'Gal A'}
+    assert store.index_lookup('v_mag.value', 'unknown') == {'Gal B'}
+
+    # Not answerable from the index
+    assert store.index_lookup('v_mag.value', {'$exists': True}) is None
+    assert store.index_lookup('ebv.value', 0.1) is None
+
+    # Index follows updates, even when the stored document was modified in place
+    doc = store.get('Gal A')
+    doc['v_mag'] = np.array([{'value': 25.0}])
+    store.upsert(doc)
+    assert store.index_lookup('v_mag.value', {'$lt': 21}) == {'Gal B'}
+    assert store.index_lookup('v_mag.value', 25) == {'Gal A'}
+
+    store.remove('Gal A')
+    assert store.index_lookup('v_mag.value', 25) == set()
+    assert len(index) == 2
+
+    # Results come back in insertion order
+    assert [d['name'] for d in store.select({'Gal C', 'Gal B'})] == ['Gal B', 'Gal C']
+
+
+def test_sorted_field_index_low_cardinality():
+    # Many documents sharing a value are added and removed in close to linear time
+    index = SortedFieldIndex('ebv.value')
+    names = ['Gal {:06d}'.format(i) for i in range(30000)]
+    start = time.perf_counter()
+    for name in names:
+        index.add(name, {'ebv': [{'value': 0.1}]})
+    for name in names[::2]:
+        index.remove(name)
+    assert time.perf_counter() - start < 3
+    assert index.lookup(0.1) == set(names[1::2])
+    assert len(index) == 15000
+
+
+def test_reference_index():
+    store = DocumentStore()
+    store.upsert({'name': 'Gal A', 'ebv': np.array([{'value': 0.1, 'reference': 'Ref_1'}]),
+                  'v_mag': np.array([{'value': 20, 'reference': 'Ref_1'}, {'value': 21, 'reference': 'Ref_2'}])})
+    store.upsert({'name': 'Gal B', 'ebv': np.array([{'value': 0.2, 'reference': 'Ref_2'}])})
+    index = store.reference_index
+    assert index.fields('Ref_1') == {'ebv': {'Gal A'}, 'v_mag': {'Gal A'}}
+    assert index.fields('Ref_2') == {'v_mag': {'Gal A'}, 'ebv': {'Gal B'}}
+    assert index.fields('Ref_3') == {}
+
+    store.upsert({'name': 'Gal A', 'ebv': np.array([{'value': 0.1, 'reference': 'Ref_3'}])})
+    assert index.fields('Ref_1') == {}
+    assert index.fields('Ref_2') == {'ebv': {'Gal B'}}
+    assert sorted(index.references()) == ['Ref_2', 'Ref_3']
+
+    store.remove('Gal B')
+    assert index.fields('Ref_2') == {}
+
+
+def test_persisted_tracking():
+    store = DocumentStore()
+    store.upsert({'name': 'Gal A'})
+    store.upsert({'name': 'Gal B'})
+    assert store.modified() == ['Gal A', 'Gal B']
+
+    store.mark_persisted('Gal A', 'data/Gal_A.json', 'abc')
+    assert store.modified() == ['Gal B']
+    assert store.is_persisted('Gal A', 'data/Gal_A.json')
+    assert not store.is_persisted('Gal A', 'export/Gal_A.json')
+    assert store.persisted_digest('Gal A', 'data/Gal_A.json') == 'abc'
+
+    # Any update marks the document as modified again
+    store.upsert({'name': 'Gal A'})
+    assert store.modified() == ['Gal A', 'Gal B']
+    assert store.persisted_digest('Gal A', 'data/Gal_A.json') is None
+
+
+def test_lazy_store():
+    files = {'a.json': {'name': 'Gal A', 'v_mag': np.array([{'value': 20.0}])},
+             'b.json': {'name': 'Gal B', 'v_mag': np.array([{'value': 21.0}])},
+             'c.json': {'name': 'Gal C', 'v_mag': np.array([{'value': 22.0}])}}
+    reads = []
+
+    def loader(filename):
+        reads.append(filename)
+        return dict(files[filename])
+
+    store = LazyDocumentStore(loader, memory_budget=250)
+    for filename, doc in files.items():
+        store.register(doc['name'], filename, size=100)
+    assert len(store) == 3 and 'Gal B' in store and reads == []
+
+    assert store.get('Gal B')['v_mag'][0]['value'] == 21.0
+    assert reads == ['b.json']
+    assert store.get('Gal B') is store.get('Gal B')  # kept while in memory
+    assert store.modified() == []
+
+    # Reading a third document goes over the budget, dropping the least recently used one
+    store.get('Gal A')
+    store.get('Gal B')
+    store.get('Gal C')
+    assert store.resident_bytes == 200
+    store.get('Gal A')
+    assert reads[-1] == 'a.json'
+
+    # Changed documents stay in memory until they are persisted
+    store.upsert({'name': 'Gal C', 'v_mag': np.array([{'value': 30.0}])})
+    assert store.evict() == 1
+    assert store.get('Gal C')['v_mag'][0]['value'] == 30.0
+    assert store.modified() == ['Gal C']
+
+    # Index entries are kept for documents that are not in memory
+    store.create_index('v_mag.value')
+    store.evict()
+    n_reads = len(reads)
+    assert [d['name'] for d in store.select(store.index_lookup('v_mag.value', {'$lt': 21}))] == ['Gal A']
+    assert len(reads) == n_reads + 1
+    assert store.reference_index.fields('Ref') == {}
+
+    assert store.remove('Gal A')['name'] == 'Gal A'
+    assert store.names() == ['Gal B', 'Gal C']
+    assert store.index_lookup('v_mag.value', {'$lt': 21}) == set()
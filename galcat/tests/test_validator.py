@@ -0,0 +1,79 @@
+# Unit tests for validator.py
+import os
+from galcat.core import Database
+from galcat.validator import Validator, ValidationReport
+
+
+def setup_module(module):
+    module.db = Database(directory='galcat/tests/test_data', references_file='galcat/tests/test_references.json')
+
+
+def test_check_unit():
+    assert Validator.check_unit({'unit': 'deg'})
+    assert Validator.check_unit({'unit': ''})
+    assert not Validator.check_unit({'unit': 'penguin'})
+    assert not Validator.check_unit({'unit': ['deg']})
+
+
+def test_run_batch_full_db():
+    report = Validator(database=db, is_data=True, ref_check=False).run_batch()
+    assert isinstance(report, ValidationReport)
+    assert report.n_docs == len(db.query_db({}))
+    assert report.ok and report.n_failed == 0
+
+    # Test data uses empty references, which fail the reference check
+    report = Validator(database=db, is_data=True, ref_check=True).run_batch()
+    assert not report.ok
+    assert report.n_failed == 2 and report.n_passed == 0
+    assert any('missing references' in m for m in report.errors['Gal 1'])
+    assert 'Gal 1' in report.summary()
+
+
+def test_run_batch_reference():
+    # Reference documents follow is_data like run_one: only their dates are checked
+    ref = db.query_reference({'key': 'Bellazzini_2006_1'})[0]
+    v = Validator(database=db, db_object=ref, is_data=False)
+    assert v.run_one()
+    report = v.run_batch()
+    assert report.ok and report.n_docs == 1
+
+
+def test_run_batch_document():
+    doc = {'name': 'Gal 1',
+           'ebv': [{'value': 0.166, 'best': 1, 'reference': 'Bellazzini_2006_1'}],
+           'ra': [{'value': 9.1, 'reference': 'Martin_2005_1', 'unit': 'penguin'},
+                  {'reference': 'Martin_2005_1'}]}
+    report = Validator(database=db, db_object=doc).run_batch()
+    assert report.n_docs == 1
+    assert len(report.errors['Gal 1']) == 2
+    assert all(m.startswith('ERROR: ') for m in report.errors['Gal 1'])
+
+    report = Validator(database=db, db_object={'name': 'Gal 99', 'ebv': []}).run_batch()
+    assert 'new/unmatched object' in report.errors['Gal 99'][0]
+
+    # Same result as the printing interface
+    doc = {'name': 'Gal 1', 'ebv': [{'value': 0.166, 'best': 1, 'reference': 'Bellazzini_2006_1'}]}
+    v = Validator(database=db, db_object=doc)
+    assert v.run() == v.run_batch().ok
+
+
+def test_check_values_messages(capsys):
+    # The printing interface reports the same messages as run_batch
+    doc = {'name': 'Gal 1', 'ra': [{'value': 9.1, 'reference': 'Martin_2005_1', 'unit': 'penguin'},
+                                   {'reference': 'NoSuchRef'}]}
+    v = Validator(database=db, db_object=doc)
+    assert not v.check_values()
+    printed = capsys.readouterr().out.strip().split('\n')
+    assert printed == v.run_batch().errors['Gal 1']
+    assert len(printed) == 3
+
+
+def test_run_batch_lazy(tmpdir):
+    # Validating one document does not read the documents of a lazy database
+    for i in range(5):
+        with open(os.path.join(str(tmpdir), 'Gal_{}.json'.format(i)), 'w') as f:
+            f.write('{"name": "Gal %d", "ra": [{"value": %d, "best": 1, "reference": ""}]}' % (i, i))
+    lazy_db = Database(directory=str(tmpdir), references_file='galcat/tests/test_references.json', lazy=True)
+    doc = {'name': 'Gal 3', 'ra': [{'value': 3, 'reference': 'Martin_2005_1'}]}
+    assert Validator(database=lazy_db, db_object=doc).run_batch().ok
+    assert lazy_db.db.n_reads == 0
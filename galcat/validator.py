@@ -1,7 +1,45 @@
 # Validate JSON
 
 import json
-from astropy.units import Quantity
+import time
+from .core import _parse_unit
+
+
+class ValidationReport(object):
+    def __init__(self):
+        """
+        Result of a batch validation: errors for each document, counts and timings.
+        """
+
+        self.errors = {}  # document name -> list of error messages, only for documents that failed
+        self.n_docs = 0
+        self.elapsed = 0.
+
+    def __repr__(self):
+        return self.summary()
+
+    def __bool__(self):
+        return self.ok
+
+    @property
+    def ok(self):
+        return len(self.errors) == 0
+
+    @property
+    def n_failed(self):
+        return len(self.errors)
+
+    @property
+    def n_passed(self):
+        return self.n_docs - self.n_failed
+
+    def summary(self):
+        out_str = 'Validated {} documents in {:.3f} s: {} passed, {} failed'.format(
+            self.n_docs, self.elapsed, self.n_passed, self.n_failed)
+        for name, messages in self.errors.items():
+            for message in messages:
+                out_str += '\n  {}: {}'.format(name, message)
+        return out_str
 
 
 class Validator(object):
@@ -68,7 +106,7 @@ class Validator(object):
             else:
                 return False
         else:
-            date_check = self.check_dates()
+            return self.check_dates()
 
     def check_name(self):
         """Checks that a name has been provided for the JSON"""
@@ -92,7 +130,7 @@ class Validator(object):
         """Check that all fields in document contain value or distribution fields.
         Also checks references for each field.
         """
-        result = [True]
+        result = True
 
         for k, v in self.doc.items():
             # Skip the name field
@@ -101,20 +139,47 @@ class Validator(object):
 
             # Loop over all value entries
             for elem in v:
-                if elem.get('value') is None and elem.get('distribution') is None:
-                    print('ERROR: {} has missing values/distribution: {}'.format(k, elem))
-                    result.append(False)
-                if self.ref_check and not self.check_references(elem):
-                    print('ERROR: {} has missing references or it does not exist: {}'.format(k, elem))
-                    result.append(False)
-                if elem.get('unit'):
-                    # If unit is present, check that it's valid
-                    unit_check = self.check_unit(elem)
-                    if not unit_check:
-                        print('ERROR: {} has invalid units: {}'.format(k, elem.get('unit')))
-                        result.append(False)
-
-        return all(result)
+                for message in self._check_element(k, elem):
+                    print(message)
+                    result = False
+
+        return result
+
+    def _check_element(self, key, elem, ref_keys=None):
+        """
+        Check a single entry of a field: it needs a value or distribution, an existing reference
+        (if ref_check is set) and, if a unit is given, a valid unit.
+
+        Parameters
+        ----------
+        key : str
+            Name of the field, used in the messages
+        elem : dict
+            Entry to check
+        ref_keys : set or None
+            Known reference keys (Default: None, look the reference up in the database)
+
+        Returns
+        -------
+        messages : list
+            Error messages, empty if the entry passed
+        """
+
+        messages = []
+        if elem.get('value') is None and elem.get('distribution') is None:
+            messages.append('ERROR: {} has missing values/distribution: {}'.format(key, elem))
+        if self.ref_check:
+            if ref_keys is None:
+                ref_check = self.check_references(elem)
+            else:
+                ref = elem.get('reference')
+                ref_check = isinstance(ref, str) and ref != '' and ref in ref_keys
+            if not ref_check:
+                messages.append('ERROR: {} has missing references or it does not exist: {}'.format(key, elem))
+        if elem.get('unit') and not self.check_unit(elem):
+            messages.append('ERROR: {} has invalid units: {}'.format(key, elem.get('unit')))
+
+        return messages
 
     def check_references(self, elem, id_column='key'):
         """Check that references are provided and that they already exist in the database"""
@@ -133,14 +198,81 @@ class Validator(object):
     @staticmethod
     def check_unit(elem):
         # Check that unit is recognized by astropy.units (or is empty)
-        if elem.get('unit') == '':
+        unit = elem.get('unit')
+        if unit == '':
             return True
 
         try:
-            _ = Quantity(1, unit=elem.get('unit'))
-            return True
-        except ValueError:
+            return _parse_unit(unit) is not None
+        except TypeError:
+            # Unhashable values can not be units
             return False
 
+    def run_batch(self):
+        """
+        Validate all documents without printing, collecting the results in a report.
+        Data documents are checked like run_one does, with names and reference keys checked against
+        sets built once from the database; other documents (is_data=False) only have their dates checked.
+
+        Returns
+        -------
+        report : ValidationReport
+            Errors per document, counts and timing
+        """
+
+        start = time.perf_counter()
+        if self.run_full_db:
+            docs = list(self.db.query_db({}))
+        else:
+            docs = [self.doc]
+
+        # Lookup sets for names and reference keys
+        names, ref_keys = set(), set()
+        if self.is_data and self.db.use_mongodb:
+            names = set(self.db.db.distinct(self.id_column))
+            ref_keys = set(self.db.references.distinct('key'))
+        elif self.is_data:
+            if self.id_column == self.db.db.id_column:
+                # Names are known without reading the documents (which matters for a lazy database)
+                names = set(self.db.db.names())
+            else:
+                names = {doc.get(self.id_column) for doc in self.db.db}
+            ref_keys = {ref.get('key') for ref in self.db.references}
+
+        results = [self._check_document(doc, names, ref_keys) for doc in docs]
+
+        report = ValidationReport()
+        report.n_docs = len(docs)
+        for name, messages in results:
+            if messages:
+                report.errors.setdefault(name, []).extend(messages)
+        report.elapsed = time.perf_counter() - start
+
+        return report
+
+    def _check_document(self, doc, names, ref_keys):
+        # Same checks as run_one, returning (name, list of messages as run_one prints them) rather than printing
+        messages = []
+        name = doc.get(self.id_column)
+        if not self.is_data:
+            if not self.check_dates():
+                messages.append('ERROR: Invalid dates: {}'.format(doc))
+            return name, messages
+
+        if not name:
+            return name, ['ERROR: JSON does not provide a valid name in the {} field.'.format(self.id_column)]
+        if name not in names:
+            messages.append('WARNING: This JSON represents a new/unmatched object: {}. '
+                            'Use load_file_to_db() to load new objects.'.format(name))
+
+        for k, v in doc.items():
+            if k == self.id_column:
+                continue
+
+            for elem in v:
+                messages.extend(self._check_element(k, elem, ref_keys))
+
+        return name, messages
+
     def check_dates(self):
         return True
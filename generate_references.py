@@ -53,49 +53,39 @@ The absolute minimum will probably be just be the key (as author_year_integer),
 # I can imagine there being functions to populate the database from calls to ADS given the doi/bibcode
 # However, I also think that queries to the reference table will not be required
 
+import sys
 import json
-import requests
-import urllib.parse
-import ads
-from dsii_secrets import ads_api_key
+from galcat.references import ReferenceResolver, ADSBackend, write_references_json
+from galcat.loader import write_text_atomic
 
-# Example query
-papers = list(ads.SearchQuery(q="The core of the Canis Major galaxy as traced by red clump stars"))
-papers = list(ads.SearchQuery(author="Bellazzini", year=2006))
-papers = list(ads.SearchQuery(first_author="Bellazzini", year=2006,
-                              q='The core of the Canis Major galaxy as traced by red clump stars'))
-
-for p in papers:
-    print(p.year, p.author[0], p.title, p.bibcode, p.doi)
+# Example query, with the ads package directly
+# papers = list(ads.SearchQuery(first_author="Bellazzini", year=2006,
+#                               q='The core of the Canis Major galaxy as traced by red clump stars'))
 
 # Bellazzini_2006_1
 # 10.1111/j.1365-2966.2005.09973.x
 # 2006MNRAS.366..865B
 
-# Get references data
-with open('references.json', 'r') as f:
-    refs = json.load(f)
-
-for ref in refs:
-    if ref.get('bibcode', '') == '' or ref.get('doi', '') == '':
-        author = ref.get('authors', [])[0]
-        year = ref.get('year')
-        title = ref.get('title')
-
-        papers = list(ads.SearchQuery(first_author=author, year=year, title=title))
-        if len(papers) == 1:
-            p = papers[0]
-
-            ref['bibcode'] = p.bibcode
-            ref['doi'] = p.doi[0]
-
-            print(ref)
-        elif len(papers) > 1:
-            print('Warning: more than one paper matched')
-            for p in papers:
-                print(p.year, p.author[0], p.title, p.bibcode, p.doi)
-
-# Output to file
-out_refs = json.dumps(refs, indent=2, sort_keys=False)
-with open('references.json', 'w') as f:
-    f.write(out_refs)
+if __name__ == '__main__':
+    # Parse References.dat into references.json. Existing entries are merged by key: fields already set there
+    # (hand edits, doi/bibcode already found) are kept and references added by hand are not dropped
+    n_refs = write_references_json('input/References.dat', 'references.json')
+    print('{} references parsed'.format(n_refs))
+    if '--no-ads' in sys.argv[1:]:
+        sys.exit()
+
+    from dsii_secrets import ads_api_key
+
+    # Get references data
+    with open('references.json', 'r') as f:
+        refs = json.load(f)
+
+    # Searches are cached in input/ads_cache.json, so rerunning only searches for new references
+    resolver = ReferenceResolver(ADSBackend(token=ads_api_key), cache_file='input/ads_cache.json',
+                                 workers=4, rate_limit=5.)
+    summary = resolver.resolve(refs, verbose=True)
+    print(summary)
+
+    # Output to file, replacing it in one step so an interrupted run leaves the old file intact
+    out_refs = json.dumps(refs, indent=2, sort_keys=False)
+    write_text_atomic('references.json', out_refs)